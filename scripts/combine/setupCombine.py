@@ -3,7 +3,7 @@ from wremnants import CardTool,combine_helpers,combine_theory_helper, HDF5Writer
 from wremnants.syst_tools import massWeightNames
 from wremnants.datasets.datagroups import Datagroups
 
-from utilities import common, logging, boostHistHelpers as hh
+from utilities import common, logging, boostHistHelpers as hh, h5pyutils
 from utilities.io_tools import input_tools
 import argparse
 import hist
@@ -21,6 +21,11 @@ def make_parser(parser=None):
     parser.add_argument("--noColorLogger", action="store_true", help="Do not use logging with colors")
     parser.add_argument("--hdf5", action="store_true", help="Write out datacard in hdf5")
     parser.add_argument("--sparse", action="store_true", help="Write out datacard in sparse mode (only for when using hdf5)")
+    parser.add_argument("--sparseOutOfCore", action="store_true", help="Keep the sparse tensor blocks in temporary files on disk (in $TMPDIR) while making the datacard and merge them into the output, to reduce the memory usage (only for when using --sparse)")
+    parser.add_argument("--hdf5Compression", type=str, default="gzip", choices=h5pyutils.compression_choices, help="Compression of the datasets in the hdf5 output (lz4, zstd and blosc require the hdf5plugin filters to read the file)")
+    parser.add_argument("--hdf5Threads", type=int, default=1, help="Number of threads of the hdf5 writer, used to compute the logk of different systematics concurrently, to assemble the sparse tensors and to compress the chunks of the output (1 runs everything serially)")
+    parser.add_argument("--rootWriter", type=str, default="root", choices=["root", "uproot"], help="Backend to write the histograms of the root datacard, with uproot the histograms are converted concurrently and written in batches")
+    parser.add_argument("--rootWriterThreads", type=int, default=1, help="Number of threads to convert the histograms of the different channels and systematics (only for --rootWriter uproot)")
     parser.add_argument("--excludeProcGroups", type=str, nargs="*", help="Don't run over processes belonging to these groups (only accepts exact group names)", default=["QCD"])
     parser.add_argument("--filterProcGroups", type=str, nargs="*", help="Only run over processes belonging to these groups", default=[])
     parser.add_argument("-x", "--excludeNuisances", type=str, default="", help="Regular expression to exclude some systematics from the datacard")
@@ -207,6 +212,7 @@ def setup(args, inputFile, fitvar, xnorm=False):
     # Start to create the CardTool object, customizing everything
     cardTool = CardTool.CardTool(xnorm=xnorm, ABCD=simultaneousABCD, real_data=args.realData)
     cardTool.setDatagroups(datagroups)
+    cardTool.setRootWriter(args.rootWriter, args.rootWriterThreads)
     if args.qcdProcessName:
         cardTool.setFakeName(args.qcdProcessName)
     logger.debug(f"Making datacards with these processes: {cardTool.getProcesses()}")
@@ -927,7 +933,7 @@ if __name__ == "__main__":
             args.doStatOnly = True
     
     if args.hdf5: 
-        writer = HDF5Writer.HDF5Writer(sparse=args.sparse)
+        writer = HDF5Writer.HDF5Writer(sparse=args.sparse, compression=args.hdf5Compression, nthreads=args.hdf5Threads, out_of_core=args.sparseOutOfCore)
 
         # loop over all files
         outnames = []
@@ -14,10 +14,12 @@ args = parser.parse_args()
 import narf
 import wremnants
 from wremnants import theory_tools, syst_tools, theory_corrections, muon_selections, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
+from wremnants import histmaker_tools
+from wremnants.histmaker_tools import scale_and_aggregate
 from wremnants.datasets.dataset_tools import getDatasets
 import math
 import hist
+import sys
 import ROOT
 import wremnants.lowpu as lowpu
 
@@ -34,6 +36,7 @@ else:
 datasets = getDatasets(maxFiles=args.maxFiles,
                         filt=args.filterProcs,
                         excl=list(set(args.excludeProcs + ["singlemuon"] if flavor=="e" else ["singleelectron"])),
+                        fileCatalogue=args.fileCatalogue, catalogueTTL=args.fileCatalogueTTL, refreshCatalogue=args.refreshFileCatalogue, countEntries=args.countFileEntries,
                         extended = "msht20an3lo" not in args.pdfs,
                         mode="lowpu")
 
@@ -469,10 +472,13 @@ def build_graph_cutFlow(df, dataset):
     return results, weightsum
 
 
-resultdict = narf.build_and_run(datasets, build_graph)
+meta_info = {}
+resultdict = histmaker_tools.build_and_run(datasets, build_graph, output_tools.analysis_output_path(f"mw_lowPU_{flavor}.hdf5", args), args, meta_info=meta_info)
+if resultdict is None:
+    # only the results of this shard were written, the post processing is done on the merged results
+    sys.exit(0)
 
 if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, groups_to_aggregate)
+    scale_and_aggregate(datasets, resultdict, groups_to_aggregate)
 
-output_tools.write_analysis_output(resultdict, f"mw_lowPU_{flavor}.hdf5", args)
\ No newline at end of file
+output_tools.write_analysis_output(resultdict, f"mw_lowPU_{flavor}.hdf5", args, meta_info=meta_info)
\ No newline at end of file
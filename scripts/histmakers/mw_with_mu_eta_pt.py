@@ -9,8 +9,9 @@ parser,initargs = common.common_parser(True)
 import ROOT
 import narf
 import wremnants
-from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools, theoryAgnostic_tools, helicity_utils
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
+from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools, theoryAgnostic_tools, helicity_utils, experimental_weights
+from wremnants import histmaker_tools
+from wremnants.histmaker_tools import scale_and_aggregate
 from wremnants.datasets.dataset_tools import getDatasets
 import hist
 import lz4.frame
@@ -19,6 +20,7 @@ import time
 from utilities import boostHistHelpers as hh
 import pathlib
 import os
+import sys
 import numpy as np
 
 data_dir = common.data_dir
@@ -33,6 +35,7 @@ parser.add_argument("--onlyTheorySyst", action="store_true", help="Keep only the
 parser.add_argument("--oneMCfileEveryN", type=int, default=None, help="Use 1 MC file every N, where N is given by this option. Mainly for tests")
 parser.add_argument("--noAuxiliaryHistograms", action="store_true", help="Remove auxiliary histograms to save memory (removed by default with --unfolding or --theoryAgnostic)")
 parser.add_argument("--mtCut", type=int, default=40, help="Value for the transverse mass cut in the event selection")
+parser.add_argument("--fuseExpWeights", action="store_true", help="Evaluate the pileup, vertex, muon prefiring and efficiency scale factor weights in a single compiled helper instead of separate columns (the throughput can be compared with scripts/tests/benchmark_exp_weights.py)")
 
 args = parser.parse_args()
 
@@ -74,6 +77,7 @@ datasets = getDatasets(maxFiles=args.maxFiles,
                        filt=args.filterProcs,
                        excl=args.excludeProcs, 
                        nanoVersion="v9", base_path=args.dataPath, oneMCfileEveryN=args.oneMCfileEveryN,
+                       fileCatalogue=args.fileCatalogue, catalogueTTL=args.fileCatalogueTTL, refreshCatalogue=args.refreshFileCatalogue, countEntries=args.countFileEntries,
                        extended = "msht20an3lo" not in args.pdfs,
                        era=era)
 
@@ -89,6 +93,9 @@ template_npt = int(args.pt[0])
 template_minpt = args.pt[1]
 template_maxpt = args.pt[2]
 logger.info(f"Pt binning: {template_npt} bins from {template_minpt} to {template_maxpt}")
+# pt range of the good muons, wider than the templates, used by the preselection of the skims and by the selection
+good_muon_minpt = 24
+good_muon_maxpt = 100
 
 # standard regular axes
 axis_eta = hist.axis.Regular(template_neta, template_mineta, template_maxeta, name = "eta", overflow=False, underflow=False)
@@ -161,10 +168,14 @@ logger.info(f"SF file: {args.sfFile}")
 pileup_helper = wremnants.make_pileup_helper(era = era)
 vertex_helper = wremnants.make_vertex_helper(era = era)
 
+if args.fuseExpWeights:
+    exp_weight_helper = wremnants.make_experimental_weight_helper(pileup_helper, vertex_helper, muon_prefiring_helper,
+        None if args.noScaleFactors else muon_efficiency_helper, new_muon_prefiring=era == "2016PostVFP", vertex_weight=not args.noVertexWeight)
+
 calib_filepaths = common.calib_filepaths
 closure_filepaths = common.closure_filepaths
 
-diff_weights_helper = ROOT.wrem.SplinesDifferentialWeightsHelper(calib_filepaths['tflite_file']) if (args.muonScaleVariation == 'smearingWeightsSplines' or args.validationHists) else None
+diff_weights_helper = muon_calibration.make_splines_differential_weights_helper(calib_filepaths['tflite_file'], grid=args.splinesWeightsGrid) if (args.muonScaleVariation == 'smearingWeightsSplines' or args.validationHists) else None
 
 mc_jpsi_crctn_helper, data_jpsi_crctn_helper, jpsi_crctn_MC_unc_helper, jpsi_crctn_data_unc_helper = muon_calibration.make_jpsi_crctn_helpers(args, calib_filepaths, make_uncertainty_helper=True)
 
@@ -215,6 +226,22 @@ def setTheoryAgnosticGraph(df, results, dataset, reco_sel_GF, era, nominal_axes_
     
 smearing_weights_procs = []
 
+# event weight of the simulation, also used for the sum of weights of the skimmed datasets
+mc_weight = "std::copysign(1.0, genWeight)"
+
+def preselection(df, dataset):
+    # subset of the event selection below, used to skim the datasets
+    if not args.makeMCefficiency:
+        df = df.Filter(muon_selections.hlt_string(era))
+    cvh_helper = data_calibration_helper if dataset.is_data else mc_calibration_helper
+    jpsi_helper = data_jpsi_crctn_helper if dataset.is_data else mc_jpsi_crctn_helper
+    df = muon_calibration.define_corrected_muons(df, cvh_helper, jpsi_helper, args, dataset, smearing_helper, bias_helper)
+    df = muon_selections.select_veto_muons(df, nMuons=1)
+    df = muon_selections.select_good_muons(df, good_muon_minpt, good_muon_maxpt, dataset.group, nMuons=1, use_trackerMuons=args.trackerMuons, use_isolation=False)
+    df = muon_selections.veto_electrons(df)
+    df = muon_selections.apply_met_filters(df)
+    return df
+
 def build_graph(df, dataset):
     logger.info(f"build graph for dataset: {dataset.name}")
     results = []
@@ -236,10 +263,10 @@ def build_graph(df, dataset):
 
     if dataset.is_data:
         df = df.DefinePerSample("weight", "1.0")
+        weightsum = histmaker_tools.sum_and_count_weights(df, dataset, "1.0")
     else:
-        df = df.Define("weight", "std::copysign(1.0, genWeight)")
-
-    weightsum = df.SumAndCount("weight")
+        df = df.Define("weight", mc_weight)
+        weightsum = histmaker_tools.sum_and_count_weights(df, dataset, mc_weight)
 
     axes = nominal_axes
     cols = nominal_cols
@@ -283,7 +310,7 @@ def build_graph(df, dataset):
     df = muon_calibration.define_corrected_muons(df, cvh_helper, jpsi_helper, args, dataset, smearing_helper, bias_helper)
 
     df = muon_selections.select_veto_muons(df, nMuons=1)
-    df = muon_selections.select_good_muons(df, 24, 100, dataset.group, nMuons=1, use_trackerMuons=args.trackerMuons, use_isolation=False)
+    df = muon_selections.select_good_muons(df, good_muon_minpt, good_muon_maxpt, dataset.group, nMuons=1, use_trackerMuons=args.trackerMuons, use_isolation=False)
 
     # the corrected RECO muon kinematics, which is intended to be used as the nominal
     df = muon_calibration.define_corrected_reco_muon_kinematics(df)
@@ -347,31 +374,35 @@ def build_graph(df, dataset):
     if dataset.is_data:
         df = df.DefinePerSample("nominal_weight", "1.0")            
     else:
-        df = df.Define("weight_pu", pileup_helper, ["Pileup_nTrueInt"])
-        df = df.Define("weight_vtx", vertex_helper, ["GenVtx_z", "Pileup_nTrueInt"])
-        df = df.Define("weight_newMuonPrefiringSF", muon_prefiring_helper, ["Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId"])
-
-        if era == "2016PostVFP":
-            weight_expr = "weight_pu*weight_newMuonPrefiringSF*L1PreFiringWeight_ECAL_Nom"
-        else:
-            weight_expr = "weight_pu*L1PreFiringWeight_Muon_Nom*L1PreFiringWeight_ECAL_Nom"
-            
-        if not args.noVertexWeight:
-            weight_expr += "*weight_vtx"
-
         # define recoil uT, muon projected on boson pt, the latter is made using preFSR variables
         # TODO: fix it for not W/Z processes
         columnsForSF = ["goodMuons_pt0", "goodMuons_eta0", "goodMuons_SApt0", "goodMuons_SAeta0", "goodMuons_uT0", "goodMuons_charge0", "passIso"]
         df = muon_selections.define_muon_uT_variable(df, isWorZ, smooth3dsf=args.smooth3dsf, colNamePrefix="goodMuons")
         if not args.smooth3dsf:
             columnsForSF.remove("goodMuons_uT0")
-            
-        if not args.noScaleFactors:
-            df = df.Define("weight_fullMuonSF_withTrackingReco", muon_efficiency_helper, columnsForSF)
-            weight_expr += "*weight_fullMuonSF_withTrackingReco"
 
-        logger.debug(f"Exp weight defined: {weight_expr}")
-        df = df.Define("exp_weight", weight_expr)
+        if args.fuseExpWeights:
+            # all experimental weights from a single helper, the individual factors are still defined
+            df = experimental_weights.define_experimental_weights(df, exp_weight_helper, new_muon_prefiring=era == "2016PostVFP", scale_factors=not args.noScaleFactors)
+        else:
+            df = df.Define("weight_pu", pileup_helper, ["Pileup_nTrueInt"])
+            df = df.Define("weight_vtx", vertex_helper, ["GenVtx_z", "Pileup_nTrueInt"])
+            df = df.Define("weight_newMuonPrefiringSF", muon_prefiring_helper, ["Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId"])
+
+            if era == "2016PostVFP":
+                weight_expr = "weight_pu*weight_newMuonPrefiringSF*L1PreFiringWeight_ECAL_Nom"
+            else:
+                weight_expr = "weight_pu*L1PreFiringWeight_Muon_Nom*L1PreFiringWeight_ECAL_Nom"
+                
+            if not args.noVertexWeight:
+                weight_expr += "*weight_vtx"
+
+            if not args.noScaleFactors:
+                df = df.Define("weight_fullMuonSF_withTrackingReco", muon_efficiency_helper, columnsForSF)
+                weight_expr += "*weight_fullMuonSF_withTrackingReco"
+
+            logger.debug(f"Exp weight defined: {weight_expr}")
+            df = df.Define("exp_weight", weight_expr)
         df = theory_tools.define_theory_weights_and_corrs(df, dataset.name, corr_helpers, args)
 
         if isWmunu and args.theoryAgnostic and not hasattr(dataset, "out_of_acceptance"):
@@ -528,9 +559,21 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+if args.skimCache:
+    # the histograms for the signal in the fiducial phase space are filled before the selection
+    skip = ["WplusmunuPostVFP", "WminusmunuPostVFP"] if args.unfolding or args.theoryAgnostic else []
+    datasets = histmaker_tools.skim_datasets(datasets, preselection, args, mc_weight, skip=skip)
+
+meta_info = {}
+resultdict = histmaker_tools.build_and_run(datasets, build_graph, output_tools.analysis_output_path(f"{os.path.basename(__file__).replace('py', 'hdf5')}", args), args, meta_info=meta_info)
+if resultdict is None:
+    # only the results of this shard were written, the post processing is done on the merged results
+    sys.exit(0)
 if not args.onlyMainHistograms and args.muonScaleVariation == 'smearingWeightsGaus' and not (args.theoryAgnostic and not args.poiAsNoi):
     logger.debug("Apply smearingWeights")
+    if args.resume:
+        # the graph is not built for datasets taken from the checkpoint file
+        smearing_weights_procs = [k for k, v in resultdict.items() if "muonScaleSyst_responseWeights_gaus" in v["output"]]
     muon_calibration.transport_smearing_weights_to_reco(
         resultdict,
         smearing_weights_procs,
@@ -540,7 +583,6 @@ if args.validationHists:
     muon_validation.muon_scale_variation_from_manual_shift(resultdict)
 
 if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, groups_to_aggregate)
+    scale_and_aggregate(datasets, resultdict, groups_to_aggregate)
 
-output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
+output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args, meta_info=meta_info)
@@ -7,7 +7,8 @@ import ROOT
 import narf
 import wremnants
 from wremnants import theory_tools,syst_tools,theory_corrections, muon_validation, muon_calibration, muon_selections, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
+from wremnants import histmaker_tools
+from wremnants.histmaker_tools import scale_and_aggregate
 from wremnants.datasets.dataset_tools import getDatasets
 from wremnants.datasets.datagroups import Datagroups
 import hist
@@ -15,6 +16,7 @@ import lz4.frame
 import math
 import time
 import os
+import sys
 
 parser.add_argument("--csVarsHist", action='store_true', help="Add CS variables to dilepton hist")
 parser.add_argument("--axes", type=str, nargs="*", default=["mll", "ptll"], help="")
@@ -39,6 +41,7 @@ datasets = getDatasets(maxFiles=args.maxFiles,
                        excl=args.excludeProcs, 
                        nanoVersion="v9",
                        base_path=args.dataPath,
+                       fileCatalogue=args.fileCatalogue, catalogueTTL=args.fileCatalogueTTL, refreshCatalogue=args.refreshFileCatalogue, countEntries=args.countFileEntries,
                        extended = "msht20an3lo" not in args.pdfs,
                        era = era)
 
@@ -126,7 +129,7 @@ vertex_helper = wremnants.make_vertex_helper(era = era)
 
 calib_filepaths = common.calib_filepaths
 closure_filepaths = common.closure_filepaths
-diff_weights_helper = ROOT.wrem.SplinesDifferentialWeightsHelper(calib_filepaths['tflite_file']) if (args.muonScaleVariation == 'smearingWeightsSplines' or args.validationHists) else None
+diff_weights_helper = muon_calibration.make_splines_differential_weights_helper(calib_filepaths['tflite_file'], grid=args.splinesWeightsGrid) if (args.muonScaleVariation == 'smearingWeightsSplines' or args.validationHists) else None
 mc_jpsi_crctn_helper, data_jpsi_crctn_helper, mc_jpsi_crctn_unc_helper, data_jpsi_crctn_unc_helper = muon_calibration.make_jpsi_crctn_helpers(args, calib_filepaths, make_uncertainty_helper=True)
 z_non_closure_parametrized_helper, z_non_closure_binned_helper = muon_calibration.make_Z_non_closure_helpers(args, calib_filepaths, closure_filepaths)
 
@@ -138,6 +141,21 @@ bias_helper = muon_calibration.make_muon_bias_helpers(args)
 
 corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], args.theoryCorr)
 
+# event weight of the simulation, also used for the sum of weights of the skimmed datasets
+mc_weight = "std::copysign(1.0, genWeight)"
+
+def preselection(df, dataset):
+    # subset of the event selection below, used to skim the datasets
+    df = df.Filter(muon_selections.hlt_string(era))
+    df = muon_selections.veto_electrons(df)
+    df = muon_selections.apply_met_filters(df)
+    cvh_helper = data_calibration_helper if dataset.is_data else mc_calibration_helper
+    jpsi_helper = data_jpsi_crctn_helper if dataset.is_data else mc_jpsi_crctn_helper
+    df = muon_calibration.define_corrected_muons(df, cvh_helper, jpsi_helper, args, dataset, smearing_helper, bias_helper)
+    df = muon_selections.select_veto_muons(df, nMuons=2)
+    df = muon_selections.select_good_muons(df, args.pt[1], args.pt[2], dataset.group, nMuons=2, use_trackerMuons=args.trackerMuons, use_isolation=True, isoDefinition=args.isolationDefinition)
+    return df
+
 def build_graph(df, dataset):
     logger.info(f"build graph for dataset: {dataset.name}")
     results = []
@@ -149,10 +167,10 @@ def build_graph(df, dataset):
     jpsi_helper = data_jpsi_crctn_helper if dataset.is_data else mc_jpsi_crctn_helper
     if dataset.is_data:
         df = df.DefinePerSample("weight", "1.0")
+        weightsum = histmaker_tools.sum_and_count_weights(df, dataset, "1.0")
     else:
-        df = df.Define("weight", "std::copysign(1.0, genWeight)")
-
-    weightsum = df.SumAndCount("weight")
+        df = df.Define("weight", mc_weight)
+        weightsum = histmaker_tools.sum_and_count_weights(df, dataset, mc_weight)
 
     axes = nominal_axes
     cols = nominal_cols
@@ -399,10 +417,18 @@ def build_graph(df, dataset):
     return results, weightsum
 
 logger.debug(f"Datasets are {[d.name for d in datasets]}")
-resultdict = narf.build_and_run(datasets, build_graph)
+if args.skimCache:
+    # the histograms at generator level and for the signal in the fiducial phase space are filled before the selection
+    skip = common.zprocs if args.unfolding or not args.noAuxiliaryHistograms else []
+    datasets = histmaker_tools.skim_datasets(datasets, preselection, args, mc_weight, skip=skip)
+
+meta_info = {}
+resultdict = histmaker_tools.build_and_run(datasets, build_graph, output_tools.analysis_output_path(f"{os.path.basename(__file__).replace('py', 'hdf5')}", args), args, meta_info=meta_info)
+if resultdict is None:
+    # only the results of this shard were written, the post processing is done on the merged results
+    sys.exit(0)
 
 if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, args.aggregateGroups)
+    scale_and_aggregate(datasets, resultdict, args.aggregateGroups)
 
-output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
+output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args, meta_info=meta_info)
@@ -15,9 +15,11 @@ logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 import narf
 import wremnants
 from wremnants import theory_tools, syst_tools, theory_corrections, muon_selections, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
+from wremnants import histmaker_tools
+from wremnants.histmaker_tools import scale_and_aggregate
 from wremnants.datasets.dataset_tools import getDatasets
 import hist
+import sys
 import wremnants.lowpu as lowpu
 
 
@@ -33,6 +35,7 @@ mass_max = 120
 datasets = getDatasets(maxFiles=args.maxFiles,
                         filt=args.filterProcs,
                         excl=list(set(args.excludeProcs + ["singlemuon"] if flavor=="ee" else ["singleelectron"])),
+                        fileCatalogue=args.fileCatalogue, catalogueTTL=args.fileCatalogueTTL, refreshCatalogue=args.refreshFileCatalogue, countEntries=args.countFileEntries,
                         extended = "msht20an3lo" not in args.pdfs,
                         mode="lowpu"
                         )
@@ -346,10 +349,13 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+meta_info = {}
+resultdict = histmaker_tools.build_and_run(datasets, build_graph, output_tools.analysis_output_path(f"mz_lowPU_{flavor}.hdf5", args), args, meta_info=meta_info)
+if resultdict is None:
+    # only the results of this shard were written, the post processing is done on the merged results
+    sys.exit(0)
 
 if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, args.aggregateGroups)
+    scale_and_aggregate(datasets, resultdict, args.aggregateGroups)
 
-output_tools.write_analysis_output(resultdict, f"mz_lowPU_{flavor}.hdf5", args)
+output_tools.write_analysis_output(resultdict, f"mz_lowPU_{flavor}.hdf5", args, meta_info=meta_info)
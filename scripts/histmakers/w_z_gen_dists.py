@@ -35,6 +35,7 @@ logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 datasets = getDatasets(maxFiles=args.maxFiles,
                         filt=args.filterProcs,
                         excl=args.excludeProcs,
+                        fileCatalogue=args.fileCatalogue, catalogueTTL=args.fileCatalogueTTL, refreshCatalogue=args.refreshFileCatalogue, countEntries=args.countFileEntries,
                         extended = "msht20an3lo" not in args.pdfs,
                         nanoVersion="v9", base_path=args.dataPath, mode='gen')
 
@@ -7,6 +7,7 @@ parser,initargs = common.common_parser(True)
 import narf
 import wremnants
 from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools
+from wremnants import histmaker_tools
 from wremnants.histmaker_tools import scale_to_data, aggregate_groups
 from wremnants.datasets.dataset_tools import getDatasets
 import hist
@@ -16,6 +17,7 @@ import time
 from utilities import boostHistHelpers as hh
 import pathlib
 import os
+import sys
 import numpy as np
 import ROOT
 
@@ -29,6 +31,7 @@ logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 datasets = getDatasets(maxFiles=args.maxFiles,
                         filt=args.filterProcs,
                         excl=args.excludeProcs,
+                        fileCatalogue=args.fileCatalogue, catalogueTTL=args.fileCatalogueTTL, refreshCatalogue=args.refreshFileCatalogue, countEntries=args.countFileEntries,
                         extended = "msht20an3lo" not in args.pdfs,
                         nanoVersion="v9", base_path=args.dataPath)
 
@@ -178,7 +181,11 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+meta_info = {}
+resultdict = histmaker_tools.build_and_run(datasets, build_graph, output_tools.analysis_output_path(f"{os.path.basename(__file__).replace('py', 'hdf5')}", args), args, meta_info=meta_info)
+if resultdict is None:
+    # only the results of this shard were written, the post processing is done on the merged results
+    sys.exit(0)
 
-output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
+output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args, meta_info=meta_info)
 
@@ -0,0 +1,62 @@
+import argparse
+
+import numpy as np
+
+from utilities import common, logging
+from utilities.rdf_tools import time_event_loop
+
+parser = argparse.ArgumentParser(description="Time per call of the smooth efficiency stat helpers evaluating the variations from the histogram or from the precomputed lookup table, on synthetic muons")
+parser.add_argument("--nEvents", type=int, default=1000000, help="Number of synthetic events with one muon each")
+parser.add_argument("--sfFile", type=str, default=f"{common.data_dir}/muonSF/allSmooth_GtoHout_vtxAgnIso.root", help="File with muon scale factors")
+parser.add_argument("--noSmooth3dsf", dest="smooth3dsf", action="store_false", help="Use the 2D scale factors instead of the ut dependent ones")
+parser.add_argument("--isoEfficiencySmoothing", action="store_true", help="If isolation SF was derived from smooth efficiencies instead of direct smoothing")
+parser.add_argument("--steps", type=str, nargs="*", default=[], help="Only time the helpers with any of these strings in their name (e.g. trigger iso)")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+import ROOT
+# single thread for a clean time per call
+ROOT.ROOT.DisableImplicitMT()
+import narf
+import wremnants
+
+_, _, helpers = wremnants.make_muon_efficiency_helpers_smooth(filename=args.sfFile, era="2016PostVFP",
+    what_analysis=ROOT.wrem.AnalysisType.Wmass, isoEfficiencySmoothing=args.isoEfficiencySmoothing, smooth3D=args.smooth3dsf)
+
+# including under/overflow in pt, eta and ut
+rng = np.random.default_rng(1)
+inputs = {
+    "pt": rng.uniform(20., 60., size=args.nEvents),
+    "eta": rng.uniform(-2.5, 2.5, size=args.nEvents),
+    "ut": rng.normal(0., 20., size=args.nEvents),
+    "charge": rng.choice([-1, 1], size=args.nEvents).astype(np.int32),
+    "passIso": rng.uniform(size=args.nEvents) < 0.8,
+    "nominal_weight": np.ones(args.nEvents),
+}
+
+def make_df():
+    df = ROOT.RDF.FromNumpy(inputs)
+    df = df.Define("muon_pt", "float(pt)").Define("muon_eta", "float(eta)").Define("muon_ut", "float(ut)")
+    return df
+
+def run(df):
+    values, dt = time_event_loop(df, ["sum"])
+    return values["sum"], dt
+
+# the time of the event loop without the helper is subtracted
+_, dt_base = run(make_df().Define("sum", "muon_pt + muon_eta + muon_ut + charge + passIso"))
+
+for key, helper in helpers.items():
+    if args.steps and not any(s in key for s in args.steps):
+        continue
+    cols = ["muon_pt", "muon_eta"] + (["muon_ut"] if args.smooth3dsf else []) + ["charge"] + (["passIso"] if "iso" in key else []) + ["nominal_weight"]
+    values = {}
+    for name, use_table in [("histogram", False), ("table", True)]:
+        helper.set_use_table(use_table)
+        df = make_df().Define("variations", helper, cols)
+        df = df.Define("sum", "Eigen::Tensor<double, 0> s = variations.sum(); return s();")
+        values[name], dt = run(df)
+        logger.info(f"{key.ljust(20)} {name.ljust(10)}: {(dt - dt_base)/args.nEvents*1e9:8.1f} ns per call")
+    helper.set_use_table(True)
+    logger.info(f"{key.ljust(20)} max deviation {np.max(np.abs(values['table'] - values['histogram'])):.3e}")
@@ -0,0 +1,91 @@
+import argparse
+
+import numpy as np
+
+from utilities import common, logging
+from utilities.rdf_tools import time_event_loop
+
+parser = argparse.ArgumentParser(description="Compare the event loop throughput and the results of the experimental weights defined as separate columns or with the fused helper, on synthetic events")
+parser.add_argument("--nEvents", type=int, default=1000000, help="Number of synthetic events")
+parser.add_argument("--era", type=str, default="2016PostVFP", help="Data taking era")
+parser.add_argument("--sfFile", type=str, default=f"{common.data_dir}/muonSF/allSmooth_GtoHout_vtxAgnIso.root", help="File with muon scale factors")
+parser.add_argument("--noSmooth3dsf", dest="smooth3dsf", action="store_false", help="Use the 2D scale factors instead of the ut dependent ones")
+parser.add_argument("--noScaleFactors", action="store_true", help="Don't include the efficiency scale factors")
+parser.add_argument("--noVertexWeight", action="store_true", help="Don't include the vertex weight")
+parser.add_argument("-j", "--nThreads", type=int, default=1, help="Number of threads (0 uses all available threads)")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+import ROOT
+ROOT.ROOT.EnableImplicitMT(max(0, args.nThreads))
+import narf
+import wremnants
+from wremnants import experimental_weights
+
+nthreads = max(1, ROOT.ROOT.GetThreadPoolSize())
+new_muon_prefiring = args.era == "2016PostVFP"
+
+pileup_helper = wremnants.make_pileup_helper(era=args.era)
+vertex_helper = wremnants.make_vertex_helper(era=args.era)
+muon_prefiring_helper, _, _ = wremnants.make_muon_prefiring_helpers(era=args.era)
+muon_efficiency_helper = None
+if not args.noScaleFactors:
+    muon_efficiency_helper, _, _ = wremnants.make_muon_efficiency_helpers_smooth(filename=args.sfFile, era=args.era,
+        what_analysis=ROOT.wrem.AnalysisType.Wmass, smooth3D=args.smooth3dsf)
+exp_weight_helper = wremnants.make_experimental_weight_helper(pileup_helper, vertex_helper, muon_prefiring_helper, muon_efficiency_helper,
+    new_muon_prefiring=new_muon_prefiring, vertex_weight=not args.noVertexWeight)
+
+# two muons per event, the first one selected, including values in the under/overflow of the histograms
+rng = np.random.default_rng(1)
+inputs = {
+    "Pileup_nTrueInt": rng.uniform(0., 80., size=args.nEvents).astype(np.float32),
+    "GenVtx_z": rng.normal(0., 4., size=args.nEvents).astype(np.float32),
+    "L1PreFiringWeight_Muon_Nom": rng.uniform(0.95, 1., size=args.nEvents).astype(np.float32),
+    "L1PreFiringWeight_ECAL_Nom": rng.uniform(0.95, 1., size=args.nEvents).astype(np.float32),
+    "ut": rng.normal(0., 20., size=args.nEvents).astype(np.float32),
+    "passIso": rng.uniform(size=args.nEvents) < 0.8,
+}
+for i in range(2):
+    inputs[f"pt{i}"] = rng.uniform(26., 56., size=args.nEvents).astype(np.float32)
+    inputs[f"eta{i}"] = rng.uniform(-2.4, 2.4, size=args.nEvents).astype(np.float32)
+    inputs[f"phi{i}"] = rng.uniform(-np.pi, np.pi, size=args.nEvents).astype(np.float32)
+    inputs[f"charge{i}"] = rng.choice([-1, 1], size=args.nEvents).astype(np.int32)
+
+def make_df():
+    df = ROOT.RDF.FromNumpy(inputs)
+    for v in ["pt", "eta", "phi"]:
+        df = df.Define(f"Muon_corrected{v.capitalize()}", f"ROOT::VecOps::RVec<float>{{{v}0, {v}1}}")
+    df = df.Define("Muon_correctedCharge", "ROOT::VecOps::RVec<int>{charge0, charge1}")
+    df = df.Define("Muon_looseId", "ROOT::VecOps::RVec<bool>{true, true}")
+    for v in ["pt", "eta", "charge"]:
+        df = df.Alias(f"goodMuons_{v}0", f"{v}0")
+    df = df.Alias("goodMuons_SApt0", "pt0").Alias("goodMuons_SAeta0", "eta0").Alias("goodMuons_uT0", "ut")
+    return df
+
+# same columns as in mw_with_mu_eta_pt.py
+df = make_df()
+df = df.Define("weight_pu", pileup_helper, ["Pileup_nTrueInt"])
+df = df.Define("weight_vtx", vertex_helper, ["GenVtx_z", "Pileup_nTrueInt"])
+df = df.Define("weight_newMuonPrefiringSF", muon_prefiring_helper, ["Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId"])
+weight_expr = "weight_pu*weight_newMuonPrefiringSF*L1PreFiringWeight_ECAL_Nom" if new_muon_prefiring else "weight_pu*L1PreFiringWeight_Muon_Nom*L1PreFiringWeight_ECAL_Nom"
+if not args.noVertexWeight:
+    weight_expr += "*weight_vtx"
+if not args.noScaleFactors:
+    columnsForSF = ["goodMuons_pt0", "goodMuons_eta0", "goodMuons_SApt0", "goodMuons_SAeta0", "goodMuons_uT0", "goodMuons_charge0", "passIso"]
+    if not args.smooth3dsf:
+        columnsForSF.remove("goodMuons_uT0")
+    df = df.Define("weight_fullMuonSF_withTrackingReco", muon_efficiency_helper, columnsForSF)
+    weight_expr += "*weight_fullMuonSF_withTrackingReco"
+df_separate = df.Define("exp_weight", weight_expr)
+
+df_fused = experimental_weights.define_experimental_weights(make_df(), exp_weight_helper,
+    new_muon_prefiring=new_muon_prefiring, scale_factors=not args.noScaleFactors)
+
+values = {}
+for name, df in [("separate", df_separate), ("fused", df_fused)]:
+    res, dt = time_event_loop(df, ["exp_weight"])
+    logger.info(f"{name.ljust(8)}: {dt:.2f} s, {args.nEvents/dt/nthreads:.0f} events/s per thread with {nthreads} threads")
+    values[name] = res["exp_weight"]
+
+logger.info(f"exp_weight: max deviation {np.max(np.abs(values['fused'] - values['separate'])):.3e}")
@@ -0,0 +1,53 @@
+import argparse
+import os
+import time
+
+import hdf5plugin
+import h5py
+import numpy as np
+
+from utilities import logging
+from utilities.h5pyutils import writeFlatInChunks, compression_choices
+
+parser = argparse.ArgumentParser(description="Compare the write speed of the serial gzip path and the threaded chunk writer on a synthetic logk tensor")
+parser.add_argument("-o", "--outfile", type=str, default="/tmp/benchmark_h5_chunk_writer.hdf5", help="Output file (overwritten for each configuration)")
+parser.add_argument("--nBins", type=int, default=5000, help="Number of bins of the synthetic tensor")
+parser.add_argument("--nProc", type=int, default=10, help="Number of processes of the synthetic tensor")
+parser.add_argument("--nSyst", type=int, default=2000, help="Number of systematics of the synthetic tensor")
+parser.add_argument("--sparsity", type=float, default=0.5, help="Fraction of systematics with all zero entries")
+parser.add_argument("--chunkSize", type=int, default=4*1024**2, help="Maximum chunk size in bytes")
+parser.add_argument("--compression", type=str, nargs="+", default=compression_choices, choices=compression_choices, help="Codecs to test")
+parser.add_argument("-j", "--nThreads", type=int, nargs="+", default=[4, 8], help="Numbers of threads to test")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+rng = np.random.default_rng(1)
+logk = np.zeros([args.nBins, args.nProc, 2, args.nSyst], dtype="float64")
+nfilled = int(args.nSyst*(1.-args.sparsity))
+logk[..., :nfilled] = rng.normal(scale=1e-2, size=[args.nBins, args.nProc, 2, nfilled])
+# realistic values have a limited number of significant digits
+logk = np.round(logk, 6)
+size = logk.nbytes/1024**2
+logger.info(f"Tensor size: {size:.1f} MB")
+
+def run(compression, nthreads):
+    time0 = time.time()
+    with h5py.File(args.outfile, mode="w", rdcc_nbytes=args.chunkSize) as f:
+        writeFlatInChunks(logk, f, "hlogk", maxChunkBytes=args.chunkSize, compression=compression, nthreads=nthreads)
+    dt = time.time() - time0
+
+    with h5py.File(args.outfile, mode="r") as f:
+        if not np.array_equal(f["hlogk"][...], logk.reshape(-1)):
+            raise RuntimeError(f"Wrong content written with {compression} and {nthreads} threads")
+
+    logger.info(f"{compression.ljust(5)} threads {str(nthreads).ljust(2)}: {dt:.2f} s, {size/dt:.1f} MB/s, file size {os.path.getsize(args.outfile)/1024**2:.1f} MB")
+    return dt
+
+reference = run("gzip", 1)
+for compression in args.compression:
+    for nthreads in args.nThreads:
+        dt = run(compression, nthreads)
+        logger.info(f"Speedup with respect to serial gzip: {reference/dt:.2f}")
+
+os.remove(args.outfile)
@@ -0,0 +1,74 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+
+import hdf5plugin
+import h5py
+import hist
+import numpy as np
+import narf
+
+from utilities import logging
+from utilities.io_tools import input_tools
+
+parser = argparse.ArgumentParser(description="Compare open time and peak memory of the full and the lazy reader of histmaker outputs on a synthetic file")
+parser.add_argument("-o", "--outfile", type=str, default="/tmp/benchmark_hdf5_reader.hdf5", help="Synthetic input file (created if it does not exist)")
+parser.add_argument("--nProcs", type=int, default=20, help="Number of processes in the synthetic file")
+parser.add_argument("--nHists", type=int, default=50, help="Number of histograms per process")
+parser.add_argument("--nVars", type=int, default=100, help="Size of the tensor axis of each histogram")
+parser.add_argument("--recreate", action="store_true", help="Recreate the synthetic file")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+def make_file(fname):
+    axes = [
+        hist.axis.Regular(48, -2.4, 2.4, name="eta", flow=False),
+        hist.axis.Regular(30, 26, 56, name="pt", flow=False),
+        hist.axis.Regular(2, -2, 2, name="charge", flow=False),
+        hist.axis.Integer(0, args.nVars, name="vars", flow=False),
+    ]
+    rng = np.random.default_rng(1)
+    with h5py.File(fname, "w") as f:
+        for iproc in range(args.nProcs):
+            output = {}
+            for ihist in range(args.nHists):
+                h = hist.Hist(*axes, storage=hist.storage.Weight())
+                h.view()[...] = np.stack([rng.random(h.shape), rng.random(h.shape)], axis=-1)
+                output["nominal" if ihist == 0 else f"nominal_syst{ihist}"] = narf.ioutils.H5PickleProxy(h)
+            result = {"dataset" : {"name" : f"proc{iproc}", "xsec" : 1., "is_data" : False}, "weight_sum" : 1., "output" : output}
+            narf.ioutils.pickle_dump_h5py(f"proc{iproc}", result, f)
+            input_tools.write_hist_index(f[f"proc{iproc}"], output)
+        narf.ioutils.pickle_dump_h5py("meta_info", {"command" : "benchmark"}, f)
+
+def run_full(fname, queue):
+    time0 = time.time()
+    with h5py.File(fname, "r") as h5file:
+        results = input_tools.load_results_h5py(h5file)
+        topen = time.time() - time0
+        h = results["proc0"]["output"]["nominal"].get()
+    queue.put((topen, time.time() - time0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def run_lazy(fname, queue):
+    time0 = time.time()
+    with input_tools.ResultsReader(fname) as results:
+        topen = time.time() - time0
+        h = results.read_hist("proc0", "nominal")
+    queue.put((topen, time.time() - time0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+if args.recreate or not os.path.isfile(args.outfile):
+    logger.info(f"Creating synthetic file {args.outfile}")
+    make_file(args.outfile)
+logger.info(f"File size: {os.path.getsize(args.outfile)/1024**3:.2f} GB")
+
+# run each reader in a fresh process for a clean measurement of the peak memory
+ctx = multiprocessing.get_context("spawn")
+for name, func in [("full", run_full), ("lazy", run_lazy)]:
+    queue = ctx.Queue()
+    proc = ctx.Process(target=func, args=(args.outfile, queue))
+    proc.start()
+    topen, tread, maxrss = queue.get()
+    proc.join()
+    logger.info(f"{name.ljust(5)} reader: open {topen:.3f} s, open and read 'nominal' {tread:.3f} s, peak RSS {maxrss/1024:.1f} MB")
@@ -0,0 +1,77 @@
+import argparse
+import types
+
+import numpy as np
+
+from utilities import common, logging
+from utilities.rdf_tools import time_event_loop
+
+parser = argparse.ArgumentParser(description="Compare the throughput and the results of the recoil calibration evaluated with the model for each event and interpolated on a grid, on synthetic events")
+parser.add_argument("--nEvents", type=int, default=1000000, help="Number of synthetic events")
+parser.add_argument("--model", type=str, default=f"{common.data_dir}/recoil/highPU_DeepMETReso/model_mc_data.tflite", help="Recoil calibration model")
+parser.add_argument("--recoilUnc", action="store_true", help="Include the uncertainty weights")
+parser.add_argument("--ptGrid", type=float, nargs=3, default=[51, 0., 100.], help="Grid in pt as 'npoints min max'")
+parser.add_argument("--paraGrid", type=float, nargs=3, default=[101, -100., 100.], help="Grid in ut_para as 'npoints min max'")
+parser.add_argument("--perpGrid", type=float, nargs=3, default=[101, -100., 100.], help="Grid in ut_perp as 'npoints min max'")
+parser.add_argument("--maxDeviation", type=float, default=None, help="Accepted maximum deviation relative to the standard deviation of the values (default: recoil_tools.recoil_grid_tolerance)")
+parser.add_argument("--q99Deviation", type=float, default=None, help="Accepted 99%% quantile of the deviation relative to the standard deviation of the values (default: recoil_tools.recoil_grid_tolerance)")
+parser.add_argument("-j", "--nThreads", type=int, default=1, help="Number of threads (0 uses all available threads)")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+import ROOT
+ROOT.ROOT.EnableImplicitMT(max(0, args.nThreads))
+import narf
+import wremnants
+from wremnants import recoil_tools
+
+nthreads = max(1, ROOT.ROOT.GetThreadPoolSize())
+grid = lambda g: [int(g[0]), g[1], g[2]]
+
+helpers = {}
+for name, use_grid in [("model", False), ("grid", True)]:
+    helper_args = types.SimpleNamespace(recoilUnc=args.recoilUnc, recoilGrid=use_grid)
+    helpers[name], nstat = recoil_tools.RecoilCalibrationHelper(args.model, helper_args,
+        pt_grid=grid(args.ptGrid), para_grid=grid(args.paraGrid), perp_grid=grid(args.perpGrid))
+
+# boson pt falling steeply, recoil components around the typical resolution, with tails outside of the grid
+rng = np.random.default_rng(1)
+inputs = {
+    "pt": rng.exponential(10., size=args.nEvents),
+    "ut_para": rng.normal(0., 20., size=args.nEvents),
+    "ut_perp": rng.normal(0., 20., size=args.nEvents),
+}
+
+cols = ["ut_para_corr", "ut_perp_corr"] + (["unc_weights"] if args.recoilUnc else [])
+values = {}
+for name, helper in helpers.items():
+    df = ROOT.RDF.FromNumpy(inputs)
+    df = df.Define("recoil_corr", helper, ["pt", "ut_para", "ut_perp"])
+    df = df.Define("ut_para_corr", "recoil_corr.ut_para_corr(0)")
+    df = df.Define("ut_perp_corr", "recoil_corr.ut_perp_corr(0)")
+    df = df.Define("unc_weights", f"Eigen::TensorFixedSize<double, Eigen::Sizes<{nstat}>> w = recoil_corr.unc_weights; return ROOT::VecOps::RVec<double>(w.data(), w.data() + w.size());")
+    values[name], dt = time_event_loop(df, cols)
+    logger.info(f"{name.ljust(5)}: {dt:.2f} s, {args.nEvents/dt/nthreads:.0f} events/s per thread with {nthreads} threads")
+
+in_grid = np.ones(args.nEvents, dtype=bool)
+for k, g in [("pt", args.ptGrid), ("ut_para", args.paraGrid), ("ut_perp", args.perpGrid)]:
+    in_grid &= (inputs[k] >= g[1]) & (inputs[k] <= g[2])
+logger.info(f"Fraction of events inside the grid: {np.mean(in_grid):.4f}")
+
+tolerance = {
+    "max" : args.maxDeviation if args.maxDeviation is not None else recoil_tools.recoil_grid_tolerance["max"],
+    "q99" : args.q99Deviation if args.q99Deviation is not None else recoil_tools.recoil_grid_tolerance["q99"],
+}
+failed = []
+for k in cols:
+    ref = values["model"][k][in_grid]
+    diff = np.abs(values["grid"][k][in_grid] - ref)
+    scale = np.std(ref)
+    deviation = {"max" : np.max(diff)/scale, "q99" : np.quantile(diff, 0.99)/scale}
+    logger.info(f"{k}: max deviation {deviation['max']:.2e}, 99% quantile {deviation['q99']:.2e}, mean deviation {np.mean(diff)/scale:.2e} "
+        f"(relative to the standard deviation {scale:.3e} of the values, accepted {tolerance['max']:.0e} and {tolerance['q99']:.0e})")
+    failed.extend(f"{k} {q}" for q in tolerance if deviation[q] > tolerance[q])
+
+if failed:
+    raise RuntimeError(f"The grid interpolation exceeds the accepted deviation for {', '.join(failed)}")
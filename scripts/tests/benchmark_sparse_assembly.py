@@ -0,0 +1,107 @@
+import argparse
+import time
+import types
+
+import numpy as np
+
+from utilities import logging
+from wremnants.HDF5Writer import HDF5Writer
+
+parser = argparse.ArgumentParser(description="Compare the filling of the sparse arrays in HDF5Writer with pre-sized buffers against incremental resizing on synthetic channels")
+parser.add_argument("--nSysts", type=int, nargs="+", default=[1000, 10000, 50000], help="Numbers of systematics to test")
+parser.add_argument("--nChannels", type=int, default=2, help="Number of channels")
+parser.add_argument("--nBins", type=int, default=500, help="Number of bins per channel")
+parser.add_argument("--nProcs", type=int, default=3, help="Number of processes")
+parser.add_argument("--density", type=float, default=0.05, help="Fraction of nonzero bins of each systematic")
+parser.add_argument("-j", "--nThreads", type=int, default=1, help="Number of threads for the pre-sized filling")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+def make_writer(nsyst):
+    rng = np.random.default_rng(1)
+    writer = HDF5Writer(sparse=True, nthreads=args.nThreads)
+    writer.channels = {f"ch{i}" : types.SimpleNamespace(xnorm=False) for i in range(args.nChannels)}
+    writer.init_data_dicts()
+    procs = [f"proc{i}" for i in range(args.nProcs)]
+    systs = [f"syst{i}" for i in range(nsyst)]
+    nvals = max(1, int(args.density*args.nBins))
+    for chan in writer.get_channels():
+        writer.init_data_dicts_channel(chan, procs)
+        for proc in procs:
+            writer.dict_norm[chan][proc] = rng.random(args.nBins)
+            for isyst, syst in enumerate(systs):
+                indices = np.sort(rng.choice(args.nBins, nvals, replace=False))[:,None]
+                writer.dict_logkavg_indices[chan][proc][syst] = indices
+                writer.dict_logkavg_values[chan][proc][syst] = rng.normal(size=nvals)
+                if isyst % 2:
+                    writer.dict_logkhalfdiff_indices[chan][proc][syst] = indices
+                    writer.dict_logkhalfdiff_values[chan][proc][syst] = rng.normal(size=nvals)
+    return writer, procs, systs
+
+def fill_resize(writer, procs, systs, ibins, idxdtype):
+    # previous implementation, growing the arrays for each block
+    nsyst = len(systs)
+    norm_sparse_size = 0
+    norm_sparse_indices = np.zeros([norm_sparse_size,2],idxdtype)
+    norm_sparse_values = np.zeros([norm_sparse_size],writer.dtype)
+
+    logk_sparse_size = 0
+    logk_sparse_normindices = np.zeros([logk_sparse_size,1],idxdtype)
+    logk_sparse_systindices = np.zeros([logk_sparse_size,1],idxdtype)
+    logk_sparse_values = np.zeros([logk_sparse_size],writer.dtype)
+
+    ibin = 0
+    for nbinschan, chan in zip(ibins, writer.get_channels()):
+        for iproc, proc in enumerate(procs):
+            norm_proc = writer.dict_norm[chan][proc]
+            norm_indices = np.transpose(np.nonzero(norm_proc))
+            norm_values = np.reshape(norm_proc[norm_indices],[-1])
+
+            oldlength = norm_sparse_size
+            norm_sparse_size = oldlength + len(norm_values)
+            norm_sparse_indices.resize([norm_sparse_size,2])
+            norm_sparse_values.resize([norm_sparse_size])
+            norm_sparse_indices[oldlength:norm_sparse_size] = np.array([[ibin,iproc]]) + np.pad(norm_indices,((0,0),(0,1)),'constant')
+            norm_sparse_values[oldlength:norm_sparse_size] = norm_values
+            norm_idx_map = np.cumsum(np.not_equal(norm_proc, 0.)) - 1 + oldlength
+
+            for isyst, syst in enumerate(systs):
+                if syst not in writer.dict_logkavg_indices[chan][proc]:
+                    continue
+                for dict_indices, dict_values, isystidx in [
+                    (writer.dict_logkavg_indices, writer.dict_logkavg_values, isyst),
+                    (writer.dict_logkhalfdiff_indices, writer.dict_logkhalfdiff_values, nsyst + isyst),
+                ]:
+                    if syst not in dict_indices[chan][proc]:
+                        continue
+                    values = dict_values[chan][proc][syst]
+                    oldlength = logk_sparse_size
+                    logk_sparse_size = oldlength + len(values)
+                    logk_sparse_normindices.resize([logk_sparse_size,1])
+                    logk_sparse_systindices.resize([logk_sparse_size,1])
+                    logk_sparse_values.resize([logk_sparse_size])
+                    logk_sparse_normindices[oldlength:logk_sparse_size] = norm_idx_map[dict_indices[chan][proc][syst]]
+                    logk_sparse_systindices[oldlength:logk_sparse_size] = isystidx
+                    logk_sparse_values[oldlength:logk_sparse_size] = values
+        ibin += nbinschan
+
+    return norm_sparse_indices, norm_sparse_values, logk_sparse_normindices, logk_sparse_systindices, logk_sparse_values
+
+for nsyst in args.nSysts:
+    writer, procs, systs = make_writer(nsyst)
+    ibins = [args.nBins]*args.nChannels
+    idxdtype = writer.get_sparse_idxdtype(sum(ibins), len(procs), nsyst)
+
+    time0 = time.time()
+    res_resize = fill_resize(writer, procs, systs, ibins, idxdtype)
+    time_resize = time.time() - time0
+
+    time0 = time.time()
+    res_presized = writer.fill_sparse_arrays(procs, systs, ibins, idxdtype)
+    time_presized = time.time() - time0
+
+    if not all(np.array_equal(a, b) for a, b in zip(res_resize, res_presized)):
+        raise RuntimeError(f"Different sparse arrays for {nsyst} systematics")
+
+    logger.info(f"{str(nsyst).rjust(6)} systematics, {len(res_presized[-1])} logk entries: resize {time_resize:.2f} s, pre-sized {time_presized:.2f} s, speedup {time_resize/time_presized:.1f}")
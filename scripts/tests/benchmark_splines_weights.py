@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+
+from utilities import common, logging
+from utilities.rdf_tools import time_event_loop
+
+parser = argparse.ArgumentParser(description="Compare the muon response weights from the splines model evaluated for each muon with the interpolation on a grid, on synthetic muons")
+parser.add_argument("--nEvents", type=int, default=1000000, help="Number of synthetic events with two muons each")
+parser.add_argument("--resolution", type=float, default=0.02, help="Relative resolution of qop used to smear the generated muons")
+parser.add_argument("--ptGrid", type=float, nargs=3, default=[43, 16., 100.], help="Grid in genPt as 'npoints min max'")
+parser.add_argument("--etaGrid", type=float, nargs=3, default=[25, -2.4, 2.4], help="Grid in genEta as 'npoints min max'")
+parser.add_argument("--qoprGrid", type=float, nargs=3, default=[401, 0.8, 1.2], help="Grid in qoprec/qopgen as 'npoints min max'")
+parser.add_argument("--maxDeviation", type=float, default=None, help="Accepted maximum deviation relative to the standard deviation of the weights (default: muon_calibration.splines_weights_grid_tolerance)")
+parser.add_argument("--q99Deviation", type=float, default=None, help="Accepted 99%% quantile of the deviation relative to the standard deviation of the weights (default: muon_calibration.splines_weights_grid_tolerance)")
+parser.add_argument("-j", "--nThreads", type=int, default=0, help="Number of threads (0 uses all available threads)")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+import ROOT
+ROOT.ROOT.EnableImplicitMT(max(0, args.nThreads))
+import narf
+from wremnants import muon_calibration
+
+filename = common.calib_filepaths["tflite_file"]
+grid = lambda g: [int(g[0]), g[1], g[2]]
+
+helper_model = muon_calibration.make_splines_differential_weights_helper(filename)
+time0 = time.time()
+helper_grid = muon_calibration.make_splines_differential_weights_helper(filename, grid=True,
+    pt_grid=grid(args.ptGrid), eta_grid=grid(args.etaGrid), qopr_grid=grid(args.qoprGrid))
+logger.info(f"Grid computed in {time.time()-time0:.1f} s")
+
+rng = np.random.default_rng(1)
+gen_pt = rng.uniform(26., 56., size=[2, args.nEvents])
+gen_eta = rng.uniform(-2.4, 2.4, size=[2, args.nEvents])
+rec_pt = gen_pt/(1. + args.resolution*rng.normal(size=[2, args.nEvents]))
+inputs = {f"{name}{i}": arr[i] for name, arr in [("genPt", gen_pt), ("genEta", gen_eta), ("recPt", rec_pt)] for i in range(2)}
+
+cols = ["recPts", "recEtas", "recCharges", "genPts", "genEtas", "genCharges"]
+values = {}
+for name, helper in [("model", helper_model), ("grid", helper_grid)]:
+    df = ROOT.RDF.FromNumpy(inputs)
+    df = df.Define("genPts", "ROOT::VecOps::RVec<float>{float(genPt0), float(genPt1)}")
+    df = df.Define("genEtas", "ROOT::VecOps::RVec<float>{float(genEta0), float(genEta1)}")
+    df = df.Define("genCharges", "ROOT::VecOps::RVec<int>{1, -1}")
+    df = df.Define("recPts", "ROOT::VecOps::RVec<float>{float(recPt0), float(recPt1)}")
+    df = df.Alias("recEtas", "genEtas").Alias("recCharges", "genCharges")
+    df = df.Define("weights", helper, cols)
+    df = df.Define("dweightdscale", "ROOT::VecOps::Map(weights, [](const auto &w) { return w.first; })")
+    df = df.Define("dweightdsigmasq", "ROOT::VecOps::Map(weights, [](const auto &w) { return w.second; })")
+    values[name], dt = time_event_loop(df, ["dweightdscale", "dweightdsigmasq"])
+    logger.info(f"{name.ljust(5)}: {dt:.2f} s, {2*args.nEvents/dt/1e6:.2f} M muons/s")
+
+tolerance = {
+    "max" : args.maxDeviation if args.maxDeviation is not None else muon_calibration.splines_weights_grid_tolerance["max"],
+    "q99" : args.q99Deviation if args.q99Deviation is not None else muon_calibration.splines_weights_grid_tolerance["q99"],
+}
+failed = []
+for k in ["dweightdscale", "dweightdsigmasq"]:
+    ref = values["model"][k]
+    diff = np.abs(values["grid"][k] - ref)
+    scale = np.std(ref)
+    deviation = {"max" : np.max(diff)/scale, "q99" : np.quantile(diff, 0.99)/scale}
+    logger.info(f"{k}: max deviation {deviation['max']:.2e}, 99% quantile {deviation['q99']:.2e}, mean deviation {np.mean(diff)/scale:.2e} "
+        f"(relative to the standard deviation {scale:.3e} of the values, accepted {tolerance['max']:.0e} and {tolerance['q99']:.0e})")
+    failed.extend(f"{k} {q}" for q in tolerance if deviation[q] > tolerance[q])
+
+if failed:
+    raise RuntimeError(f"The grid interpolation exceeds the accepted deviation for {', '.join(failed)}")
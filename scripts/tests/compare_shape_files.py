@@ -0,0 +1,54 @@
+import argparse
+
+import numpy as np
+import uproot
+
+from utilities import logging
+
+parser = argparse.ArgumentParser(description="Compare the histograms of two root datacard shape files bin by bin (e.g. written by setupCombine.py with --rootWriter root and uproot)")
+parser.add_argument("reference", type=str, help="Reference shape file")
+parser.add_argument("target", type=str, help="Shape file to compare")
+parser.add_argument("--tolerance", type=float, default=0., help="Maximum absolute difference of the bin contents and errors")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+def shapes(filename):
+    # the histograms of the process directories, including the under/overflow bins
+    res = {}
+    with uproot.open(filename) as f:
+        for key, classname in f.classnames(recursive=True, cycle=False).items():
+            if not classname.startswith("TH"):
+                continue
+            h = f[key]
+            res[key] = (h.values(flow=True), h.errors(flow=True), [ax.edges(flow=False) for ax in h.axes])
+    return res
+
+ref = shapes(args.reference)
+target = shapes(args.target)
+
+missing = sorted(set(ref) - set(target))
+extra = sorted(set(target) - set(ref))
+for key in missing:
+    logger.error(f"Histogram {key} missing in {args.target}")
+for key in extra:
+    logger.error(f"Histogram {key} not in {args.reference}")
+
+max_diff = 0.
+nbad = 0
+for key in sorted(set(ref) & set(target)):
+    values, errors, edges = ref[key]
+    values_t, errors_t, edges_t = target[key]
+    if values.shape != values_t.shape or any(not np.array_equal(e, e_t) for e, e_t in zip(edges, edges_t)):
+        logger.error(f"Histogram {key} has different binning")
+        nbad += 1
+        continue
+    diff = max(np.max(np.abs(values - values_t), initial=0.), np.max(np.abs(errors - errors_t), initial=0.))
+    max_diff = max(max_diff, diff)
+    if diff > args.tolerance:
+        logger.error(f"Histogram {key} differs by {diff:.3e}")
+        nbad += 1
+
+logger.info(f"Compared {len(set(ref) & set(target))} histograms, max difference of contents and errors {max_diff:.3e}")
+if missing or extra or nbad:
+    raise RuntimeError(f"The shape files differ: {len(missing)} missing, {len(extra)} extra and {nbad} different histograms")
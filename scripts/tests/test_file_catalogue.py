@@ -0,0 +1,45 @@
+import argparse
+import os
+import tempfile
+
+from utilities import logging
+
+parser = argparse.ArgumentParser(description="Check the file catalogue of the datasets on a local directory tree, in place of a xrootd server")
+parser.add_argument("--nDirs", type=int, default=20, help="Number of dataset directories")
+parser.add_argument("--nFiles", type=int, default=50, help="Number of files per dataset directory, split in two subdirectories")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+from wremnants.datasets import dataset_tools
+
+def make_file(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("x")
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    paths = [f"{tmpdir}/dataset{i}" for i in range(args.nDirs)]
+    for path in paths:
+        for j in range(args.nFiles):
+            make_file(f"{path}/{j%2:04d}/file_{j}.root")
+        make_file(f"{path}/log.txt")
+
+    filename = f"{tmpdir}/catalogue.json"
+    catalogue = dataset_tools.FileCatalogue(filename)
+    catalogue.prefetch(paths + [f"{tmpdir}/missing"])
+    for path in paths:
+        assert catalogue.files(path) == dataset_tools.buildFileList(path), f"Wrong files for {path}"
+    assert catalogue.files(f"{tmpdir}/missing") == []
+
+    # a new file is only seen after the ttl or with refresh
+    make_file(f"{paths[0]}/0000/file_new.root")
+    catalogue = dataset_tools.FileCatalogue(filename)
+    assert len(catalogue.files(paths[0])) == args.nFiles, "The catalogue was not read from the file"
+    catalogue = dataset_tools.FileCatalogue(filename, ttl=0)
+    assert len(catalogue.files(paths[0])) == args.nFiles+1, "The catalogue was not listed again after the ttl"
+    catalogue = dataset_tools.FileCatalogue(filename, refresh=True)
+    assert len(catalogue.files(paths[0])) == args.nFiles+1, "The catalogue was not listed again with refresh"
+    assert all(f[1] == 1 for f in catalogue.listings[paths[0]]["files"]), "Wrong file sizes"
+
+logger.info("File catalogue checks passed")
@@ -0,0 +1,59 @@
+import argparse
+import importlib
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from utilities import logging
+
+parser = argparse.ArgumentParser(description="Build the precompiled dictionary of the wremnants/include headers declared at import "
+    "(and by the given modules) and compare the time of 'import wremnants' with and without it")
+parser.add_argument("--modules", type=str, nargs="*", default=[], help="Additional wremnants modules whose headers are compiled, e.g. wremnants.muon_validation wremnants.recoil_tools")
+parser.add_argument("--nRepeat", type=int, default=5, help="Number of imports timed with and without the cache")
+parser.add_argument("--noTiming", action="store_true", help="Only build the cache")
+parser.add_argument("--clean", action="store_true", help="Remove the existing cache instead of building it")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__)
+
+# the headers are parsed normally to find the ones which are declared
+os.environ["WREM_NO_INCLUDE_CACHE"] = "1"
+import wremnants
+from wremnants import include_cache
+
+if args.clean:
+    if os.path.isfile(include_cache.stamp_path()):
+        os.remove(include_cache.stamp_path())
+    logger.info(f"Removed the include cache stamp in {include_cache.cache_dir}")
+    sys.exit(0)
+
+for module in args.modules:
+    importlib.import_module(module)
+
+headers = list(include_cache.declared_headers)
+logger.info(f"Compiling {len(headers)} headers: {', '.join(headers)}")
+time0 = time.time()
+include_cache.build(headers)
+logger.info(f"Include cache built in {time.time()-time0:.1f} s")
+
+if args.noTiming:
+    sys.exit(0)
+
+def time_import(use_cache):
+    env = dict(os.environ)
+    if use_cache:
+        env.pop("WREM_NO_INCLUDE_CACHE", None)
+    times = []
+    for i in range(args.nRepeat):
+        time0 = time.time()
+        subprocess.run([sys.executable, "-c", "import wremnants"], env=env, check=True)
+        times.append(time.time() - time0)
+    return statistics.median(times)
+
+# one import to warm up the file system caches
+subprocess.run([sys.executable, "-c", "import wremnants"], check=True)
+time_nocache = time_import(False)
+time_cache = time_import(True)
+logger.info(f"'import wremnants' (median of {args.nRepeat}): {time_nocache:.2f} s without the include cache, {time_cache:.2f} s with the include cache")
@@ -1,6 +1,8 @@
 import argparse
 import h5py
 import copy
+import os
+import multiprocessing
 
 from utilities import logging
 from utilities.io_tools import input_tools
@@ -12,6 +14,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument("infiles", type=str, nargs="+", help="Input hdf5 files")
 parser.add_argument("-p", "--postfix", type=str, help="Postfix for output file name", default="merged")
 parser.add_argument("-o", "--outfolder", type=str, default="./", help="Output folder")
+parser.add_argument("--streaming", action="store_true",
+    help="Stream one histogram at a time from the inputs to the output, histograms with the same key in different files are summed (e.g. processes split by file range)")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes for the streaming merge")
 args = parser.parse_args()
 logger = logging.setup_logger(__file__)
 
@@ -25,30 +30,157 @@ def recursive_copy(res):
         return copy.deepcopy(res)
     elif type(res) == narf.ioutils.H5PickleProxy:
         # need to copy the underlying object, then make a proxy again for lazy reading of output file
-        return narf.ioutils.H5PickleProxy(res.get()) 
+        return narf.ioutils.H5PickleProxy(res.get())
     else:
         raise TypeError(f"Unknown type {type(res)} of object {res}")
 
-results = {}
-for i, infile in enumerate(args.infiles):
-    logger.info(f"Now at file {infile}")
-    h5file = h5py.File(infile, "r")
-    result = narf.ioutils.pickle_load_h5py(h5file["results"])
-
-    for key, value in result.items():
-        logger.info(f"Copying {key} ...")
-        if key in results.keys():
-            if key == "meta_info":
-                results[f"meta_info_{i}"] = copy.deepcopy(value)
-            else:
-                raise NotImplementedError(f"The object with key {key} from file {infile} was already present in a previous file; No implementation to solve this conflict")
+def sum_objects(proxies):
+    # sum the objects with the same key from several input files, only the running sum and one input are held in memory,
+    # the inputs are released from their proxies once they are added
+    res = None
+    for proxy in proxies:
+        obj = proxy.get() if isinstance(proxy, narf.ioutils.H5PickleProxy) else proxy
+        if res is None:
+            res = obj
         else:
-            results[key] = recursive_copy(value)
+            res += obj
+        if isinstance(proxy, narf.ioutils.H5PickleProxy):
+            proxy.release()
+    return res
+
+class SumProxy(narf.ioutils.H5PickleProxy):
+    # sums the objects with the same key from several input files only when it is written out,
+    # the sum is not kept, so only one summed histogram is held in memory at a time,
+    # stream_keys checks that the written histograms read back equal to the sum of the inputs
+    def __init__(self, proxies):
+        super().__init__(None)
+        self.proxies = proxies
+
+    def get(self):
+        return sum_objects(self.proxies)
+
+    def release(self):
+        pass
+
+def merge_results(key, results):
+    # merge the results of one process from different files, the histograms are only summed when they are written
+    merged = {k: v for k, v in results[0].items() if k != "output"}
+    if len(results) > 1:
+        if merged["dataset"].get("is_data", False):
+            merged["lumi"] = sum(r["lumi"] for r in results)
+        for k in ["weight_sum", "event_count"]:
+            if k in merged:
+                merged[k] = sum(r[k] for r in results)
+        merged["dataset"] = copy.deepcopy(merged["dataset"])
+        if "filepaths" in merged["dataset"]:
+            merged["dataset"]["filepaths"] = [f for r in results for f in r["dataset"]["filepaths"]]
+
+    merged["output"] = {}
+    for r in results:
+        for h_name, h in r["output"].items():
+            if h_name not in merged["output"]:
+                merged["output"][h_name] = []
+            merged["output"][h_name].append(h)
+
+    for h_name, proxies in merged["output"].items():
+        if len(proxies) != len(results):
+            logger.warning(f"Histogram {h_name} of {key} was found in {len(proxies)} out of {len(results)} files")
+        merged["output"][h_name] = SumProxy(proxies)
+
+    return merged
+
+def check_merged(key, h5group, results):
+    # round trip check of the first histogram of a process, the written one has to be equal to the sum of the inputs
+    written = narf.ioutils.pickle_load_h5py(h5group)["output"]
+    if not written:
+        return
+    h_name = next(iter(written))
+    h = written[h_name]
+    h = h.get() if isinstance(h, narf.ioutils.H5PickleProxy) else h
+    ref = sum_objects([r["output"][h_name] for r in results if h_name in r["output"]])
+    if h is None or not h == ref:
+        raise RuntimeError(f"Histogram {h_name} of {key} read back from the output differs from the sum of the inputs")
+
+def stream_keys(infiles, keys, outfile):
+    readers = [input_tools.ResultsReader(infile) for infile in infiles]
+    with h5py.File(outfile, "w") as fout:
+        for key in keys:
+            logger.info(f"Merging {key} ...")
+            sources = [r for r in readers if key in r]
+            merged = merge_results(key, [r[key] for r in sources])
+            narf.ioutils.pickle_dump_h5py(key, merged, fout)
+            check_merged(key, fout[key], [r[key] for r in sources])
+            input_tools.write_result_info(fout[key], merged)
+            # the index is the same for all inputs, copy it to avoid reading the histograms again
+            h5in = sources[0].h5file
+            if key in h5in and input_tools.hist_index_attr in h5in[key].attrs:
+                fout[key].attrs[input_tools.hist_index_attr] = h5in[key].attrs[input_tools.hist_index_attr]
+            del merged
+            for r in sources:
+                del r.results[key]
+    for r in readers:
+        r.close()
 
 outfile = args.infiles[0].split("/")[-1]
 if args.postfix:
     outfile = outfile.replace(".hdf5", f"_{args.postfix}.hdf5" if args.postfix else ".hdf5")
+outpath = f"{args.outfolder}/{outfile}"
+
+if args.streaming:
+    keys = []
+    meta_infos = []
+    for i, infile in enumerate(args.infiles):
+        with input_tools.ResultsReader(infile) as results:
+            for key in results.keys():
+                if key == "meta_info":
+                    meta_infos.append(results[key])
+                    continue
+                if key in keys:
+                    # histograms of previous files are already scaled, summing those would not give the correct normalization
+                    meta = results.get("meta_info", {})
+                    if not results[key]["dataset"].get("is_data", False) and not meta.get("args", {}).get("noScaleToData", False):
+                        raise RuntimeError(f"The object with key {key} from file {infile} was already present in a previous file; "
+                            "summing it requires the histograms to be produced with --noScaleToData")
+                    logger.info(f"The object with key {key} from file {infile} is summed with the previous ones")
+                else:
+                    keys.append(key)
+
+    logger.info(f"Writing merged results into output file {outpath}")
+    if args.jobs > 1 and len(keys) > 1:
+        # each worker writes its own file, the groups are then copied into the final output without unpickling
+        njobs = min(args.jobs, len(keys))
+        partfiles = [f"{outpath}.part{i}" for i in range(njobs)]
+        with multiprocessing.Pool(njobs) as pool:
+            pool.starmap(stream_keys, [(args.infiles, keys[i::njobs], partfile) for i, partfile in enumerate(partfiles)])
+        with h5py.File(outpath, "w") as fout:
+            for partfile in partfiles:
+                with h5py.File(partfile, "r") as fpart:
+                    for key in fpart.keys():
+                        fpart.copy(fpart[key], fout, name=key)
+                os.remove(partfile)
+    else:
+        stream_keys(args.infiles, keys, outpath)
+
+    with h5py.File(outpath, "a") as fout:
+        for i, meta_info in enumerate(meta_infos):
+            narf.ioutils.pickle_dump_h5py("meta_info" if i == 0 else f"meta_info_{i}", meta_info, fout)
+else:
+    results = {}
+    for i, infile in enumerate(args.infiles):
+        logger.info(f"Now at file {infile}")
+        h5file = h5py.File(infile, "r")
+        result = narf.ioutils.pickle_load_h5py(h5file["results"])
+
+        for key, value in result.items():
+            logger.info(f"Copying {key} ...")
+            if key in results.keys():
+                if key == "meta_info":
+                    results[f"meta_info_{i}"] = copy.deepcopy(value)
+                else:
+                    raise NotImplementedError(f"The object with key {key} from file {infile} was already present in a previous file; No implementation to solve this conflict")
+            else:
+                results[key] = recursive_copy(value)
 
-logger.info(f"Writing merged results into output file {args.outfolder}/{outfile}")
-with h5py.File(f"{args.outfolder}/{outfile}", 'w') as f:
-    narf.ioutils.pickle_dump_h5py("results", results, f)
\ No newline at end of file
+    logger.info(f"Writing merged results into output file {outpath}")
+    with h5py.File(outpath, 'w') as f:
+        narf.ioutils.pickle_dump_h5py("results", results, f)
@@ -644,3 +644,83 @@ def rssHist(h, syst_axis, scale=1.):
 
     return hUp, hDown
 
+
+def decorrelationRegions(axes, decorrByBinDict):
+    # name suffixes and inclusive ranges of bins of the first two axes (indices in the arrays with under/overflow bins)
+    # of the decorrelated variations, for each key of decorrByBinDict:
+    # "x" or "y": {"label" : "eta", "edges" : [...]} and "xy": {"label" : ["eta", "pt"], "edges" : [[...], [...]]}
+    # the bins are found as in ROOT with the edges moved inwards by a small constant, bin 0 being the underflow bin
+    def root_bin(axis, x):
+        return axis.index(x) + 1
+
+    def array_range(axis, low, high):
+        offset = 0 if axis.traits.underflow else -1
+        return max(low + offset, 0), min(high + offset, axis.extent - 1)
+
+    def edge_ranges(axis, edges):
+        return [array_range(axis, root_bin(axis, edges[i]+0.001), root_bin(axis, edges[i+1]-0.001)) for i in range(len(edges)-1)]
+
+    suffixes = []
+    ranges = []
+    for ax, decorrDict in decorrByBinDict.items():
+        label = decorrDict["label"]
+        if ax == "x":
+            full_y = [array_range(axes[1], 1, axes[1].size)] if len(axes) > 1 else [None]
+            for ix, range_x in enumerate(edge_ranges(axes[0], decorrDict["edges"])):
+                suffixes.append(f"_{label}{ix}")
+                ranges.append((range_x, full_y[0]))
+        elif ax == "y":
+            full_x = array_range(axes[0], 1, axes[0].size)
+            for iy, range_y in enumerate(edge_ranges(axes[1], decorrDict["edges"])):
+                suffixes.append(f"_{label}{iy}")
+                ranges.append((full_x, range_y))
+        elif ax == "xy":
+            ranges_x = edge_ranges(axes[0], decorrDict["edges"][0])
+            ranges_y = edge_ranges(axes[1], decorrDict["edges"][1])
+            for ix, range_x in enumerate(ranges_x):
+                for iy, range_y in enumerate(ranges_y):
+                    suffixes.append(f"_{label[0]}{ix}{label[1]}{iy}")
+                    ranges.append((range_x, range_y))
+        else:
+            raise ValueError(f"Invalid decorrelation {ax}, must be 'x', 'y' or 'xy'")
+    return suffixes, ranges
+
+def decorrelateByBinsArray(values, nominal, axes, decorrByBinDict):
+    # all decorrelated variations at once, each of them is the nominal except in the bins of its region where it is the variation,
+    # the region covers the bins without under/overflow of the other axes;
+    # values has shape [..., *axes] and nominal [*axes], both including the under/overflow bins,
+    # returns the name suffixes and the variations stacked along a new leading axis
+    suffixes, ranges = decorrelationRegions(axes, decorrByBinDict)
+    ndecorr = len(suffixes)
+    mask = np.ones([ndecorr] + [1]*len(axes), dtype=bool)
+    for i, axis in enumerate(axes):
+        idx = np.arange(axis.extent)
+        if i < 2 and ranges[0][i] is not None:
+            low, high = (np.array([r[i][j] for r in ranges])[:, np.newaxis] for j in range(2))
+            mask_axis = (idx >= low) & (idx <= high)
+        else:
+            offset = 1 if axis.traits.underflow else 0
+            mask_axis = ((idx >= offset) & (idx < offset + axis.size))[np.newaxis, :]
+        mask = mask & mask_axis.reshape([mask_axis.shape[0]] + [axis.extent if j == i else 1 for j in range(len(axes))])
+    # broadcast over the leading axes of the values
+    mask = mask.reshape([ndecorr] + [1]*(values.ndim - len(axes)) + list(mask.shape[1:]))
+    return suffixes, np.where(mask, values, nominal)
+
+def decorrelateByBins(hvar, hnom, decorrByBinDict):
+    # histogram version of decorrelateByBinsArray, returns the name suffixes and a histogram with the axes of the nominal one
+    # and the decorrelated variations along a new leading axis "decorr"
+    if hnom.axes.name != hvar.axes.name:
+        hnom = hnom.project(*hvar.axes.name)
+    suffixes, values = decorrelateByBinsArray(hvar.values(flow=True), hnom.values(flow=True), hnom.axes, decorrByBinDict)
+    hout = hist.Hist(hist.axis.Integer(0, len(suffixes), underflow=False, overflow=False, name="decorr"), *hnom.axes, storage=hnom.storage_type())
+    if hout.storage_type == hist.storage.Weight:
+        # the variances are the square of the errors as with the ROOT histograms, which are sqrt(|value|) without sumw2
+        if hvar.storage_type == hist.storage.Weight:
+            variances = np.square(np.sqrt(hvar.variances(flow=True)))
+        else:
+            variances = np.abs(hvar.values(flow=True))
+        _, variances = decorrelateByBinsArray(variances, hnom.variances(flow=True), hnom.axes, decorrByBinDict)
+        hout.view(flow=True)[...] = np.stack([values, variances], axis=-1)
+    else:
+        hout.view(flow=True)[...] = values
+    return suffixes, hout
@@ -0,0 +1,73 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+
+import lz4.frame
+
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+# folder of the cache, caching is disabled if None (currently only used for the post-processed theory correction histograms)
+cache_dir = None
+
+def set_cache_dir(path):
+    global cache_dir
+    cache_dir = path
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+def file_hash(path):
+    # content hash of a file, memoized by path, size and modification time to read large files only once
+    stat = os.stat(path)
+    index_file = f"{cache_dir}/file_hashes.json"
+    index = {}
+    if os.path.isfile(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+
+    key = f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    if key not in index:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(16*1024**2), b""):
+                digest.update(chunk)
+        index[key] = digest.hexdigest()
+        tmp = f"{index_file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, index_file)
+
+    return index[key]
+
+def cached(name, func, files=[], code=[], **inputs):
+    # returns func(), read from the cache if it was computed before for the same content of the input files,
+    # the same source code of the given functions or modules and the same (json serializable) inputs
+    if not cache_dir:
+        return func()
+
+    digest = hashlib.blake2b(digest_size=20)
+    for path in files:
+        digest.update(file_hash(path).encode())
+    for obj in code:
+        digest.update(inspect.getsource(obj).encode())
+    digest.update(json.dumps(inputs, sort_keys=True, default=str).encode())
+    path = f"{cache_dir}/{name}_{digest.hexdigest()}.pkl.lz4"
+
+    if os.path.isfile(path):
+        logger.debug(f"Read {name} from cache {path}")
+        with lz4.frame.open(path, "rb") as f:
+            return pickle.load(f)
+
+    time0 = time.time()
+    res = func()
+    # written with a temporary name to be safe against concurrent jobs
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with lz4.frame.open(tmp, "wb") as f:
+        pickle.dump(res, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    logger.debug(f"Computed {name} in {time.time() - time0:.2f} s and stored it in cache {path}")
+    return res
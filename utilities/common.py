@@ -123,12 +123,16 @@ def common_parser(for_reco_highPU=False):
     parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4],
                         help="Set verbosity level with logging, the larger the more verbose")
     parser.add_argument("--noColorLogger", action="store_true", help="Do not use logging with colors")
+    parser.add_argument("--helperCache", type=str, default=None, help="Folder to cache the post-processed theory correction histograms, they are reused if the correction files and the code are unchanged (only the reading and post-processing of the theory corrections is cached, their conversion to tensors and the other helpers are not)")
     initargs,_ = parser.parse_known_args()
 
     # initName for this internal logger is needed to avoid conflicts with the main logger named "wremnants" by default,
     # otherwise the logger is apparently propagated back to the root logger causing each following message to be printed twice 
     common_logger = logging.setup_logger(__file__, initargs.verbose, initargs.noColorLogger, initName="common_logger_wremnants")
     
+    from utilities import cache_tools
+    cache_tools.set_cache_dir(initargs.helperCache)
+
     import ROOT
     ROOT.ROOT.EnableImplicitMT(max(0,initargs.nThreads))
     import narf
@@ -168,14 +172,28 @@ def common_parser(for_reco_highPU=False):
     parser.add_argument("--noRecoil", action='store_true', help="Don't apply recoild correction")
     parser.add_argument("--recoilHists", action='store_true', help="Save all recoil related histograms for calibration and validation")
     parser.add_argument("--recoilUnc", action='store_true', help="Run the recoil calibration with uncertainties (slower)")
+    parser.add_argument("--recoilGrid", action='store_true', help="Evaluate the recoil calibration model once on a grid of (pt, ut_para, ut_perp) in 2 GeV steps up to 100 GeV and interpolate it instead of evaluating the model for each event, "
+        "the accepted deviation from the model is recoil_tools.recoil_grid_tolerance and is checked by scripts/tests/benchmark_recoil_helper.py")
     parser.add_argument("--highptscales", action='store_true', help="Apply highptscales option in MiNNLO for better description of data at high pT")
     parser.add_argument("--dataPath", type=str, default=None, help="Access samples from this path (default reads from local machine), for eos use 'root://eoscms.cern.ch//store/cmst3/group/wmass/w-mass-13TeV/NanoAOD/'")
+    parser.add_argument("--fileCatalogue", type=str, default=None, help="Json file to cache the list of input files found under the dataset paths, to be reused by the following jobs")
+    parser.add_argument("--fileCatalogueTTL", type=float, default=24, help="Time in hours after which the paths in the file catalogue are listed again")
+    parser.add_argument("--refreshFileCatalogue", action='store_true', help="List all paths again and update the file catalogue")
+    parser.add_argument("--countFileEntries", action='store_true', help="Open the input files to store their number of events in the file catalogue, it is used instead of the file size to balance the work")
+    parser.add_argument("--noBalanceFiles", action='store_true', help="Keep the input files in the order they are found instead of balancing their size between the shards and processing the largest files first")
     parser.add_argument("--noVertexWeight", action='store_true', help="Do not apply reweighting of vertex z distribution in MC to match data")
     parser.add_argument("--validationHists", action='store_true', help="make histograms used only for validations")
     parser.add_argument("--onlyMainHistograms", action='store_true', help="Only produce some histograms, skipping (most) systematics to run faster when those are not needed")
     parser.add_argument("--met", type=str, choices=["DeepMETReso", "RawPFMET"], help="MET (DeepMETReso or RawPFMET)", default="DeepMETReso")
     parser.add_argument("-o", "--outfolder", type=str, default="", help="Output folder")
     parser.add_argument("--appendOutputFile", type=str, default="", help="Append analysis output to specified output file")
+    parser.add_argument("--profileGraph", action='store_true', help="Measure the time spent in each column and filter of the graph, the balance of the tasks of the event loop and the size of the histograms, the report is written into the meta_info of the output file and into a json file")
+    parser.add_argument("--checkpoint", action='store_true', help="Run the datasets one after the other and write the results of each of them to a checkpoint file next to the output file as soon as it is done (the datasets are then no longer run together in a single event loop pass, which can be slower)")
+    parser.add_argument("--nShards", type=int, default=1, help="Split the input files of each dataset into this number of shards, run each shard in a separate process and merge the results")
+    parser.add_argument("--shard", type=int, default=None, help="Only run the given shard of the input files of each dataset and write the unprocessed results (used by --nShards)")
+    parser.add_argument("--shardJobs", type=int, default=None, help="Number of shards run in parallel (default: all)")
+    parser.add_argument("--shardCommand", type=str, default=None, help="Template to run the shards with a batch system, e.g. 'srun -N1 {command}', where {command} is replaced by the command of the shard and {shard} by its index, it has to return when the shard is done")
+    parser.add_argument("--resume", action='store_true', help="Read the results of the datasets from the checkpoint file if they were produced with the same code, options and input files, only run the missing ones (implies --checkpoint)")
     parser.add_argument("-e", "--era", type=str, choices=["2016PreVFP","2016PostVFP", "2017", "2018"], help="Data set to process", default="2016PostVFP")
     parser.add_argument("--nonClosureScheme", type=str, default = "A-only", choices=["none", "A-M-separated", "A-M-combined", "binned", "binned-plus-M", "A-only", "M-only"], help = "source of the Z non-closure nuisances")
     parser.add_argument("--correlatedNonClosureNP", action="store_false", help="disable the de-correlation of Z non-closure nuisance parameters after the jpsi massfit")
@@ -209,6 +227,7 @@ def common_parser(for_reco_highPU=False):
         parser.add_argument("--excludeFlow", action='store_true', help="Excludes underflow and overflow bins in main axes")
         parser.add_argument("--biasCalibration", type=str, default=None, choices=["binned","parameterized", "A", "M"], help="Adjust central value by calibration bias hist for simulation")
         parser.add_argument("--noSmearing", action='store_true', help="Disable resolution corrections")
+        parser.add_argument("--splinesWeightsGrid", action='store_true', help="Interpolate the muon response weights of the splines model on a grid computed once instead of evaluating the model for each muon (the accepted deviation from the model is muon_calibration.splines_weights_grid_tolerance, checked with scripts/tests/benchmark_splines_weights.py)")
         # options for efficiencies
         parser.add_argument("--trackerMuons", action='store_true', help="Use tracker muons instead of global muons (need appropriate scale factors too). This is obsolete")
         parser.add_argument("--binnedScaleFactors", action='store_true', help="Use binned scale factors (different helpers)")
@@ -216,6 +235,7 @@ def common_parser(for_reco_highPU=False):
         parser.add_argument("--isoEfficiencySmoothing", action='store_true', help="If isolation SF was derived from smooth efficiencies instead of direct smoothing") 
         parser.add_argument("--noScaleFactors", action="store_true", help="Don't use scale factors for efficiency (legacy option for tests)")
         parser.add_argument("--isolationDefinition", choices=["iso04vtxAgn", "iso04"], default="iso04vtxAgn",  help="Isolation type (and corresponding scale factors)")
+        parser.add_argument("--skimCache", type=str, default=None, help="Folder to store the events passing the preselection of each dataset, later runs with the same files, selection and muon corrections read the events from there")
 
     commonargs,_ = parser.parse_known_args()
 
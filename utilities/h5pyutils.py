@@ -1,40 +1,132 @@
 import numpy as np
 import math
+import time
+import zlib
+import struct
+import itertools
+import concurrent.futures
+import hdf5plugin
 
-def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2):    
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+compression_choices = ["gzip", "lz4", "zstd", "blosc"]
+
+def _lz4_compress(buf, blocksize=1024**3):
+    # format of the hdf5 lz4 filter (id 32004): 8 bytes original size, 4 bytes block size (big endian),
+    # then for each block 4 bytes compressed size followed by the data, incompressible blocks are stored as is
+    import lz4.block
+    out = [struct.pack(">qi", len(buf), blocksize)]
+    for start in range(0, len(buf), blocksize):
+        block = buf[start:start+blocksize]
+        cblock = lz4.block.compress(block, store_size=False)
+        if len(cblock) >= len(block):
+            cblock = bytes(block)
+        out.append(struct.pack(">i", len(cblock)))
+        out.append(cblock)
+    return b"".join(out)
+
+def get_chunk_compressor(compression="gzip", itemsize=8):
+    # returns the dataset options and a function compressing one chunk into the format expected by the hdf5 filter,
+    # or None for the compressor if the python bindings of the codec are not available
+    if compression == "gzip":
+        level = 4
+        return dict(compression="gzip", compression_opts=level), lambda buf: zlib.compress(buf, level)
+    elif compression == "lz4":
+        opts = dict(hdf5plugin.LZ4())
+        try:
+            import lz4.block
+        except ImportError:
+            return opts, None
+        return opts, _lz4_compress
+    elif compression == "zstd":
+        opts = dict(hdf5plugin.Zstd())
+        try:
+            import zstandard
+        except ImportError:
+            return opts, None
+        # the filter needs the original size in the frame header to decompress
+        return opts, lambda buf: zstandard.ZstdCompressor(write_content_size=True).compress(buf)
+    elif compression == "blosc":
+        opts = dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        try:
+            import blosc
+        except ImportError:
+            return opts, None
+        # the filter (id 32001) stores the blosc frame as it is
+        return opts, lambda buf: blosc.compress(buf, typesize=itemsize, clevel=5, shuffle=blosc.SHUFFLE, cname="lz4")
+    else:
+        raise ValueError(f"Unknown compression {compression}, choose one of {compression_choices}")
+
+def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2, compression = "gzip", nthreads = 1):
+    time0 = time.time()
     arrflat = arr.reshape(-1)
 
     esize = np.dtype(arrflat.dtype).itemsize
     nbytes = arrflat.size*esize
 
     #special handling for empty datasets, which should not use chunked storage or compression
+    compress = None
     if arrflat.size == 0:
         chunksize = 1
         chunks = None
-        compression = None
+        opts = {}
     else:
         chunksize = int(min(arrflat.size,max(1,math.floor(maxChunkBytes/esize))))
         chunks = (chunksize,)
-        compression = "gzip"
+        opts, compress = get_chunk_compressor(compression, esize)
+        if compress is None:
+            logger.warning(f"Python bindings for {compression} not found, falling back to serial compression in the hdf5 library")
 
-    h5dset = h5group.create_dataset(outname, arrflat.shape, chunks=chunks, dtype=arrflat.dtype, compression=compression)
+    h5dset = h5group.create_dataset(outname, arrflat.shape, chunks=chunks, dtype=arrflat.dtype, **opts)
 
-    #write in chunks, preserving sparsity if relevant
-    for ielem in range(0,arrflat.size,chunksize):
-        aout = arrflat[ielem:ielem+chunksize]
-        if np.count_nonzero(aout):
-            h5dset[ielem:ielem+chunksize] = aout
+    if compress is not None and nthreads > 1:
+        _writeChunksParallel(arrflat, h5dset, chunksize, compress, nthreads)
+    else:
+        #write in chunks, preserving sparsity if relevant
+        for ielem in range(0,arrflat.size,chunksize):
+            aout = arrflat[ielem:ielem+chunksize]
+            if np.count_nonzero(aout):
+                h5dset[ielem:ielem+chunksize] = aout
 
     h5dset.attrs['original_shape'] = np.array(arr.shape,dtype='int64')
 
+    dt = time.time() - time0
+    if nbytes > 0 and dt > 0:
+        logger.debug(f"Wrote {outname} ({nbytes/1024**2:.1f} MB) with {opts.get('compression', compression)} in {dt:.2f} s ({nbytes/1024**2/dt:.1f} MB/s)")
+
     return nbytes
 
-def writeSparse(indices, values, dense_shape, h5group, outname, maxChunkBytes = 1024**2):
+def _writeChunksParallel(arrflat, h5dset, chunksize, compress, nthreads):
+    # compress the chunks on a thread pool (the codecs release the GIL) and write the compressed buffers
+    # directly to the file, bypassing the filter pipeline, all-zero chunks are skipped to preserve sparsity
+    def compress_chunk(ielem):
+        aout = arrflat[ielem:ielem+chunksize]
+        if not np.count_nonzero(aout):
+            return None
+        if aout.size < chunksize:
+            # the last chunk has to be stored with the full chunk size
+            aout = np.concatenate([aout, np.zeros(chunksize-aout.size, dtype=aout.dtype)])
+        return compress(np.ascontiguousarray(aout).view(np.uint8).data)
+
+    offsets = iter(range(0, arrflat.size, chunksize))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+        # only a limited number of chunks is in flight to bound the memory usage
+        while True:
+            batch = list(itertools.islice(offsets, 4*nthreads))
+            if not batch:
+                break
+            for ielem, data in zip(batch, executor.map(compress_chunk, batch)):
+                if data is not None:
+                    h5dset.id.write_direct_chunk((ielem,), data)
+
+def writeSparse(indices, values, dense_shape, h5group, outname, maxChunkBytes = 1024**2, compression = "gzip", nthreads = 1):
     outgroup = h5group.create_group(outname)
 
     nbytes = 0
-    nbytes += writeFlatInChunks(indices, outgroup, "indices", maxChunkBytes)
-    nbytes += writeFlatInChunks(values, outgroup, "values", maxChunkBytes)
+    nbytes += writeFlatInChunks(indices, outgroup, "indices", maxChunkBytes, compression, nthreads)
+    nbytes += writeFlatInChunks(values, outgroup, "values", maxChunkBytes, compression, nthreads)
     outgroup.attrs['dense_shape'] = np.array(dense_shape, dtype='int64')
 
-    return nbytes
\ No newline at end of file
+    return nbytes
@@ -11,11 +11,147 @@ from narf import ioutils
 import ROOT
 import uproot
 import re
+import collections
+import collections.abc
 
 logger = logging.child_logger(__name__)
 
 scetlib_tnp_match_expr = ["^gamma_.*[+|-]\d+", "^b_.*[+|-]\d+", "^s[+|-]\d+", "^h_.*\d+"]
 
+# attribute of each process group in the histmaker output holding a json index of its histograms
+hist_index_attr = "hist_index"
+# attribute of each process group holding the dataset name, type and normalisation as json
+result_info_attr = "result_info"
+
+HistInfo = collections.namedtuple("HistInfo", ["process", "name", "axes", "storage", "nbytes"])
+
+def make_hist_index(output):
+    # lightweight description of the histograms of one process, stored next to the pickled results
+    index = {}
+    for name, h in output.items():
+        if isinstance(h, ioutils.H5PickleProxy):
+            h = h.get()
+        if not isinstance(h, hist.Hist):
+            continue
+        index[name] = {
+            "axes" : list(h.axes.name),
+            "storage" : h.storage_type.__name__,
+            "nbytes" : int(h.view(flow=True).nbytes),
+        }
+    return index
+
+def write_hist_index(h5group, output):
+    h5group.attrs[hist_index_attr] = json.dumps(make_hist_index(output))
+
+def make_result_info(result):
+    # the entries of the results of a process needed to make the datagroup members, None for other objects (e.g. meta_info)
+    if not isinstance(result, dict) or "dataset" not in result:
+        return None
+    return {
+        "dataset" : {k: result["dataset"].get(k, d) for k, d in [("name", None), ("xsec", None), ("is_data", False)]},
+        "weight_sum" : result.get("weight_sum"),
+        "lumi" : result.get("lumi", 0),
+    }
+
+def write_result_info(h5group, result):
+    info = make_result_info(result)
+    if info is not None:
+        h5group.attrs[result_info_attr] = json.dumps(info, default=float)
+
+class ResultsReader(collections.abc.Mapping):
+    # Read only view of the results of a histmaker hdf5 file.
+    # The entries of the results dictionary (one per process) are only unpickled when accessed 
+    # and histograms are only materialised by read_hist. The index of (process, name, axes, storage, nbytes)
+    # is built when opening from the attributes written by write_hist_index, 
+    # for files without them it is filled from the pickled results when a process is accessed.
+    def __init__(self, h5file):
+        self.close_file = isinstance(h5file, str)
+        self.h5file = h5py.File(h5file, "r") if self.close_file else h5file
+        self.results = {}
+
+        if "results" in self.h5file.keys():
+            # all results stored in a single pickle, nothing to gain from lazy reading
+            self.results = ioutils.pickle_load_h5py(self.h5file["results"])
+            self.keys_ = list(self.results.keys())
+        else:
+            self.keys_ = list(self.h5file.keys())
+
+        self.index = {}
+        for key in self.keys_:
+            if key not in self.h5file or hist_index_attr not in self.h5file[key].attrs:
+                continue
+            self.index[key] = {name : HistInfo(key, name, tuple(info["axes"]), info["storage"], info["nbytes"]) 
+                for name, info in json.loads(self.h5file[key].attrs[hist_index_attr]).items()}
+
+        self.infos = {}
+        for key in self.keys_:
+            if key in self.h5file and result_info_attr in self.h5file[key].attrs:
+                self.infos[key] = json.loads(self.h5file[key].attrs[result_info_attr])
+
+    def __getitem__(self, key):
+        if key not in self.results:
+            if key not in self.keys_:
+                raise KeyError(key)
+            logger.debug(f"Unpickle results for {key}")
+            self.results[key] = ioutils.pickle_load_h5py(self.h5file[key])
+        return self.results[key]
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.close_file:
+            self.h5file.close()
+
+    def hist_index(self, proc):
+        if proc not in self.keys_:
+            raise ValueError(f"Invalid process {proc}! No output found in file {self.h5file.filename}")
+        if proc not in self.index:
+            # no index stored in the file, only the names are known without reading the histograms
+            self.index[proc] = {name : HistInfo(proc, name, None, None, None) for name in self[proc]["output"].keys()}
+        return self.index[proc]
+
+    def result_info(self, key):
+        # dataset name, type and normalisation of a process, only unpickled for files without the attribute
+        if key not in self.infos:
+            self.infos[key] = make_result_info(self[key])
+        return self.infos[key]
+
+    def result_infos(self):
+        infos = {key: self.result_info(key) for key in self.keys_}
+        return {k: v for k, v in infos.items() if v is not None}
+
+    def hist_names(self, proc):
+        return self.hist_index(proc).keys()
+
+    def hist_info(self, proc, histname):
+        index = self.hist_index(proc)
+        if histname not in index:
+            raise ValueError(f"Histogram {histname} not found for process {proc}")
+        return index[histname]
+
+    def read_hist(self, proc, histname):
+        self.hist_info(proc, histname)
+        h = self[proc]["output"][histname]
+        if isinstance(h, ioutils.H5PickleProxy):
+            h = h.get()
+        return h
+
+    def release(self, proc, histname):
+        # remove a histogram that is loaded into memory from the proxy object
+        h = self[proc]["output"].get(histname) if proc in self.results else None
+        if isinstance(h, ioutils.H5PickleProxy):
+            h.release()
+
 def load_results_h5py(h5file):
     if "results" in h5file.keys():
         return ioutils.pickle_load_h5py(h5file["results"])
@@ -29,35 +165,30 @@ def read_and_scale_pkllz4(fname, proc, histname, calculate_lumi=False, scale=1):
     return load_and_scale(results, proc, histname, calculate_lumi, scale)
 
 def read_hist_names(fname, proc):
-    with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
-        if proc not in results:
-            raise ValueError(f"Invalid process {proc}! No output found in file {fname}")
-        return results[proc]["output"].keys()
+    with ResultsReader(fname) as results:
+        return list(results.hist_names(proc))
 
 def read_keys(fname):
-    with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
-        return results.keys()
+    with ResultsReader(fname) as results:
+        return list(results.keys())
 
 def read_xsec(fname, proc):
-    with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
+    with ResultsReader(fname) as results:
         return results[proc]["dataset"]["xsec"]
 
 def read_sumw(fname, proc):
-    with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
+    with ResultsReader(fname) as results:
         return results[proc]["weight_sum"]
 
 def read_and_scale(fname, proc, histname, calculate_lumi=False, scale=1, apply_xsec=True):
-    with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
-            
+    with ResultsReader(fname) as results:
         return load_and_scale(results, proc, histname, calculate_lumi, scale, apply_xsec)
 
 def load_and_scale(res_dict, proc, histname, calculate_lumi=False, scale=1., apply_xsec=True):
-    h = res_dict[proc]["output"][histname]
+    if isinstance(res_dict, ResultsReader):
+        h = res_dict.read_hist(proc, histname)
+    else:
+        h = res_dict[proc]["output"][histname]
     if isinstance(h, ioutils.H5PickleProxy):
         h = h.get()
     if not res_dict[proc]["dataset"]["is_data"]:
@@ -8,6 +8,7 @@ import h5py
 import narf
 import numpy as np
 from utilities import common, logging
+from utilities.io_tools import input_tools
 import glob
 import shutil
 import lz4.frame
@@ -49,9 +50,7 @@ def writeMetaInfoToRootFile(rtfile, exclude_diff='notebooks', args=None):
         out = ROOT.TNamed(str(key), str(value))
         out.Write()
 
-def write_analysis_output(results, outfile, args):
-    analysis_debug_output(results)
-
+def analysis_output_path(outfile, args):
     to_append = []
     if args.theoryCorr and not args.theoryCorrAltOnly:
         to_append.append(args.theoryCorr[0]+"Corr")
@@ -74,6 +73,14 @@ def write_analysis_output(results, outfile, args):
             os.makedirs(args.outfolder)
         outfile = os.path.join(args.outfolder, outfile)
 
+    return outfile
+
+def write_analysis_output(results, outfile, args, meta_info=None):
+    # meta_info: additional entries for the meta_info of the output file (e.g. the graph profile)
+    analysis_debug_output(results)
+
+    outfile = analysis_output_path(outfile, args)
+
     if args.appendOutputFile:
         outfile = args.appendOutputFile
         if os.path.isfile(outfile):
@@ -92,9 +99,16 @@ def write_analysis_output(results, outfile, args):
         for k, v in results.items():
             logger.debug(f"Pickle and dump {k}")
             narf.ioutils.pickle_dump_h5py(k, v, f)
+            if isinstance(v, dict) and "output" in v:
+                # index of the histograms to allow reading them without unpickling the full results
+                input_tools.write_hist_index(f[k], v["output"])
+                input_tools.write_result_info(f[k], v)
 
         if "meta_info" not in f.keys():
-            narf.ioutils.pickle_dump_h5py("meta_info", narf.ioutils.make_meta_info_dict(args=args, wd=common.base_dir), f)
+            meta_info_dict = narf.ioutils.make_meta_info_dict(args=args, wd=common.base_dir)
+            if meta_info:
+                meta_info_dict.update(meta_info)
+            narf.ioutils.pickle_dump_h5py("meta_info", meta_info_dict, f)
 
     logger.info(f"Writing output: {time.time()-time0}")
     logger.info(f"Output saved in {outfile}")
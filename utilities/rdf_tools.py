@@ -1,3 +1,7 @@
+import time
+
+import numpy as np
+
 '''
 INPUT -------------------------------------------------------------------------
 |* (str) sort_key: the name of the RDF column to be used as the key to sort cols_to_sort
@@ -28,3 +32,15 @@ def sort_rdf_cols(
     for col in cols_to_sort:
         df = df.Define(f"{col}{sorted_cols_suffix}", f"ROOT::VecOps::Take({col}, sort_idx_{sort_key})")
     return df
+
+def time_event_loop(df, cols, nrepeat=2):
+    # time of the event loop reading cols, run nrepeat times such that the first run jits the graph,
+    # the values are ordered by entry since the entries are not ordered with multiple threads, vector columns are stacked
+    df = df.Define("benchmark_entry", "rdfentry_")
+    for i in range(nrepeat):
+        time0 = time.perf_counter()
+        res = df.AsNumpy(["benchmark_entry", *cols])
+        dt = time.perf_counter() - time0
+    order = np.argsort(res["benchmark_entry"])
+    values = {k: (np.stack([np.asarray(v) for v in res[k]]) if res[k].dtype == object else res[k])[order] for k in cols}
+    return values, dt
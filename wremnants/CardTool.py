@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from wremnants import histselections as sel
+from wremnants import histselections as sel, combine_helpers
 from utilities import boostHistHelpers as hh, common, logging
 from utilities.io_tools import output_tools
 import narf
@@ -14,6 +14,7 @@ import re
 import hist
 import copy
 import math
+import concurrent.futures
 
 logger = logging.child_logger(__name__)
 
@@ -36,6 +37,13 @@ class CardTool(object):
     
         self.skipHist = False # don't produce/write histograms, file with them already exists
         self.outfile = None
+        self.rootWriter = "root" # "root" writes each histogram with ROOT, "uproot" converts them concurrently and writes them in batches
+        self.rootWriterThreads = 1
+        self.rootWriterBatchSize = 1000
+        self.uprootFile = None
+        self.uprootDirs = {}
+        self.uprootPool = None
+        self.pendingHists = []
         self.systematics = {}
         self.lnNSystematics = {}
         self.predictedProcs = []
@@ -503,10 +511,9 @@ class CardTool(object):
 
         return updated_skip
 
-    def systHists(self, hvar, syst):
-        if syst == self.nominalName:
-            return {self.nominalName : hvar}
-
+    def systEntries(self, hvar, syst):
+        # returns the histogram after the action of the systematic, the names of the syst axes and the bins of all variations,
+        # the output names of the variations are stored in systInfo["outNames"]
         systInfo = self.systematics[syst] 
         systAxes = systInfo["systAxes"]
         systAxesLabels = systInfo.get("labelsByAxis", systAxes)
@@ -514,7 +521,7 @@ class CardTool(object):
         # Jan: moved above the mirror action, as this action can cause mirroring
         if systInfo["action"]:
             hvar = systInfo["action"](hvar, **systInfo["actionArgs"])
-        if self.outfile:
+        if self.outfile and type(self.outfile) != str:
             self.outfile.cd() # needed to restore the current directory in case the action opens a new root file
 
         axNames = systAxes[:]
@@ -556,20 +563,82 @@ class CardTool(object):
             if not len(systInfo["outNames"]):
                 raise RuntimeError(f"Did not find any valid variations for syst {syst}")
 
-        variations = [hvar[{ax : binnum for ax,binnum in zip(axNames, entry)}] for entry in entries]
-        if hvar.axes[-1].name == "mirror" and len(variations) == 2*len(systInfo["outNames"]):
+        if hvar.axes[-1].name == "mirror" and len(entries) == 2*len(systInfo["outNames"]):
             systInfo["outNames"] = [n + d for n in systInfo["outNames"] for d in ["Up", "Down"]]
-        elif len(variations) != len(systInfo["outNames"]):
+        elif len(entries) != len(systInfo["outNames"]):
             logger.warning(f"The number of variations doesn't match the number of names for "
-                f"syst {syst}. Found {len(systInfo['outNames'])} names and {len(variations)} variations.")
+                f"syst {syst}. Found {len(systInfo['outNames'])} names and {len(entries)} variations.")
+
+        return hvar, axNames, entries
+
+    def systHists(self, hvar, syst):
+        if syst == self.nominalName:
+            return {self.nominalName : hvar}
+
+        hvar, axNames, entries = self.systEntries(hvar, syst)
+        variations = [hvar[{ax : binnum for ax,binnum in zip(axNames, entry)}] for entry in entries]
 
-        return {name : var for name,var in zip(systInfo["outNames"], variations) if name}
+        return {name : var for name,var in zip(self.systematics[syst]["outNames"], variations) if name}
+
+    def systHistsArray(self, hvar, syst, axes=None, flow=False):
+        # batched version of systHists without a histogram per variation,
+        # returns the ordered list of names and the values of all variations as one array with shape [nvar, *axes],
+        # all other axes (except the syst axes) are summed including their under/overflow bins
+        if syst == self.nominalName:
+            names = [self.nominalName]
+            axNames = []
+            entries = [()]
+        else:
+            hvar, axNames, entries = self.systEntries(hvar, syst)
+            names = self.systematics[syst]["outNames"]
+
+        if axes is None:
+            axes = [n for n in hvar.axes.name if n not in axNames]
+
+        # same selection as for the dictionary, a duplicated name takes the last variation
+        selected = {name : entry for name, entry in zip(names, entries) if name}
+
+        values = hvar.values(flow=True)
+        # sum over the axes that are neither syst nor output axes
+        sum_idxs = tuple(i for i, n in enumerate(hvar.axes.name) if n not in axNames and n not in axes)
+        if sum_idxs:
+            values = values.sum(axis=sum_idxs)
+        remaining = [n for n in hvar.axes.name if n in axNames or n in axes]
+
+        # syst axes to the front, then the output axes in the requested order
+        values = np.moveaxis(values, [remaining.index(n) for n in [*axNames, *axes]], range(len(axNames)+len(axes)))
+
+        def flow_index(axis, entry):
+            # index of a bin in the array including the flow bins
+            offset = 1 if axis.traits.underflow else 0
+            if entry is hist.underflow:
+                return 0
+            elif entry is hist.overflow:
+                return offset + axis.size
+            elif isinstance(entry, str):
+                return offset + axis.index(entry)
+            return offset + entry
+
+        if axNames:
+            idxs = [[flow_index(hvar.axes[ax], entry[i]) for entry in selected.values()] for i, ax in enumerate(axNames)]
+            values = values[tuple(np.array(idx, dtype=np.int64) for idx in idxs)]
+        else:
+            values = values[np.newaxis, ...]
+
+        if not flow:
+            # drop the flow bins of the output axes
+            slices = []
+            for ax in axes:
+                axis = hvar.axes[ax]
+                offset = 1 if axis.traits.underflow else 0
+                slices.append(slice(offset, offset + axis.size))
+            values = values[(slice(None), *slices)]
+
+        return list(selected.keys()), np.ascontiguousarray(values)
 
     def getLogk(self, hvar, hnom, kfac=1., logkepsilon=math.log(1e-3)):
         # check if there is a sign flip between systematic and nominal
-        _logk = kfac*np.log(hvar.values()/hnom.values())
-        _logk_view = np.where(np.equal(np.sign(hnom.values()*hvar.values()),1), _logk, logkepsilon*np.ones_like(_logk))
-        return _logk_view
+        return combine_helpers.get_logk(hvar.values(), hnom.values(), kfac, logkepsilon)
 
     def symmetrize(self, var_map, hnom, symmetrize=None):
         if symmetrize is None:
@@ -592,34 +661,26 @@ class CardTool(object):
                 hvardown = var_map[vardown]
 
                 logkup = self.getLogk(hvarup, hnom)
-                logkdown = -self.getLogk(hvardown, hnom)
+                logkdown = self.getLogk(hvardown, hnom)
+                np.negative(logkdown, out=logkdown)
 
-                if symmetrize in ["conservative", "average"]:
-                    if symmetrize=="conservative":
-                        # symmetrize by largest magnitude of up and down variations
-                        logk = np.where(np.abs(logkup) > np.abs(logkdown), logkup, logkdown)
-                    elif symmetrize=="average":
-                        # symmetrize by average of up and down variations
-                        logk = 0.5*(logkup + logkdown)
+                logk, logkdiff = combine_helpers.symmetrize_logk(logkup, logkdown, symmetrize, out_avg=logkup)
+                logkup = None
+                logkdown = None
 
+                # the exponentials are computed in place in the logk arrays
+                if symmetrize in ["conservative", "average"]:
                     # reuse histograms to avoid copies
                     # up and down variations are explicitly produced in this case
-                    hvarup.values()[...] = hnom.values()*np.exp(logk)
-                    hvardown.values()[...] = hnom.values()*np.exp(-logk)
+                    np.multiply(hnom.values(), np.exp(logk), out=hvarup.values())
+                    np.exp(np.negative(logk, out=logk), out=logk)
+                    np.multiply(hnom.values(), logk, out=hvardown.values())
 
                     var_map_out[varup] = hvarup
                     var_map_out[vardown] = hvardown
 
                 elif symmetrize in ["linear", "quadratic"]:
-                    # "linear" corresponds to a piecewise linear dependence of logk on theta
-                    # while "quadratic" corresponds to a quadratic dependence and leads
-                    # to a large variance
-                    diff_fact = np.sqrt(3.) if symmetrize=="quadratic" else 1.
-
                     # split asymmetric variation into two symmetric variations
-                    logkavg = 0.5*(logkup + logkdown)
-                    logkdiff =  0.5*diff_fact*(logkup - logkdown)
-
                     varavg = varbase + "SymAvg"
                     vardiff = varbase + "SymDiff"
 
@@ -630,11 +691,13 @@ class CardTool(object):
                     hvardiffup = hvarup.copy()
                     hvardiffdown = hvardown.copy()
 
-                    hvaravgup.values()[...] = hnom.values()*np.exp(logkavg)
-                    hvaravgdown.values()[...] = hnom.values()*np.exp(-logkavg)
+                    np.multiply(hnom.values(), np.exp(logk), out=hvaravgup.values())
+                    np.exp(np.negative(logk, out=logk), out=logk)
+                    np.multiply(hnom.values(), logk, out=hvaravgdown.values())
 
-                    hvardiffup.values()[...] = hnom.values()*np.exp(logkdiff)
-                    hvardiffdown.values()[...] = hnom.values()*np.exp(-logkdiff)
+                    np.multiply(hnom.values(), np.exp(logkdiff), out=hvardiffup.values())
+                    np.exp(np.negative(logkdiff, out=logkdiff), out=logkdiff)
+                    np.multiply(hnom.values(), logkdiff, out=hvardiffdown.values())
 
                     varavgup = varavg + "Up"
                     varavgdown = varavg + "Down"
@@ -723,8 +786,6 @@ class CardTool(object):
             #logger.error(f"systNames = {systNames}")
 
     def makeDecorrelatedSystHistograms(self, h, hnomi, name, decorrByBinDict):
-        # s = hist.tag.Slicer()
-        # TODO: using an alternative version using boost directly may be faster, but for now this is just for testing
         # decorrByBinDict is a dictionary as
         # decorrByBinDict = {"x": {"label" : "eta",
         #                          "edges" : [round(-2.4+i*0.4,1) for i in range(13)],}
@@ -733,58 +794,32 @@ class CardTool(object):
         # decorrByBinDict = {"xy": {"label" : ["eta", "pt"],
         #                          "edges" : [ [etaEdges], [ptEdges] ]}
         #                   }
+        # all variations are made at once along a new axis, see hh.decorrelateByBins
         # TODO: could also do charge decorrelation by using the z axis if present
-        ret = {}
-        hnomiroot = narf.hist_to_root(hnomi)
-        hsystroot = narf.hist_to_root(h)
-        for ax in decorrByBinDict.keys():
-            decorrDict = decorrByBinDict[ax]
-            decorrSystLabel = decorrDict["label"]
-            logger.info(f"Decorrelating syst {name} by {ax} bins using {decorrSystLabel}")
-            if ax != "xy":
-                for ibin in range(len(decorrDict["edges"]) -1):
-                    upDown = "Up" if name.endswith("Up") else "Down" if name.endswith("Down") else ""
-                    newname = name[:-len(upDown)] if len(upDown) else name[:]
-                    newname = f"{newname}_{decorrSystLabel}{ibin}{upDown}"
-                    logger.debug(f"Decorrelating syst {name} by {ax} bins: preparing new histogram {newname}")
-                    # FIXME: do not assume we can only have eta and pt axes (or eta-pt when implemented)
-                    # bin ID are retrieved adding some small constants to bin edges, low/high edge is increased/decreased
-                    if ax == "x":
-                        xbinLow = hnomiroot.GetXaxis().FindFixBin(decorrDict["edges"][ibin]+0.001)
-                        xbinHigh = hnomiroot.GetXaxis().FindFixBin(decorrDict["edges"][ibin+1]-0.001)
-                        ybinLow = 1
-                        ybinHigh = hnomiroot.GetNbinsY()
-                    elif ax == "y":
-                        xbinLow = 1
-                        xbinHigh = hnomiroot.GetNbinsX()
-                        ybinLow = hnomiroot.GetYaxis().FindFixBin(decorrDict["edges"][ibin]+0.001)
-                        ybinHigh = hnomiroot.GetYaxis().FindFixBin(decorrDict["edges"][ibin+1]-0.001)
-                    hsystrootDecorr = copy.deepcopy(hnomiroot.Clone(newname))
-                    ROOT.wrem.fillTH3fromTH3part(hsystrootDecorr, hsystroot,
-                                                 xbinLow, ybinLow, 1,
-                                                 xbinHigh, ybinHigh, hnomiroot.GetNbinsZ())
-                    ret[newname] = narf.root_to_hist(hsystrootDecorr, axis_names = hnomi.axes.name)
-            else:
-                edgesX = decorrDict["edges"][0]
-                edgesY = decorrDict["edges"][1]
-                for ix in range(len(edgesX)-1):
-                    for iy in range(len(edgesY)-1):
-                        xbinLow = hnomiroot.GetXaxis().FindFixBin(edgesX[ix]+0.001)
-                        xbinHigh = hnomiroot.GetXaxis().FindFixBin(edgesX[ix+1]-0.001)
-                        ybinLow = hnomiroot.GetYaxis().FindFixBin(edgesY[iy]+0.001)
-                        ybinHigh = hnomiroot.GetYaxis().FindFixBin(edgesY[iy+1]-0.001)
-                        upDown = "Up" if name.endswith("Up") else "Down" if name.endswith("Down") else ""
-                        newname = name[:-len(upDown)] if len(upDown) else name[:]
-                        newname = f"{newname}_{decorrSystLabel[0]}{ix}{decorrSystLabel[1]}{iy}{upDown}"
-                        logger.warning(f"Decorrelating syst {name} by {ax} bins: preparing new histogram {newname}")
-                        hsystrootDecorr = copy.deepcopy(hnomiroot.Clone(newname))
-                        ROOT.wrem.fillTH3fromTH3part(hsystrootDecorr, hsystroot,
-                                                     xbinLow, ybinLow, 1,
-                                                     xbinHigh, ybinHigh, hnomiroot.GetNbinsZ())
-                        ret[newname] = narf.root_to_hist(hsystrootDecorr, axis_names = hnomi.axes.name)
-        return ret
+        for ax, decorrDict in decorrByBinDict.items():
+            logger.info(f"Decorrelating syst {name} by {ax} bins using {decorrDict['label']}")
+        upDown = "Up" if name.endswith("Up") else "Down" if name.endswith("Down") else ""
+        basename = name[:-len(upDown)] if len(upDown) else name[:]
+        suffixes, hdecorr = hh.decorrelateByBins(h, hnomi, decorrByBinDict)
+        return {f"{basename}{suffix}{upDown}" : hdecorr[{"decorr" : i}] for i, suffix in enumerate(suffixes)}
+
+    def decorrelateSystArray(self, names, values, hnomi, axes, decorrByBinDict):
+        # decorrelated variations of the batched variations from systHistsArray with flow=True,
+        # returns the names and the values without under/overflow bins
+        hnomi = hnomi.project(*axes) if hnomi.axes.name != tuple(axes) else hnomi
+        suffixes, values = hh.decorrelateByBinsArray(values, hnomi.values(flow=True), hnomi.axes, decorrByBinDict)
+        slices = []
+        for axis in hnomi.axes:
+            offset = 1 if axis.traits.underflow else 0
+            slices.append(slice(offset, offset + axis.size))
+        values = values[(slice(None), slice(None), *slices)]
+        newnames = []
+        for suffix in suffixes:
+            for name in names:
+                upDown = "Up" if name.endswith("Up") else "Down" if name.endswith("Down") else ""
+                newnames.append(f"{name[:-len(upDown)] if len(upDown) else name}{suffix}{upDown}")
+        return newnames, np.ascontiguousarray(values.reshape(len(newnames), *values.shape[2:]))
 
-                
     def writeForProcess(self, h, proc, syst, check_systs=True):
         decorrelateByBin = {}
         hnom = None
@@ -896,10 +931,22 @@ class CardTool(object):
         if syst != self.nominalName:
             self.fillCardWithSyst(syst)
 
+    def setRootWriter(self, writer, nThreads=1, batchSize=1000):
+        if writer not in ["root", "uproot"]:
+            raise ValueError(f"Unknown root writer {writer}, options are 'root' and 'uproot'")
+        self.rootWriter = writer
+        self.rootWriterThreads = max(1, nThreads)
+        self.rootWriterBatchSize = batchSize
+
     def setOutfile(self, outfile):
         if type(outfile) == str:
             if self.skipHist:
                 self.outfile = outfile # only store name, file will not be used and doesn't need to be opened
+            elif self.rootWriter == "uproot":
+                self.outfile = outfile # the histograms are written through uproot, the file is only opened with ROOT at the end for the meta info
+                self.uprootFile = uproot.recreate(outfile)
+                self.uprootDirs = {}
+                self.uprootPool = concurrent.futures.ThreadPoolExecutor(max_workers=self.rootWriterThreads)
             else:
                 self.outfile = ROOT.TFile(outfile, "recreate")
                 self.outfile.cd()
@@ -919,44 +966,62 @@ class CardTool(object):
         self.setOutfile(os.path.abspath(f"{self.outfolder}/{basename}CombineInput{suffix}.root"))
             
     def writeOutput(self, args=None, forceNonzero=True, check_systs=True):
-        self.datagroups.loadHistsForDatagroups(
-            baseName=self.nominalName, syst=self.nominalName,
-            procsToRead=self.datagroups.groups.keys(),
-            label=self.nominalName, 
-            scaleToNewLumi=self.lumiScale, 
-            forceNonzero=forceNonzero,
-            sumFakesPartial=not self.ABCD)
-        
-        self.writeForProcesses(self.nominalName, processes=self.datagroups.groups.keys(), label=self.nominalName, check_systs=check_systs)
-        self.loadNominalCard()
-
-        if not self.real_data and not self.xnorm:
-            # If real data is not explicitly requested, use pseudodata instead (but still store read data in root writer)
-            self.setPseudodata([self.nominalName])
-        if self.pseudoData and not self.xnorm:
-            self.addPseudodata()
-
-        self.writeLnNSystematics()
-        for syst in self.systematics.keys():
-            if self.isExcludedNuisance(syst): continue
-            systMap = self.systematics[syst]
-            systName = syst if not systMap["name"] else systMap["name"]
-            processes = systMap["processes"]
-            # Needed to avoid always reading the variation for the fakes, even for procs not specified
-            forceToNominal=[x for x in self.datagroups.getProcNames() if x not in 
-                self.datagroups.getProcNames([p for g in processes for p in self.expandProcesses(g) if p != self.getFakeName()])]
+        uproot_output = self.uprootFile is not None
+        try:
             self.datagroups.loadHistsForDatagroups(
-                self.nominalName, systName, label="syst",
-                procsToRead=processes, 
-                forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
-                preOpMap=systMap["preOpMap"], preOpArgs=systMap["preOpArgs"], 
+                baseName=self.nominalName, syst=self.nominalName,
+                procsToRead=self.datagroups.groups.keys(),
+                label=self.nominalName, 
+                scaleToNewLumi=self.lumiScale, 
+                forceNonzero=forceNonzero,
+                sumFakesPartial=not self.ABCD)
+        
+            self.writeForProcesses(self.nominalName, processes=self.datagroups.groups.keys(), label=self.nominalName, check_systs=check_systs)
+            self.loadNominalCard()
+
+            if not self.real_data and not self.xnorm:
+                # If real data is not explicitly requested, use pseudodata instead (but still store read data in root writer)
+                self.setPseudodata([self.nominalName])
+            if self.pseudoData and not self.xnorm:
+                self.addPseudodata()
+
+            self.writeLnNSystematics()
+            systs = [syst for syst in self.systematics.keys() if not self.isExcludedNuisance(syst)]
+            systs_to_read = []
+            for syst in systs:
+                systMap = self.systematics[syst]
+                systName = syst if not systMap["name"] else systMap["name"]
+                processes = systMap["processes"]
+                # Needed to avoid always reading the variation for the fakes, even for procs not specified
+                forceToNominal=[x for x in self.datagroups.getProcNames() if x not in 
+                    self.datagroups.getProcNames([p for g in processes for p in self.expandProcesses(g) if p != self.getFakeName()])]
+                systs_to_read.append((systName, dict(
+                    procsToRead=processes, 
+                    forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
+                    preOpMap=systMap["preOpMap"], preOpArgs=systMap["preOpArgs"], 
+                    forceToNominal=forceToNominal,
+                )))
+            # the histograms are read one syst at a time, members that only need the nominal histogram are read once
+            loader = self.datagroups.loadHistsForDatagroupsMulti(
+                self.nominalName, systs_to_read, label="syst",
                 scaleToNewLumi=self.lumiScale,
-                forceToNominal=forceToNominal,
                 sumFakesPartial=not self.ABCD
             )
-            self.writeForProcesses(syst, label="syst", processes=processes, check_systs=check_systs)
-
-        output_tools.writeMetaInfoToRootFile(self.outfile, exclude_diff='notebooks', args=args)
+            for syst, systName in zip(systs, loader):
+                self.writeForProcesses(syst, label="syst", processes=self.systematics[syst]["processes"], check_systs=check_systs)
+            if uproot_output:
+                self.closeUprootFile()
+        finally:
+            if self.uprootFile is not None:
+                # only reached on an exception, the queued histograms are dropped and the threads and the file are closed
+                self.closeUprootFile(flush=False)
+
+        if uproot_output:
+            rtfile = ROOT.TFile(self.outfile, "update")
+            output_tools.writeMetaInfoToRootFile(rtfile, exclude_diff='notebooks', args=args)
+            rtfile.Close()
+        else:
+            output_tools.writeMetaInfoToRootFile(self.outfile, exclude_diff='notebooks', args=args)
         if self.skipHist:
             logger.info("Histograms will not be written because 'skipHist' flag is set to True")
         logger.info(f"Writing text/root cards to {self.outfile}")
@@ -1166,6 +1231,41 @@ class CardTool(object):
         hout = narf.hist_to_root(h)
         hout.SetName(f"{name}_{self.channels[0]}" if self.channels else name)
         hout.Write()
+
+    def toWritable(self, h, q=None):
+        return uproot.to_writable(h if q is None else self.getBoostHistByCharge(h, q))
+
+    def queueHist(self, h, proc, name):
+        # same histograms and names as writeHistByCharge and writeHistWithCharges,
+        # the conversion of each charge is done concurrently and the histograms are written in batches
+        if self.writeByCharge:
+            items = [(name.replace("CHANNEL",charge)+f"_{charge}", self.chargeIdDict[charge]["val"]) for charge in self.channels]
+        else:
+            items = [(f"{name}_{self.channels[0]}" if self.channels else name, None)]
+        for hname, q in items:
+            self.pendingHists.append((proc, hname, self.uprootPool.submit(self.toWritable, h, q)))
+        if len(self.pendingHists) >= self.rootWriterBatchSize:
+            self.flushHists()
+
+    def flushHists(self):
+        # one update per process directory, which is much faster than writing the histograms one by one
+        batches = {}
+        for proc, hname, future in self.pendingHists:
+            batches.setdefault(proc, {})[hname] = future.result()
+        for proc, hists in batches.items():
+            if proc not in self.uprootDirs:
+                self.uprootDirs[proc] = self.uprootFile.mkdir(proc)
+            self.uprootDirs[proc].update(hists)
+        self.pendingHists = []
+
+    def closeUprootFile(self, flush=True):
+        if flush:
+            self.flushHists()
+        else:
+            self.pendingHists = []
+        self.uprootPool.shutdown(cancel_futures=not flush)
+        self.uprootFile.close()
+        self.uprootFile = None
     
     def writeHist(self, h, proc, syst, setZeroStatUnc=False, decorrByBin={}, hnomi=None):
         if self.skipHist:
@@ -1200,16 +1300,21 @@ class CardTool(object):
         if setZeroStatUnc:
             h.variances(flow=True)[...] = 0.
 
-        # make sub directories for each process or return existing sub directory
-        directory = self.outfile.mkdir(proc, proc, True)
-        directory.cd()
-
         name = self.variationName(proc, syst)
 
         hists = {name: h} # always keep original variation in output file for checks
         if decorrByBin:
             hists.update(self.makeDecorrelatedSystHistograms(h, hnomi, syst, decorrByBin))
 
+        if self.uprootFile is not None:
+            for hname, histo in hists.items():
+                self.queueHist(histo, proc, hname)
+            return
+
+        # make sub directories for each process or return existing sub directory
+        directory = self.outfile.mkdir(proc, proc, True)
+        directory.cd()
+
         for hname, histo in hists.items():
             if self.writeByCharge:
                 self.writeHistByCharge(histo, hname)
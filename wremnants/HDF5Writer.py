@@ -1,3 +1,4 @@
+from wremnants import combine_helpers
 from wremnants.combine_helpers import projectABCD
 from utilities import boostHistHelpers as hh, common, logging
 from utilities.io_tools import output_tools, combinetf_input
@@ -10,20 +11,67 @@ from utilities.h5pyutils import writeFlatInChunks, writeSparse
 import math
 import pandas as pd
 import os
+import tempfile
+import concurrent.futures
 import narf
 import re
 from collections import defaultdict
 
 logger = logging.child_logger(__name__)
 
+class SparseBlockStore(object):
+    # append only store of the sparse logk blocks in temporary files on disk, the blocks are kept in the order they are booked
+    # and read back through memory maps such that only the part which is currently merged is held in memory
+    def __init__(self, dtype, tmpdir=None):
+        self.dtype = dtype
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="hdf5writer_", dir=tmpdir)
+        self.findices = open(f"{self.tmpdir.name}/indices.bin", "wb")
+        self.fvalues = open(f"{self.tmpdir.name}/values.bin", "wb")
+        self.blocks = {} # key -> (offset, size)
+        self.size = 0
+        self.indices = None
+        self.values = None
+
+    def add(self, key, indices, values):
+        # booking the same key again replaces the block, the old entries are left unused in the files
+        nvals = len(values)
+        if nvals:
+            self.findices.write(np.ascontiguousarray(indices, dtype="int64").tobytes())
+            self.fvalues.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+        self.blocks[key] = (self.size, nvals)
+        self.size += nvals
+
+    def finalize(self):
+        self.findices.close()
+        self.fvalues.close()
+        if self.size == 0:
+            self.indices = np.zeros([0], "int64")
+            self.values = np.zeros([0], self.dtype)
+        else:
+            self.indices = np.memmap(self.findices.name, dtype="int64", mode="r", shape=(self.size,))
+            self.values = np.memmap(self.fvalues.name, dtype=self.dtype, mode="r", shape=(self.size,))
+
+    def open_output(self, name, dtype, shape):
+        # output array of the merge, also on disk
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype)
+        return np.lib.format.open_memmap(f"{self.tmpdir.name}/{name}.npy", mode="w+", dtype=dtype, shape=shape)
+
+    def cleanup(self):
+        self.indices = None
+        self.values = None
+        self.tmpdir.cleanup()
+
 class HDF5Writer(object):
     # keeps multiple card tools and writes them out in a single file to fit (appending the histograms)
-    def __init__(self, card_name="card", sparse=False):
+    def __init__(self, card_name="card", sparse=False, compression="gzip", nthreads=1, out_of_core=False):
         self.cardName = card_name
         self.cardTools = []
         # settings for writing out hdf5 files
         self.dtype="float64"
         self.chunkSize=4*1024**2
+        self.compression=compression # codec of the chunked datasets
+        self.nthreads=nthreads # threads to compute the logk, fill the sparse arrays and compress chunks in parallel, 1 runs everything serially
         self.logkepsilon=math.log(1e-3) #numerical cutoff in case of zeros in systematic variations
 
         self.theoryFit = False
@@ -49,6 +97,8 @@ class HDF5Writer(object):
             self.clipSig = np.abs(np.log(clipSystVariationsSignal))
 
         self.sparse = sparse
+        self.outOfCore = out_of_core # keep the sparse blocks on disk instead of in memory
+        self.sparse_store = None
 
 
     def init_data_dicts(self):
@@ -59,6 +109,9 @@ class HDF5Writer(object):
         self.dict_sumw2 = {c : {} for c in channels}
         self.dict_norm = {c : {} for c in channels}
 
+        if self.sparse and self.outOfCore:
+            self.sparse_store = SparseBlockStore(self.dtype)
+
         if self.sparse:
             self.dict_logkavg_indices = {c : {} for c in channels}
             self.dict_logkavg_values = {c : {} for c in channels}
@@ -122,12 +175,15 @@ class HDF5Writer(object):
             bkgs.update([p for p in chanInfo.predictedProcesses() if p not in chanInfo.unconstrainedProcesses])      
         return list(common.natural_sort(bkgs))
 
+    def use_abcd_projection(self, chanInfo):
+        return chanInfo.ABCD and set(chanInfo.getFakerateAxes()) != set(chanInfo.fit_axes[:len(chanInfo.getFakerateAxes())])
+
     def get_flat_values(self, h, chanInfo, axes, return_variances=True):
         # check if variances are available
         if return_variances and (h.storage_type != hist.storage.Weight):
             raise RuntimeError(f"Sumw2 not filled for {h} but needed for binByBin uncertainties")
 
-        if chanInfo.ABCD and set(chanInfo.getFakerateAxes()) != set(chanInfo.fit_axes[:len(chanInfo.getFakerateAxes())]):
+        if self.use_abcd_projection(chanInfo):
             h = projectABCD(chanInfo, h, return_variances=return_variances)
         elif h.axes.name != axes:
             h = h.project(*axes)
@@ -282,6 +338,11 @@ class HDF5Writer(object):
 
                 self.dict_data_obs[chan] = data_obs
 
+            # the nominal histograms projected on the fit axes are kept for the systematics decorrelated by bins
+            hnoms_decorr = {}
+            if any(s["decorrByBin"] for s in chanInfo.systematics.values()) and not self.use_abcd_projection(chanInfo):
+                hnoms_decorr = {proc : dg.groups[proc].hists[chanInfo.nominalName].project(*axes) for proc in procs_chan}
+
             # free memory
             if dg.dataName in dg.groups:
                 del dg.groups[dg.dataName].hists[chanInfo.nominalName]
@@ -338,127 +399,70 @@ class HDF5Writer(object):
 
                 self.book_systematic(syst, var_name)
 
-            # shape systematics
-            for systKey, syst in chanInfo.systematics.items():
-                logger.info(f"Now in channel {chan} at shape systematic group {systKey}")
-
-                if chanInfo.isExcludedNuisance(systKey): 
-                    continue
-
-                # some channels (e.g. xnorm) don't have all processes affected by the systematic
-                procs_syst = [p for p in syst["processes"] if p in procs_chan]
-                if len(procs_syst) == 0:
-                    continue
+            # shape systematics, with more than one thread the logk of different systematics are computed concurrently
+            # while the histograms of the next ones are loaded
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads) if self.nthreads > 1 else None
+            try:
+                pending = []
+                shape_systs = []
+                for systKey, syst in chanInfo.systematics.items():
+                    if chanInfo.isExcludedNuisance(systKey): 
+                        continue
 
-                systName = systKey if not syst["name"] else syst["name"]
+                    # some channels (e.g. xnorm) don't have all processes affected by the systematic
+                    procs_syst = [p for p in syst["processes"] if p in procs_chan]
+                    if len(procs_syst) == 0:
+                        continue
 
-                # Needed to avoid always reading the variation for the fakes, even for procs not specified
-                forceToNominal=[x for x in dg.getProcNames() if x not in 
-                    dg.getProcNames([p for g in procs_syst for p in chanInfo.expandProcesses(g) if p != dg.fakeName])]
+                    systName = systKey if not syst["name"] else syst["name"]
 
-                dg.loadHistsForDatagroups(
-                    chanInfo.nominalName, systName, label="syst",
-                    procsToRead=procs_syst, 
-                    forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
-                    preOpMap=syst["preOpMap"], preOpArgs=syst["preOpArgs"], 
                     # Needed to avoid always reading the variation for the fakes, even for procs not specified
-                    forceToNominal=forceToNominal,
+                    forceToNominal=[x for x in dg.getProcNames() if x not in 
+                        dg.getProcNames([p for g in procs_syst for p in chanInfo.expandProcesses(g) if p != dg.fakeName])]
+
+                    shape_systs.append((systKey, syst, procs_syst, systName, dict(
+                        procsToRead=procs_syst, 
+                        forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
+                        preOpMap=syst["preOpMap"], preOpArgs=syst["preOpArgs"], 
+                        forceToNominal=forceToNominal,
+                    )))
+
+                # the histograms are read one syst at a time, members that only need the nominal histogram are read once
+                loader = dg.loadHistsForDatagroupsMulti(
+                    chanInfo.nominalName, [(x[3], x[4]) for x in shape_systs], label="syst",
                     scaleToNewLumi=chanInfo.lumiScale,
                     nominalIfMissing=not chanInfo.xnorm, # for masked channels not all systematics exist (we can skip loading nominal since Fake does not exist)
-                    sumFakesPartial=not chanInfo.ABCD
+                    sumFakesPartial=not chanInfo.ABCD,
+                    releaseAfter=False, # done below
                 )
+                for (systKey, syst, procs_syst, systName, options), _ in zip(shape_systs, loader):
+                    logger.info(f"Now in channel {chan} at shape systematic group {systKey}")
 
-                for proc in procs_syst:
-                    logger.debug(f"Now at proc {proc}!")
-
-                    hvar = dg.groups[proc].hists["syst"]
-
-                    if syst["decorrByBin"]:
-                        raise NotImplementedError("By bin decorrelation is not supported for writing output in hdf5")
-
-                    var_map = chanInfo.systHists(hvar, systKey)
-
-                    var_names = [x[:-2] if "Up" in x[-2:] else (x[:-4] if "Down" in x[-4:] else x) 
-                        for x in filter(lambda x: x != "", var_map.keys())]
-                    # Deduplicate while keeping order
-                    var_names = list(dict.fromkeys(var_names))
-                    norm_proc = self.dict_norm[chan][proc]
-
-                    for var_name in var_names:
-                        kfac=syst["scale"]
-
-                        def get_logk(histname, var_type=""):
-                            _hist = var_map[histname+var_type]
-
-                            _syst = self.get_flat_values(_hist, chanInfo, axes, return_variances=False)
-
-                            if not np.all(np.isfinite(_syst)):
-                                raise RuntimeError(f"{len(_syst)-sum(np.isfinite(_syst))} NaN or Inf values encountered in systematic {var_name}!")
-
-                            # check if there is a sign flip between systematic and nominal
-                            _logk = kfac*np.log(_syst/norm_proc)
-                            _logk_view = np.where(np.equal(np.sign(norm_proc*_syst),1), _logk, self.logkepsilon*np.ones_like(_logk))
-                            _syst = None
-
-                            if self.clipSystVariations>0.:
-                                _logk = np.clip(_logk,-self.clip,self.clip)
-                            if self.clipSystVariationsSignal>0. and proc in signals:
-                                _logk = np.clip(_logk,-self.clipSig,self.clipSig)
-
-                            return _logk_view
+                    hvars = {}
+                    for proc in procs_syst:
+                        if syst["decorrByBin"] and self.use_abcd_projection(chanInfo):
+                            raise NotImplementedError("By bin decorrelation is not supported for writing output in hdf5 with the ABCD projection")
+                        hvars[proc] = dg.groups[proc].hists["syst"]
+                        del dg.groups[proc].hists["syst"]
 
-                        var_name_out = var_name
+                    # release original histograms in the proxy objects
+                    dg.release_results(f"{chanInfo.nominalName}_{systName}")
 
-                        if syst["mirror"]:
-                            logkavg_proc = get_logk(var_name)
-                        elif syst["symmetrize"] is not None:
-                            logkup_proc = get_logk(var_name, "Up")
-                            logkdown_proc = -get_logk(var_name, "Down")
-
-                            if syst["symmetrize"] == "conservative":
-                                # symmetrize by largest magnitude of up and down variations
-                                logkavg_proc = np.where(np.abs(logkup_proc) > np.abs(logkdown_proc), logkup_proc, logkdown_proc)
-                            elif syst["symmetrize"] == "average":
-                                # symmetrize by average of up and down variations
-                                logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
-                            elif syst["symmetrize"] in ["linear", "quadratic"]:
-                                # "linear" corresponds to a piecewise linear dependence of logk on theta
-                                # while "quadratic" corresponds to a quadratic dependence and leads
-                                # to a large variance
-                                diff_fact = np.sqrt(3.) if syst["symmetrize"]=="quadratic" else 1.
-
-                                # split asymmetric variation into two symmetric variations
-                                logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
-                                logkdiffavg_proc = 0.5*diff_fact*(logkup_proc - logkdown_proc)
-
-                                var_name_out = var_name + "SymAvg"
-                                var_name_out_diff = var_name + "SymDiff"
-
-                                #special case, book the extra systematic
-                                self.book_logk_avg(logkdiffavg_proc, chan, proc, var_name_out_diff)
-                                self.book_systematic(syst, var_name_out_diff)
-                        else:
-                            logkup_proc = get_logk(var_name, "Up")
-                            logkdown_proc = -get_logk(var_name, "Down")
-
-                            logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
-                            logkhalfdiff_proc = 0.5*(logkup_proc - logkdown_proc)
-
-                            logkup_proc = None
-                            logkdown_proc = None
-
-                            self.book_logk_halfdiff(logkhalfdiff_proc, chan, proc, var_name_out)
-
-                        self.book_logk_avg(logkavg_proc, chan, proc, var_name_out)
-                        self.book_systematic(syst, var_name_out)
-
-                    # free memory
-                    for var in var_map.keys():
-                        var_map[var] = None
-                    del dg.groups[proc].hists["syst"]
-
-                # release original histograms in the proxy objects
-                dg.release_results(f"{chanInfo.nominalName}_{systName}")
+                    if executor is None:
+                        self.book_logk_syst(self.get_logk_syst(chan, chanInfo, systKey, syst, hvars, axes, signals, hnoms_decorr))
+                    else:
+                        pending.append(executor.submit(self.get_logk_syst, chan, chanInfo, systKey, syst, hvars, axes, signals, hnoms_decorr))
+                        # book in the original order and limit the number of systematics kept in memory
+                        while len(pending) > 2*self.nthreads:
+                            self.book_logk_syst(pending.pop(0).result())
+                    hvars = None
+
+                for future in pending:
+                    self.book_logk_syst(future.result())
+            finally:
+                if executor is not None:
+                    # the systematics not started yet are cancelled if one of them raised
+                    executor.shutdown(cancel_futures=True)
 
         procs = signals + bkgs
         nproc = len(procs)
@@ -493,131 +497,17 @@ class HDF5Writer(object):
         nbinsfull = sum(ibins)
 
         ibin = 0
-        if self.sparse:
+        if self.sparse and self.sparse_store is not None:
+            logger.info(f"Write out sparse array from the blocks stored on disk")
+            norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, logk_sparse_indices, logk_sparse_values, logk_sparse_dense_shape = self.merge_sparse_blocks(procs, systs, ibins)
+        elif self.sparse:
             logger.info(f"Write out sparse array")
 
-            idxdtype = 'int32'
-            maxsparseidx = max(nbinsfull*nproc,2*nsyst)
-            if maxsparseidx > np.iinfo(idxdtype).max:
-                logger.info("sparse array shapes are too large for index datatype, switching to int64")
-                idxdtype = 'int64'
-
-            norm_sparse_size = 0
-            norm_sparse_indices = np.zeros([norm_sparse_size,2],idxdtype)
-            norm_sparse_values = np.zeros([norm_sparse_size],self.dtype)
+            idxdtype = self.get_sparse_idxdtype(nbinsfull, nproc, nsyst)
 
-            logk_sparse_size = 0
-            logk_sparse_normindices = np.zeros([logk_sparse_size,1],idxdtype)
-            logk_sparse_systindices = np.zeros([logk_sparse_size,1],idxdtype)
-            logk_sparse_values = np.zeros([logk_sparse_size],self.dtype)
+            norm_sparse_indices, norm_sparse_values, logk_sparse_normindices, logk_sparse_systindices, logk_sparse_values = self.fill_sparse_arrays(procs, systs, ibins, idxdtype)
 
-            for nbinschan, chan in zip(ibins, self.get_channels()):
-                dict_norm_chan = self.dict_norm[chan]
-                dict_logkavg_chan_indices = self.dict_logkavg_indices[chan]
-                dict_logkavg_chan_values = self.dict_logkavg_values[chan]
-                dict_logkhalfdiff_chan_indices = self.dict_logkhalfdiff_indices[chan]
-                dict_logkhalfdiff_chan_values = self.dict_logkhalfdiff_values[chan]
-
-                for iproc, proc in enumerate(procs):
-                    if proc not in dict_norm_chan:
-                        continue
-                    norm_proc = dict_norm_chan[proc]
-
-                    norm_indices = np.transpose(np.nonzero(norm_proc))
-                    norm_values = np.reshape(norm_proc[norm_indices],[-1])
-                        
-                    nvals = len(norm_values)
-                    oldlength = norm_sparse_size
-                    norm_sparse_size = oldlength + nvals
-                    norm_sparse_indices.resize([norm_sparse_size,2])
-                    norm_sparse_values.resize([norm_sparse_size])
-                    
-                    out_indices = np.array([[ibin,iproc]]) + np.pad(norm_indices,((0,0),(0,1)),'constant')
-                    norm_indices = None
-                    
-                    norm_sparse_indices[oldlength:norm_sparse_size] = out_indices
-                    out_indices = None
-                    
-                    norm_sparse_values[oldlength:norm_sparse_size] = norm_values
-                    norm_values = None
-                    
-                    norm_idx_map = np.cumsum(np.not_equal(norm_proc, 0.)) - 1 + oldlength
-
-                    dict_logkavg_proc_indices = dict_logkavg_chan_indices[proc]
-                    dict_logkavg_proc_values = dict_logkavg_chan_values[proc]
-                    dict_logkhalfdiff_proc_indices = dict_logkhalfdiff_chan_indices[proc]
-                    dict_logkhalfdiff_proc_values = dict_logkhalfdiff_chan_values[proc]
-                    for isyst, syst in enumerate(systs):
-                        if syst not in dict_logkavg_proc_indices.keys():
-                            continue
-
-                        logkavg_proc_indices = dict_logkavg_proc_indices[syst]
-                        logkavg_proc_values = dict_logkavg_proc_values[syst]
-
-                        nvals_proc = len(logkavg_proc_values)
-                        oldlength = logk_sparse_size
-                        logk_sparse_size = oldlength + nvals_proc
-                        logk_sparse_normindices.resize([logk_sparse_size,1])
-                        logk_sparse_systindices.resize([logk_sparse_size,1])
-                        logk_sparse_values.resize([logk_sparse_size])
-
-                        #first dimension of output indices are NOT in the dense [nbin,nproc] space, but rather refer to indices in the norm_sparse vectors
-                        #second dimension is flattened in the [2,nsyst] space, where logkavg corresponds to [0,isyst] flattened to isyst
-                        #two dimensions are kept in separate arrays for now to reduce the number of copies needed later
-                        out_normindices = norm_idx_map[logkavg_proc_indices]
-                        logkavg_proc_indices = None
-                        
-                        logk_sparse_normindices[oldlength:logk_sparse_size] = out_normindices
-                        logk_sparse_systindices[oldlength:logk_sparse_size] = isyst
-                        out_normindices = None
-                        
-                        logk_sparse_values[oldlength:logk_sparse_size] = logkavg_proc_values
-                        logkavg_proc_values = None
-
-                        if syst in dict_logkhalfdiff_proc_indices:
-                            logkhalfdiff_proc_indices = dict_logkhalfdiff_proc_indices[syst]
-                            logkhalfdiff_proc_values = dict_logkhalfdiff_proc_values[syst]
-                            
-                            nvals_proc = len(logkhalfdiff_proc_values)
-                            oldlength = logk_sparse_size
-                            logk_sparse_size = oldlength + nvals_proc
-                            logk_sparse_normindices.resize([logk_sparse_size,1])
-                            logk_sparse_systindices.resize([logk_sparse_size,1])
-                            logk_sparse_values.resize([logk_sparse_size])
-                                    
-                            #out_indices = np.array([[ibin,iproc,isyst,1]]) + np.pad(logkhalfdiff_proc_indices,((0,0),(0,3)),'constant')
-                            #first dimension of output indices are NOT in the dense [nbin,nproc] space, but rather refer to indices in the norm_sparse vectors
-                            #second dimension is flattened in the [2,nsyst] space, where logkhalfdiff corresponds to [1,isyst] flattened to nsyst + isyst
-                            #two dimensions are kept in separate arrays for now to reduce the number of copies needed later
-                            out_normindices = norm_idx_map[logkhalfdiff_proc_indices]
-                            logkhalfdiff_proc_indices = None
-                            
-                            logk_sparse_normindices[oldlength:logk_sparse_size] = out_normindices
-                            logk_sparse_systindices[oldlength:logk_sparse_size] = nsyst + isyst
-                            out_normindices = None
-                            
-                            logk_sparse_values[oldlength:logk_sparse_size] = logkhalfdiff_proc_values
-                            logkhalfdiff_proc_values = None
-
-                    # free memory
-                    dict_logkavg_proc_indices = None
-                    dict_logkavg_proc_values = None
-                    dict_logkhalfdiff_proc_indices = None
-                    dict_logkhalfdiff_proc_values = None
-
-                # free memory
-                norm_proc = None
-                norm_idx_map = None
-
-                ibin += nbinschan
-            
-            logger.info(f"Resize and sort sparse arrays into canonical order")
-            #resize sparse arrays to actual length
-            norm_sparse_indices.resize([norm_sparse_size,2])
-            norm_sparse_values.resize([norm_sparse_size])
-            logk_sparse_normindices.resize([logk_sparse_size,1])
-            logk_sparse_systindices.resize([logk_sparse_size,1])
-            logk_sparse_values.resize([logk_sparse_size])
+            logger.info(f"Sort sparse arrays into canonical order")
             
             #straightforward sorting of norm_sparse into canonical order
             norm_sparse_dense_shape = (nbinsfull, nproc)
@@ -766,13 +656,13 @@ class HDF5Writer(object):
         nbytes = 0
 
         constraintweights = self.get_constraintweights(self.dtype)
-        nbytes += writeFlatInChunks(constraintweights, f, "hconstraintweights", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(constraintweights, f, "hconstraintweights", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
         constraintweights = None
 
-        nbytes += writeFlatInChunks(data_obs, f, "hdata_obs", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(data_obs, f, "hdata_obs", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
         data_obs = None
 
-        nbytes += writeFlatInChunks(pseudodata, f, "hpseudodata", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(pseudodata, f, "hpseudodata", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
         pseudodata = None
 
         if self.theoryFit:
@@ -780,40 +670,305 @@ class HDF5Writer(object):
             if data_cov.shape != (nbins,nbins):
                 raise RuntimeError(f"covariance matrix has incompatible shape of {data_cov.shape}, expected is {(nbins,nbins)}!")
             full_cov = np.add(data_cov,np.diag(sumw2)) if self.theoryFitMCStat else data_cov
-            nbytes += writeFlatInChunks(np.linalg.inv(full_cov), f, "hdata_cov_inv", maxChunkBytes = self.chunkSize)
+            nbytes += writeFlatInChunks(np.linalg.inv(full_cov), f, "hdata_cov_inv", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
             data_cov = None
             full_cov = None
 
-        nbytes += writeFlatInChunks(kstat, f, "hkstat", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(kstat, f, "hkstat", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
         kstat = None
 
         if self.sparse:
-            nbytes += writeSparse(norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, f, "hnorm_sparse", maxChunkBytes = self.chunkSize)
+            nbytes += writeSparse(norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, f, "hnorm_sparse", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
             norm_sparse_indices = None
             norm_sparse_values = None
-            nbytes += writeSparse(logk_sparse_indices, logk_sparse_values, logk_sparse_dense_shape, f, "hlogk_sparse", maxChunkBytes = self.chunkSize)
+            nbytes += writeSparse(logk_sparse_indices, logk_sparse_values, logk_sparse_dense_shape, f, "hlogk_sparse", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
             logk_sparse_indices = None
             logk_sparse_values = None
+            if self.sparse_store is not None:
+                self.sparse_store.cleanup()
+                self.sparse_store = None
         else:
-            nbytes += writeFlatInChunks(norm, f, "hnorm", maxChunkBytes = self.chunkSize)
+            nbytes += writeFlatInChunks(norm, f, "hnorm", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
             norm = None
-            nbytes += writeFlatInChunks(logk, f, "hlogk", maxChunkBytes = self.chunkSize)
+            nbytes += writeFlatInChunks(logk, f, "hlogk", maxChunkBytes = self.chunkSize, compression = self.compression, nthreads = self.nthreads)
             logk = None
 
         logger.info(f"Total raw bytes in arrays = {nbytes}")
 
 
+    def get_logk_syst(self, chan, chanInfo, systKey, syst, hvars, axes, signals, hnoms={}):
+        # compute the logk of all variations of a systematic for the given processes,
+        # returns the booking calls to be executed in order (which is done in the main thread)
+        bookings = []
+        for proc, hvar in hvars.items():
+            logger.debug(f"Now at proc {proc}!")
+
+            if self.use_abcd_projection(chanInfo):
+                var_map = chanInfo.systHists(hvar, systKey)
+            else:
+                # all variations in one array, without a histogram for each variation
+                if syst["decorrByBin"]:
+                    # only the decorrelated variations enter the fit, as in the datacard
+                    names, values = chanInfo.systHistsArray(hvar, systKey, axes, flow=True)
+                    names, values = chanInfo.decorrelateSystArray(names, values, hnoms[proc], axes, syst["decorrByBin"])
+                else:
+                    names, values = chanInfo.systHistsArray(hvar, systKey, axes)
+                values = values.reshape(len(names), -1)
+                var_map = {name : values[i] for i, name in enumerate(names)}
+                values = None
+
+            var_names = [x[:-2] if "Up" in x[-2:] else (x[:-4] if "Down" in x[-4:] else x) 
+                for x in filter(lambda x: x != "", var_map.keys())]
+            # Deduplicate while keeping order
+            var_names = list(dict.fromkeys(var_names))
+            norm_proc = self.dict_norm[chan][proc]
+
+            clip = 0.
+            if self.clipSystVariations>0.:
+                clip = self.clip
+            if self.clipSystVariationsSignal>0. and proc in signals:
+                clip = self.clipSig if clip == 0. else min(clip, self.clipSig)
+
+            for var_name in var_names:
+                kfac=syst["scale"]
+
+                def get_logk(histname, var_type=""):
+                    _var = var_map[histname+var_type]
+                    if isinstance(_var, np.ndarray):
+                        # each row is only used once and can be overwritten, a copy is only made for a different dtype
+                        _syst = _var.astype(self.dtype, copy=False)
+                    else:
+                        _syst = self.get_flat_values(_var, chanInfo, axes, return_variances=False)
+
+                    if not np.all(np.isfinite(_syst)):
+                        raise RuntimeError(f"{len(_syst)-sum(np.isfinite(_syst))} NaN or Inf values encountered in systematic {var_name}!")
+
+                    # the flat values are a copy, compute the logk in place
+                    return combine_helpers.get_logk(_syst, norm_proc, kfac, self.logkepsilon, clip=clip, out=_syst)
+
+                var_name_out = var_name
+
+                if syst["mirror"]:
+                    logkavg_proc = get_logk(var_name)
+                else:
+                    logkup_proc = get_logk(var_name, "Up")
+                    logkdown_proc = get_logk(var_name, "Down")
+                    np.negative(logkdown_proc, out=logkdown_proc)
+
+                    # the average is computed in place in the up variation
+                    logkavg_proc, logkdiff_proc = combine_helpers.symmetrize_logk(logkup_proc, logkdown_proc, syst["symmetrize"], out_avg=logkup_proc)
+                    logkup_proc = None
+                    logkdown_proc = None
+
+                    if syst["symmetrize"] in ["linear", "quadratic"]:
+                        # split asymmetric variation into two symmetric variations
+                        var_name_out = var_name + "SymAvg"
+                        var_name_out_diff = var_name + "SymDiff"
+
+                        #special case, book the extra systematic
+                        bookings.append((self.book_logk_avg, (logkdiff_proc, chan, proc, var_name_out_diff)))
+                        bookings.append((self.book_systematic, (syst, var_name_out_diff)))
+                    elif syst["symmetrize"] is None:
+                        bookings.append((self.book_logk_halfdiff, (logkdiff_proc, chan, proc, var_name_out)))
+
+                bookings.append((self.book_logk_avg, (logkavg_proc, chan, proc, var_name_out)))
+                bookings.append((self.book_systematic, (syst, var_name_out)))
+
+            # free memory
+            for var in var_map.keys():
+                var_map[var] = None
+            hvars[proc] = None
+
+        return bookings
+
+    def book_logk_syst(self, bookings):
+        for func, args in bookings:
+            func(*args)
+
+    def get_sparse_idxdtype(self, nbinsfull, nproc, nsyst):
+        idxdtype = 'int32'
+        maxsparseidx = max(nbinsfull*nproc,2*nsyst)
+        if maxsparseidx > np.iinfo(idxdtype).max:
+            logger.info("sparse array shapes are too large for index datatype, switching to int64")
+            idxdtype = 'int64'
+        return idxdtype
+
+    def fill_sparse_arrays(self, procs, systs, ibins, idxdtype):
+        # fill the sparse arrays in (channel, process, systematic) order with two passes,
+        # first the number of entries of each block is counted to allocate the arrays only once, then each block is copied into its slice
+        nsyst = len(systs)
+
+        units = []
+        norm_sparse_size = 0
+        logk_sparse_size = 0
+        ibin = 0
+        for nbinschan, chan in zip(ibins, self.get_channels()):
+            dict_norm_chan = self.dict_norm[chan]
+            for iproc, proc in enumerate(procs):
+                if proc not in dict_norm_chan:
+                    continue
+                norm_proc = dict_norm_chan[proc]
+
+                dict_logkavg_proc_indices = self.dict_logkavg_indices[chan][proc]
+                dict_logkavg_proc_values = self.dict_logkavg_values[chan][proc]
+                dict_logkhalfdiff_proc_indices = self.dict_logkhalfdiff_indices[chan][proc]
+                dict_logkhalfdiff_proc_values = self.dict_logkhalfdiff_values[chan][proc]
+
+                #second dimension of the logk indices is flattened in the [2,nsyst] space, where logkavg corresponds to [0,isyst] and logkhalfdiff to [1,isyst]
+                blocks = []
+                for isyst, syst in enumerate(systs):
+                    if syst not in dict_logkavg_proc_indices.keys():
+                        continue
+                    blocks.append((dict_logkavg_proc_indices[syst], dict_logkavg_proc_values[syst], isyst, logk_sparse_size))
+                    logk_sparse_size += len(dict_logkavg_proc_values[syst])
+                    if syst in dict_logkhalfdiff_proc_indices:
+                        blocks.append((dict_logkhalfdiff_proc_indices[syst], dict_logkhalfdiff_proc_values[syst], nsyst + isyst, logk_sparse_size))
+                        logk_sparse_size += len(dict_logkhalfdiff_proc_values[syst])
+
+                units.append((norm_proc, iproc, ibin, norm_sparse_size, blocks))
+                norm_sparse_size += np.count_nonzero(norm_proc)
+
+            ibin += nbinschan
+
+        norm_sparse_indices = np.empty([norm_sparse_size,2],idxdtype)
+        norm_sparse_values = np.empty([norm_sparse_size],self.dtype)
+        logk_sparse_normindices = np.empty([logk_sparse_size,1],idxdtype)
+        logk_sparse_systindices = np.empty([logk_sparse_size,1],idxdtype)
+        logk_sparse_values = np.empty([logk_sparse_size],self.dtype)
+
+        def fill_unit(unit):
+            norm_proc, iproc, ibin, norm_offset, blocks = unit
+
+            norm_indices = np.nonzero(norm_proc)[0]
+            nvals = len(norm_indices)
+            norm_sparse_indices[norm_offset:norm_offset+nvals, 0] = ibin + norm_indices
+            norm_sparse_indices[norm_offset:norm_offset+nvals, 1] = iproc
+            norm_sparse_values[norm_offset:norm_offset+nvals] = norm_proc[norm_indices]
+
+            #first dimension of the logk indices is NOT in the dense [nbin,nproc] space, but rather refers to indices in the norm_sparse vectors
+            #two dimensions are kept in separate arrays for now to reduce the number of copies needed later
+            norm_idx_map = np.cumsum(np.not_equal(norm_proc, 0.)) - 1 + norm_offset
+            for indices, values, isystidx, offset in blocks:
+                nvals = len(values)
+                logk_sparse_normindices[offset:offset+nvals] = norm_idx_map[indices]
+                logk_sparse_systindices[offset:offset+nvals] = isystidx
+                logk_sparse_values[offset:offset+nvals] = values
+
+        #the slices are disjoint, so the blocks can be filled concurrently
+        if self.nthreads > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+                for _ in executor.map(fill_unit, units):
+                    pass
+        else:
+            for unit in units:
+                fill_unit(unit)
+
+        return norm_sparse_indices, norm_sparse_values, logk_sparse_normindices, logk_sparse_systindices, logk_sparse_values
+
+    def merge_sparse_blocks(self, procs, systs, ibins):
+        # assemble the sparse tensors in canonical order from the blocks on disk,
+        # the logk blocks of each channel are merged in windows of bins such that only about one chunk is in memory at a time
+        store = self.sparse_store
+        store.finalize()
+
+        nproc = len(procs)
+        nsyst = len(systs)
+        nbinsfull = sum(ibins)
+        idxdtype = self.get_sparse_idxdtype(nbinsfull, nproc, nsyst)
+
+        #the normalization is small, the nonzero entries of the dense [nbins, nproc] array per channel are directly in canonical order
+        norm_sparse_indices = []
+        norm_sparse_values = []
+        norm_idx_maps = []
+        norm_sparse_size = 0
+        ibin = 0
+        for nbinschan, chan in zip(ibins, self.get_channels()):
+            norm_chan = np.zeros([nbinschan, nproc], self.dtype)
+            for iproc, proc in enumerate(procs):
+                if proc in self.dict_norm[chan]:
+                    norm_chan[:, iproc] = self.dict_norm[chan][proc]
+            nonzero = np.not_equal(norm_chan, 0.)
+            bin_indices, proc_indices = np.nonzero(nonzero)
+            norm_sparse_indices.append(np.stack([bin_indices + ibin, proc_indices], axis=-1).astype(idxdtype))
+            norm_sparse_values.append(norm_chan[nonzero])
+            #index of each (bin, proc) in the norm_sparse vectors
+            norm_idx_maps.append(np.reshape(np.cumsum(nonzero) - 1 + norm_sparse_size, nonzero.shape))
+            norm_sparse_size += len(bin_indices)
+            ibin += nbinschan
+
+        norm_sparse_indices = np.concatenate(norm_sparse_indices) if norm_sparse_indices else np.zeros([0,2], idxdtype)
+        norm_sparse_values = np.concatenate(norm_sparse_values) if norm_sparse_values else np.zeros([0], self.dtype)
+        norm_sparse_dense_shape = (nbinsfull, nproc)
+
+        #second dimension is flattened in the [2,nsyst] space, logkavg corresponds to [0,isyst] and logkhalfdiff to [1,isyst]
+        logk_sparse_dense_shape = (norm_sparse_size, 2*nsyst)
+        blocks_chans = []
+        for chan in self.get_channels():
+            blocks = []
+            for iproc, proc in enumerate(procs):
+                for isyst, syst in enumerate(systs):
+                    if (chan, proc, syst, 0) not in store.blocks:
+                        continue
+                    for ilogk in range(2):
+                        key = (chan, proc, syst, ilogk)
+                        if key in store.blocks and store.blocks[key][1] > 0:
+                            blocks.append((iproc, ilogk*nsyst + isyst, *store.blocks[key]))
+            blocks_chans.append(blocks)
+        nvals = sum(b[3] for blocks in blocks_chans for b in blocks)
+
+        logk_sparse_indices = store.open_output("logk_sparse_indices", idxdtype, (nvals, 2))
+        logk_sparse_values = store.open_output("logk_sparse_values", self.dtype, (nvals,))
+
+        maxwindow = max(1, self.chunkSize//np.dtype(self.dtype).itemsize)
+        logk_sparse_size = 0
+        for nbinschan, norm_idx_map, blocks in zip(ibins, norm_idx_maps, blocks_chans):
+            nvals_chan = sum(b[3] for b in blocks)
+            if nvals_chan == 0:
+                continue
+            binwindow = math.ceil(nbinschan/math.ceil(nvals_chan/maxwindow))
+
+            #the bin indices within each block are sorted, so the entries of each window are contiguous in the block
+            cursors = [0]*len(blocks)
+            for binlow in range(0, nbinschan, binwindow):
+                keys_window = []
+                values_window = []
+                for iblock, (iproc, isystidx, offset, nvals) in enumerate(blocks):
+                    start = offset + cursors[iblock]
+                    nwindow = np.searchsorted(store.indices[start:offset+nvals], binlow + binwindow)
+                    if nwindow == 0:
+                        continue
+                    bin_indices = np.asarray(store.indices[start:start+nwindow])
+                    keys_window.append(norm_idx_map[bin_indices, iproc]*(2*nsyst) + isystidx)
+                    values_window.append(np.asarray(store.values[start:start+nwindow]))
+                    cursors[iblock] += nwindow
+
+                if not keys_window:
+                    continue
+                keys_window = np.concatenate(keys_window)
+                sort_indices = np.argsort(keys_window)
+                keys_window = keys_window[sort_indices]
+                nwindow = len(keys_window)
+                logk_sparse_indices[logk_sparse_size:logk_sparse_size+nwindow, 0] = keys_window // (2*nsyst)
+                logk_sparse_indices[logk_sparse_size:logk_sparse_size+nwindow, 1] = keys_window % (2*nsyst)
+                logk_sparse_values[logk_sparse_size:logk_sparse_size+nwindow] = np.concatenate(values_window)[sort_indices]
+                logk_sparse_size += nwindow
+
+        return norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, logk_sparse_indices, logk_sparse_values, logk_sparse_dense_shape
+
     def book_logk_avg(self, *args):
-        self.book_logk(self.dict_logkavg, self.dict_logkavg_indices, self.dict_logkavg_values, *args)
+        self.book_logk(self.dict_logkavg, self.dict_logkavg_indices, self.dict_logkavg_values, *args, ilogk=0)
     
     def book_logk_halfdiff(self, *args):
-        self.book_logk(self.dict_logkhalfdiff, self.dict_logkhalfdiff_indices, self.dict_logkhalfdiff_values, *args)
+        self.book_logk(self.dict_logkhalfdiff, self.dict_logkhalfdiff_indices, self.dict_logkhalfdiff_values, *args, ilogk=1)
 
-    def book_logk(self, dict_logk, dict_logk_indices, dict_logk_values, logk, chan, proc, syst_name):
+    def book_logk(self, dict_logk, dict_logk_indices, dict_logk_values, logk, chan, proc, syst_name, ilogk=0):
         norm_proc = self.dict_norm[chan][proc]
         #ensure that systematic tensor is sparse where normalization matrix is sparse
         logk = np.where(np.equal(norm_proc,0.), 0., logk)
-        if self.sparse:
+        if self.sparse_store is not None:
+            indices = np.nonzero(logk)[0]
+            self.sparse_store.add((chan, proc, syst_name, ilogk), indices, logk[indices])
+        elif self.sparse:
             indices = np.transpose(np.nonzero(logk))
             dict_logk_indices[chan][proc][syst_name] = indices
             dict_logk_values[chan][proc][syst_name] = np.reshape(logk[indices],[-1])
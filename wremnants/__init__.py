@@ -4,13 +4,16 @@ import pathlib
 
 ROOT.gInterpreter.AddIncludePath(f"{pathlib.Path(__file__).parent}/include/")
 
-narf.clingutils.Declare('#include "muonCorr.h"')
-narf.clingutils.Declare('#include "histoScaling.h"')
-narf.clingutils.Declare('#include "histHelpers.h"')
-narf.clingutils.Declare('#include "utils.h"')
-narf.clingutils.Declare('#include "csVariables.h"')
-narf.clingutils.Declare('#include "EtaPtCorrelatedEfficiency.h"')
-narf.clingutils.Declare('#include "theoryTools.h"')
+from . import include_cache
+include_cache.load()
+
+include_cache.declare('#include "muonCorr.h"')
+include_cache.declare('#include "histoScaling.h"')
+include_cache.declare('#include "histHelpers.h"')
+include_cache.declare('#include "utils.h"')
+include_cache.declare('#include "csVariables.h"')
+include_cache.declare('#include "EtaPtCorrelatedEfficiency.h"')
+include_cache.declare('#include "theoryTools.h"')
 
 from .muon_prefiring import make_muon_prefiring_helpers
 from .muon_efficiencies_smooth import make_muon_efficiency_helpers_smooth
@@ -21,6 +24,7 @@ from .muon_efficiencies_binned_vqt_real import make_muon_efficiency_helpers_binn
 from .qcdScaleByHelicity_helper import makeQCDScaleByHelicityHelper
 from .pileup import make_pileup_helper
 from .vertex import make_vertex_helper
+from .experimental_weights import make_experimental_weight_helper
 from .syst_tools import scale_helicity_hist_to_variations
 from .theory_tools import scale_tensor_axes, define_prefsr_vars, moments_to_angular_coeffs
 from .muon_calibration import *
@@ -2,6 +2,7 @@ from utilities import common, logging
 from utilities.io_tools import input_tools
 
 import numpy as np
+import math
 
 logger = logging.child_logger(__name__)
 
@@ -126,3 +127,54 @@ def projectABCD(cardTool, h, return_variances=False, dtype="float64"):
     return flat, flat_variances
 
 
+
+def get_logk(syst, nom, kfac=1., logkepsilon=math.log(1e-3), clip=0., out=None):
+    # logk = kfac*log(syst/nom) computed in place in out (which can be syst itself to avoid any allocation)
+    # in case of a sign flip between systematic and nominal (or zeros) logkepsilon is used instead
+    if out is None:
+        out = np.empty(np.broadcast(syst, nom).shape, dtype=np.result_type(syst, nom, np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(syst, nom, out=out)
+        # only positive and finite ratios give a finite log
+        np.log(out, out=out)
+    if kfac != 1.:
+        np.multiply(out, kfac, out=out)
+    np.copyto(out, logkepsilon, where=~np.isfinite(out))
+    if clip > 0.:
+        np.clip(out, -clip, clip, out=out)
+    return out
+
+def symmetrize_logk(logkup, logkdown, symmetrize=None, out_avg=None, out_diff=None):
+    # combine the logk of the up and the (sign flipped) down variation into the average and the half difference,
+    # returns (logkavg, logkdiff) where logkdiff is
+    #   the half difference for asymmetric variations (symmetrize=None),
+    #   the logk of the additional symmetric variation for "linear" and "quadratic",
+    #   None for "conservative" and "average"
+    # out_avg can be one of the input arrays to work in place, out_diff must not share memory with the inputs
+    if symmetrize not in [None, "conservative", "average", "linear", "quadratic"]:
+        raise ValueError(f"Invalid option for 'symmetrize' {symmetrize}")
+
+    if out_avg is None:
+        out_avg = np.empty_like(logkup)
+
+    logkdiff = None
+    if symmetrize in [None, "linear", "quadratic"]:
+        # "linear" corresponds to a piecewise linear dependence of logk on theta
+        # while "quadratic" corresponds to a quadratic dependence and leads to a large variance
+        diff_fact = np.sqrt(3.) if symmetrize=="quadratic" else 1.
+        # computed first since out_avg may share the memory with one of the inputs
+        if out_diff is None:
+            out_diff = np.empty_like(logkup)
+        logkdiff = np.subtract(logkup, logkdown, out=out_diff)
+        np.multiply(logkdiff, 0.5*diff_fact, out=logkdiff)
+
+    if symmetrize == "conservative":
+        # symmetrize by largest magnitude of up and down variations
+        take_up = np.abs(logkup) > np.abs(logkdown)
+        np.copyto(out_avg, logkup, where=take_up)
+        np.copyto(out_avg, logkdown, where=~take_up)
+    else:
+        np.add(logkup, logkdown, out=out_avg)
+        np.multiply(out_avg, 0.5, out=out_avg)
+
+    return out_avg, logkdiff
@@ -1,7 +1,8 @@
 import narf
+from wremnants import include_cache
 import ROOT
 
-narf.clingutils.Declare('#include "theory_corrections.h"')
+include_cache.declare('#include "theory_corrections.h"')
 
 def makeCorrectionsTensor(corrh, tensor=None, tensor_rank=1, weighted_corr=False):
     hist_dims = len(corrh.axes)-tensor_rank 
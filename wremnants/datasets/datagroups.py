@@ -30,7 +30,7 @@ class Datagroups(object):
         elif infile.endswith(".hdf5"):
             logger.info("Load input file")
             self.h5file = h5py.File(infile, "r")
-            self.results = input_tools.load_results_h5py(self.h5file)
+            self.results = input_tools.ResultsReader(self.h5file)
         else:
             raise ValueError(f"{infile} has unsupported file type")
 
@@ -77,15 +77,21 @@ class Datagroups(object):
 
         make_datagroups(self, **kwargs)
 
-        self.lumi = sum([value.get("lumi", 0) for key, value in self.results.items()])
+        self.lumi = sum([value.get("lumi", 0) for value in self.result_infos().values() if value["dataset"].get("is_data", False)])
         if self.lumi > 0:
             logger.info(f"Integrated luminosity from data: {self.lumi}/fb")
         else:
             self.lumi = 1
             logger.warning(f"No data process was selected, normalizing MC to {self.lumi }/fb")
 
+    def result_infos(self):
+        # entries of the results with a dataset, for the lazy reader only the attributes stored next to the histograms are read
+        if isinstance(self.results, input_tools.ResultsReader):
+            return self.results.result_infos()
+        return {k: v for k, v in self.results.items() if type(v) == dict and "dataset" in v}
+
     def get_members_from_results(self, startswith=[], not_startswith=[], is_data=False):
-        dsets = {k: v for k, v in self.results.items() if type(v) == dict and "dataset" in v}
+        dsets = self.result_infos()
         if is_data:
             dsets = {k: v for k, v in dsets.items() if v["dataset"].get("is_data", False)}
         else:
@@ -210,10 +216,13 @@ class Datagroups(object):
 
     # remove a histogram that is loaded into memory from a proxy object 
     def release_results(self, histname):
-        for result in self.results.values():
-            if "output" not in result:
+        # only the members of the groups, the results of other processes are not unpickled from a lazy reader
+        procs = set(m.name for group in self.groups.values() for m in group.members)
+        for proc in procs:
+            if isinstance(self.results, input_tools.ResultsReader):
+                self.results.release(proc, histname)
                 continue
-            res = result["output"]
+            res = self.results.get(proc, {}).get("output", {})
             if histname in res:
                 res[histname].release()
 
@@ -235,37 +244,107 @@ class Datagroups(object):
         # this line is annoying for the theory agnostic, too many processes for signal
         logger.debug(f"In loadHistsForDatagroups(): for hist {syst} procsToRead = {procsToRead}")
 
+        plan = self.makeLoadPlan(procsToRead, excludeProcs, sumFakesPartial, scaleToNewLumi)
+        self.loadHistsFromPlan(plan, baseName, syst, label, nominalIfMissing=nominalIfMissing, applySelection=applySelection,
+            forceNonzero=forceNonzero, preOpMap=preOpMap, preOpArgs=preOpArgs, forceToNominal=forceToNominal)
+
+    def loadHistsForDatagroupsMulti(self, 
+        baseName, systs, procsToRead=None, label=None, nominalIfMissing=True, 
+        applySelection=True, forceNonzero=True, preOpMap=None, preOpArgs={}, 
+        scaleToNewLumi=1, excludeProcs=None, forceToNominal=[], sumFakesPartial=True,
+        releaseAfter=True,
+    ):
+        # generator version of loadHistsForDatagroups for a list of systematics, the groups are filled for one syst at a time 
+        #   and the syst name is yielded once group.hists[label] is available
+        # the list of members, scale factors and fake partial sum bookkeeping are only done once, 
+        #   and members that read the nominal histogram (e.g. with forceToNominal) are read and transformed only once for all systs
+        # elements of systs can be a syst name or a tuple (syst, options) where options is a dict overriding procsToRead,
+        #   nominalIfMissing, applySelection, forceNonzero, preOpMap, preOpArgs and forceToNominal for this syst
+        plans = {}
+        nominal_cache = {}
+        defaults = dict(procsToRead=procsToRead, nominalIfMissing=nominalIfMissing, applySelection=applySelection, forceNonzero=forceNonzero, 
+            preOpMap=preOpMap, preOpArgs=preOpArgs, forceToNominal=forceToNominal)
+        for syst in systs:
+            options = defaults.copy()
+            if isinstance(syst, tuple):
+                syst, syst_options = syst
+                options.update(syst_options)
+            procs = options.pop("procsToRead")
+            plan_key = tuple(procs) if procs else None
+            if plan_key not in plans:
+                plans[plan_key] = self.makeLoadPlan(procs, excludeProcs, sumFakesPartial, scaleToNewLumi)
+            plan = plans[plan_key]
+
+            syst_label = label if label else (syst if syst else baseName)
+            logger.debug(f"In loadHistsForDatagroupsMulti(): for hist {syst}")
+            self.loadHistsFromPlan(plan, baseName, syst, syst_label, nominal_cache=nominal_cache, **options)
+
+            yield syst
+
+            if releaseAfter:
+                # keep the memory bounded to the histograms of one syst
+                for group in plan["groups"].values():
+                    if syst_label in group.hists:
+                        del group.hists[syst_label]
+                self.release_results(self.histName(baseName, syst=syst))
+
+    def makeLoadPlan(self, procsToRead=None, excludeProcs=None, sumFakesPartial=True, scaleToNewLumi=1):
+        # everything needed to read the histograms of the groups that does not depend on the systematic
         if not procsToRead:
             if excludeProcs:
                 procsToRead = list(filter(lambda x: x not in excludeProcs, self.groups.keys()))
             else:
                 procsToRead = list(self.groups.keys())
 
-        foundExact = False
-
         # If fakes are present do them as last group, and when running on prompt group build the sum to be used for the fakes.
         # This makes the code faster and avoid possible bugs related to reading again the same processes
         # NOTE:
         # To speed up even more, one could directly use the per-group sum already computed for each group,
         # but this would need to assume that fakes effectively had all the single processes in each group as members
         # (usually it will be the case, but it is more difficult to handle in a fully general way and without bugs)
-        histForFake = None # to store the data-MC sums used for the fakes, for each syst
         if sumFakesPartial and self.fakeName in procsToRead:
             procsToReadSort = [x for x in procsToRead if x != self.fakeName] + [self.fakeName]
             hasFake = True
             fakesMembers = [m.name for m in self.groups[self.fakeName].members]
-            fakesMembersWithSyst = []
             logger.debug(f"Has fake members: {fakesMembers}")
         else:
             hasFake = False
+            fakesMembers = []
             procsToReadSort = [x for x in procsToRead]
         # Note: if 'hasFake' is kept as False (but Fake exists), the original behaviour for which Fake reads everything again is restored
-        for procName in procsToReadSort:
-            logger.debug(f"Reading group {procName}")
 
+        groups = {}
+        scales = {}
+        for procName in procsToReadSort:
             if procName not in self.groups.keys():
                 raise RuntimeError(f"Group {procName} not known. Defined groups are {list(self.groups.keys())}.")
             group = self.groups[procName]
+            groups[procName] = group
+            for i, member in enumerate(group.members):
+                scale = self.processScaleFactor(member)
+                scale *= scaleToNewLumi
+                if group.scale:
+                    scale *= group.scale(member)
+                scaleForFake = None
+                if hasFake and procName != self.fakeName and member.name in fakesMembers:
+                    # apply the correct scale for fakes
+                    scaleForFake = self.groups[self.fakeName].scale(member)
+                scales[(procName, i)] = (scale, scaleForFake)
+
+        return dict(groups=groups, scales=scales, hasFake=hasFake, sumFakesPartial=sumFakesPartial)
+
+    def loadHistsFromPlan(self, plan, baseName, syst, label, nominalIfMissing=True, applySelection=True, forceNonzero=True, 
+        preOpMap=None, preOpArgs={}, forceToNominal=[], nominal_cache=None,
+    ):
+        hasFake = plan["hasFake"]
+        sumFakesPartial = plan["sumFakesPartial"]
+
+        foundExact = False
+
+        histForFake = None # to store the data-MC sums used for the fakes, for each syst
+        fakesMembersWithSyst = []
+        for procName, group in plan["groups"].items():
+            logger.debug(f"Reading group {procName}")
 
             group.hists[label] = None
 
@@ -278,69 +357,47 @@ class Datagroups(object):
                 if member.name in forceToNominal:
                     read_syst = ""
                     logger.debug(f"Forcing group member {member.name} to read the nominal hist for syst {syst}")
-                try:
-                    h = self.readHist(baseName, member, procName, read_syst)
-                    foundExact = True
-                except ValueError as e:
-                    if nominalIfMissing:
-                        logger.info(f"{str(e)}. Using nominal hist {self.nominalName} instead")
-                        h = self.readHist(self.nominalName, member, procName, "")
-                    else:
-                        logger.warning(str(e))
-                        continue
-
-                h_id = id(h)
 
-                logger.debug(f"Hist axes are {h.axes.name}")
+                scale, scaleProcForFake = plan["scales"][(procName, i)]
+                # the nominal histograms (without a pre operation) are the same for all systematics
+                cache_key = (procName, i, forceNonzero)
+                cacheable = nominal_cache is not None and not (preOpMap and member.name in preOpMap)
 
-                if group.memberOp:
-                    if group.memberOp[i] is not None:
-                        logger.debug(f"Apply operation to member {i}: {member.name}/{procName}")
-                        h = group.memberOp[i](h)
+                if cacheable and read_syst == "" and cache_key in nominal_cache:
+                    logger.debug(f"Use cached nominal hist for {member.name}/{procName}")
+                    h = nominal_cache[cache_key].copy()
+                    foundExact = True
+                else:
+                    try:
+                        h = self.readHist(baseName, member, procName, read_syst)
+                        foundExact = True
+                        use_nominal = read_syst == ""
+                    except ValueError as e:
+                        if nominalIfMissing:
+                            logger.info(f"{str(e)}. Using nominal hist {self.nominalName} instead")
+                            use_nominal = self.nominalName == baseName
+                            if cacheable and use_nominal and cache_key in nominal_cache:
+                                h = nominal_cache[cache_key].copy()
+                            else:
+                                h = self.readHist(self.nominalName, member, procName, "")
+                                h = self.transformMemberHist(h, group, i, member, procName, scale, forceNonzero, preOpMap, preOpArgs)
+                                if cacheable and use_nominal:
+                                    nominal_cache[cache_key] = h.copy()
+                        else:
+                            logger.warning(str(e))
+                            continue
                     else:
-                        logger.debug(f"No operation for member {i}: {member.name}/{procName}")
-
-                if preOpMap and member.name in preOpMap:
-                    logger.debug(f"Applying action to {member.name}/{procName} after loading")
-                    h = preOpMap[member.name](h, **preOpArgs)
-
-                sum_axes = [x for x in self.sum_gen_axes if x in h.axes.name]
-                if len(sum_axes) > 0:
-                    # sum over remaining axes (avoid integrating over fit axes & fakerate axes)
-                    logger.debug(f"Sum over axes {sum_axes}")
-                    h = h.project(*[x for x in h.axes.name if x not in sum_axes])
-                    logger.debug(f"Hist axes are now {h.axes.name}")
-
-                if h_id == id(h):
-                    logger.debug(f"Make explicit copy")
-                    h = h.copy()
-
-                if self.globalAction:
-                    logger.debug("Applying global action")
-                    h = self.globalAction(h)
-
-                if forceNonzero:
-                    logger.debug("force non zero")
-                    h = hh.clipNegativeVals(h, createNew=False)
-
-                scale = self.processScaleFactor(member)
-                scale *= scaleToNewLumi
-                if group.scale:
-                    scale *= group.scale(member)
-
-                if not np.isclose(scale, 1, rtol=0, atol=1e-10):
-                    logger.debug(f"Scale hist with {scale}")
-                    h = hh.scaleHist(h, scale, createNew=False)
+                        h = self.transformMemberHist(h, group, i, member, procName, scale, forceNonzero, preOpMap, preOpArgs)
+                        if cacheable and use_nominal:
+                            nominal_cache[cache_key] = h.copy()
 
                 hasPartialSumForFake = False
                 if hasFake and procName != self.fakeName:
-                    if member.name in fakesMembers:
+                    if scaleProcForFake is not None:
                         logger.debug("Make partial sums for fakes")
                         if member.name not in fakesMembersWithSyst:
                             fakesMembersWithSyst.append(member.name)
                         hasPartialSumForFake = True
-                        # apply the correct scale for fakes
-                        scaleProcForFake = self.groups[self.fakeName].scale(member)
                         logger.debug(f"Summing hist {read_syst} for {member.name} to {self.fakeName} with scale = {scaleProcForFake}")
                         hProcForFake = scaleProcForFake * h
                         histForFake = hh.addHists(histForFake, hProcForFake, createNew=False) if histForFake else hProcForFake
@@ -381,6 +438,48 @@ class Datagroups(object):
         if nominalIfMissing and not foundExact:
             raise ValueError(f"Did not find systematic {syst} for any processes!")
 
+    def transformMemberHist(self, h, group, i, member, procName, scale, forceNonzero=True, preOpMap=None, preOpArgs={}):
+        # operations applied to each member histogram after reading it
+        h_id = id(h)
+
+        logger.debug(f"Hist axes are {h.axes.name}")
+
+        if group.memberOp:
+            if group.memberOp[i] is not None:
+                logger.debug(f"Apply operation to member {i}: {member.name}/{procName}")
+                h = group.memberOp[i](h)
+            else:
+                logger.debug(f"No operation for member {i}: {member.name}/{procName}")
+
+        if preOpMap and member.name in preOpMap:
+            logger.debug(f"Applying action to {member.name}/{procName} after loading")
+            h = preOpMap[member.name](h, **preOpArgs)
+
+        sum_axes = [x for x in self.sum_gen_axes if x in h.axes.name]
+        if len(sum_axes) > 0:
+            # sum over remaining axes (avoid integrating over fit axes & fakerate axes)
+            logger.debug(f"Sum over axes {sum_axes}")
+            h = h.project(*[x for x in h.axes.name if x not in sum_axes])
+            logger.debug(f"Hist axes are now {h.axes.name}")
+
+        if h_id == id(h):
+            logger.debug(f"Make explicit copy")
+            h = h.copy()
+
+        if self.globalAction:
+            logger.debug("Applying global action")
+            h = self.globalAction(h)
+
+        if forceNonzero:
+            logger.debug("force non zero")
+            h = hh.clipNegativeVals(h, createNew=False)
+
+        if not np.isclose(scale, 1, rtol=0, atol=1e-10):
+            logger.debug(f"Scale hist with {scale}")
+            h = hh.scaleHist(h, scale, createNew=False)
+
+        return h
+
     def getDatagroups(self):
         return self.groups
 
@@ -611,9 +710,12 @@ class Datagroups(object):
                 axes[i] = f"abs{var}"
 
     def readHist(self, baseName, proc, group, syst):
-        output = self.results[proc.name]["output"]
         histname = self.histName(baseName, proc.name, syst)
         logger.debug(f"Reading hist {histname} for proc/group {proc.name}/{group} and syst '{syst}'")
+        if isinstance(self.results, input_tools.ResultsReader):
+            return self.results.read_hist(proc.name, histname)
+
+        output = self.results[proc.name]["output"]
         if histname not in output:
             raise ValueError(f"Histogram {histname} not found for process {proc.name}")
 
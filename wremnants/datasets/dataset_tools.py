@@ -7,6 +7,11 @@ import glob
 import random
 import pathlib
 import socket
+import json
+import re
+import time
+import collections
+import concurrent.futures
 #set the debug level for logging incase of full printout 
 from wremnants.datasets.datasetDict_v9 import dataDictV9, dataDictV9extended
 from wremnants.datasets.datasetDict_gen import genDataDict
@@ -26,16 +31,22 @@ default_nfiles = {
     'ZtautauPostVFP' : 1200,
 }
 
-def buildFileListPosix(path):
+def buildFileListPosix(path, stat=False):
     outfiles = []
     for root, dirs, fnames in os.walk(path):
         for fname in fnames:
             if fname.lower().endswith(".root"):
-                outfiles.append(f"{root}/{fname}")
+                fpath = f"{root}/{fname}"
+                if stat:
+                    fstat = os.stat(fpath)
+                    outfiles.append((fpath, fstat.st_size, fstat.st_mtime))
+                else:
+                    outfiles.append(fpath)
 
     return outfiles
 
-def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False, num_clients = 16):
+def listDirXrd(xrdfs, path):
+    # entries of a directory as (name, is_dir, size, mtime), None if the directory does not exist
     status, dirlist = xrdfs.dirlist(path, flags = XRootD.client.flags.DirListFlags.STAT)
 
     if not status.ok:
@@ -44,36 +55,50 @@ def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False,
         else:
             raise RuntimeError(f"Error in XRootD.client.FileSystem.dirlist: {status.message}, {status.code}, {status.errno}")
 
-        return
+        return None
 
+    entries = []
     for diritem in dirlist:
         is_dir = diritem.statinfo.flags & XRootD.client.flags.StatInfoFlags.IS_DIR
         is_other = diritem.statinfo.flags & XRootD.client.flags.StatInfoFlags.OTHER
-        is_file = not (is_dir or is_other)
-
-        if is_dir and recurse:
-            childpath = f"{path}/{diritem.name}"
-            appendFilesXrd(filelist, xrdfs, childpath, suffixes=suffixes, recurse=recurse, num_clients=num_clients)
-        elif is_file:
-            lowername = diritem.name.lower()
-            matchsuffix = False
-            for suffix in suffixes:
-                if lowername.endswith(suffix):
-                    matchsuffix = True
-                    break
-
-            if matchsuffix:
+        if not is_other:
+            entries.append((diritem.name, bool(is_dir), diritem.statinfo.size, diritem.statinfo.modtime))
+
+    return entries
+
+def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False, num_clients = 16, stat = False, max_workers = 16):
+    # the directories are listed level by level with concurrent requests,
+    # the files are then appended in the same order as by a depth-first walk
+    listings = {}
+    dirs = [path]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while dirs:
+            listings.update(zip(dirs, executor.map(lambda d: listDirXrd(xrdfs, d), dirs)))
+            dirs = [f"{d}/{name}" for d in dirs if recurse and listings[d] for name, is_dir, size, mtime in listings[d] if is_dir]
+
+    def append(path):
+        for name, is_dir, size, mtime in listings[path] or []:
+            if is_dir:
+                if recurse:
+                    append(f"{path}/{name}")
+            elif any(name.lower().endswith(suffix) for suffix in suffixes):
                 if num_clients > 0:
                     # construct client string if necessary to force multiple xrootd connections
                     # (needed for good performance when a single or small number of xrootd servers is used)
                     client = f"user_{random.randrange(num_clients)}"
-                    outname = f"{xrdfs.url.protocol}://{client}@{xrdfs.url.hostname}:{xrdfs.url.port}/{path}/{diritem.name}"
+                    outname = f"{xrdfs.url.protocol}://{client}@{xrdfs.url.hostname}:{xrdfs.url.port}/{path}/{name}"
                 else:
-                    outname = f"{xrdfs.url.protocol}://{xrdfs.url.hostid}/{path}/{diritem.name}"
+                    outname = f"{xrdfs.url.protocol}://{xrdfs.url.hostid}/{path}/{name}"
+
+                filelist.append((outname, size, mtime) if stat else outname)
 
-                filelist.append(outname)
+    append(path)
 
-def buildFileListXrd(path, num_clients = 16):
+def stripXrdClient(path):
+    # remove the random client name added by appendFilesXrd, to identify a file independently of the xrootd connection
+    return re.sub(r"^(\w+://)user_\d+@", r"\1", path)
+
+def buildFileListXrd(path, num_clients = 16, stat = False, max_workers = 16):
     xrdurl =  XRootD.client.URL(path)
 
     if not xrdurl.is_valid():
@@ -83,16 +108,110 @@ def buildFileListXrd(path, num_clients = 16):
     xrdpath = xrdurl.path
 
     outfiles = []
-    appendFilesXrd(outfiles, xrdfs, xrdpath, recurse=True, num_clients=num_clients)
+    appendFilesXrd(outfiles, xrdfs, xrdpath, recurse=True, num_clients=num_clients, stat=stat, max_workers=max_workers)
 
     return outfiles
 
-def buildFileList(path):
+def buildFileList(path, stat=False, max_workers=16):
     xrdprefix = "root://"
-    return buildFileListXrd(path) if path.startswith(xrdprefix) else buildFileListPosix(path)
+    return buildFileListXrd(path, stat=stat, max_workers=max_workers) if path.startswith(xrdprefix) else buildFileListPosix(path, stat=stat)
+
+class FileCatalogue(object):
+    # cache of the files found under the input paths as {path: {"time": time of the listing, "files": [[file, size, mtime], ...]}}
+    # and of the number of entries of the files that were opened as {file: [size, entries]},
+    # kept in memory and optionally in a json file to be reused by the following jobs,
+    # paths older than ttl hours are listed again, with refresh all paths are listed again once
+    def __init__(self, filename=None, ttl=24, refresh=False, max_workers=16):
+        self.filename = filename
+        self.ttl = ttl*3600
+        self.refresh = refresh
+        self.max_workers = max_workers
+        self.listings = {}
+        self.file_entries = {}
+        self.listed = set()
+        # {file: size} of all listed files, built on first use
+        self.file_sizes = None
+        if filename and os.path.isfile(filename):
+            with open(filename, "r") as f:
+                data = json.load(f)
+            self.listings = data.get("listings", {})
+            self.file_entries = data.get("entries", {})
+
+    def valid(self, path):
+        if path in self.listed:
+            return True
+        if self.refresh or path not in self.listings:
+            return False
+        return time.time() - self.listings[path]["time"] < self.ttl
+
+    def prefetch(self, paths):
+        # the missing paths are listed concurrently, the workers are shared with the concurrent listing within each path
+        missing = list(dict.fromkeys(p for p in paths if not self.valid(p)))
+        if not missing:
+            return
+
+        time0 = time.time()
+        max_workers_path = max(1, self.max_workers//len(missing))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            results = list(executor.map(lambda p: buildFileList(p, stat=True, max_workers=max_workers_path), missing))
+
+        for path, files in zip(missing, results):
+            self.listings[path] = {"time": time0, "files": [list(f) for f in files]}
+            self.listed.add(path)
+        self.file_sizes = None
+        logger.info(f"Listed the files of {len(missing)} paths in {time.time()-time0:.1f} s")
+
+        self.save()
+
+    def files(self, path):
+        self.prefetch([path])
+        return [f[0] for f in self.listings[path]["files"]]
+
+    def sizes(self, files):
+        if self.file_sizes is None:
+            self.file_sizes = {f[0]: f[1] for listing in self.listings.values() for f in listing["files"]}
+        return [self.file_sizes.get(f) for f in files]
+
+    def count_entries(self, files):
+        # number of entries of the files, None for zombie files, files are only opened again if their size changed
+        sizes = dict(zip(files, self.sizes(files)))
+        missing = [f for f in files if f not in self.file_entries or self.file_entries[f][0] != sizes[f]]
+        if missing:
+            time0 = time.time()
+            # the files are opened concurrently, see enableConcurrentFileOpen
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+                entries = list(executor.map(fileEntries, missing))
+            for f, n in zip(missing, entries):
+                if n is not None:
+                    self.file_entries[f] = [sizes[f], n]
+            logger.info(f"Opened {len(missing)} files in {time.time()-time0:.1f} s")
+            self.save()
+
+        return [self.file_entries[f][1] if f in self.file_entries else None for f in files]
+
+    def file_weights(self, files):
+        # work needed to process the files, their number of entries if known for all of them or their size
+        entries = [self.file_entries.get(f, [None, None])[1] for f in files]
+        if all(n is not None for n in entries):
+            return entries
+        sizes = self.sizes(files)
+        if all(size is not None for size in sizes):
+            return sizes
+        return None
+
+    def save(self):
+        if not self.filename:
+            return
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        # written with a temporary name to be safe against concurrent jobs
+        tmp = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"listings": self.listings, "entries": self.file_entries}, f)
+        os.replace(tmp, self.filename)
 
 #TODO add the rest of the samples!
-def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_data=False, oneMCfileEveryN=None):
+def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_data=False, oneMCfileEveryN=None, catalogue=None):
     filelist = []
     expandedPaths = []
     for orig_path in paths:
@@ -107,7 +226,7 @@ def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_dat
             expandedPaths.append(path)
             logger.debug(f"Reading files from path {path}")
 
-            files = buildFileList(path)
+            files = catalogue.files(path) if catalogue else buildFileList(path)
             if maxFiles > 0 and len(files) >= maxFiles:
                 break
 
@@ -202,6 +321,11 @@ def getDataPath(mode=None):
         base_path = "/scratch/wmass/y2016"
     return base_path
 
+def enableConcurrentFileOpen():
+    # needed to open the files from several threads, TFile::Open releases the GIL from then on
+    ROOT.EnableThreadSafety()
+    ROOT.TFile.Open.__release_gil__ = True
+
 def is_zombie(file_path):
     # Try opening the ROOT file and check if it's a zombie file
     file = ROOT.TFile.Open(file_path)
@@ -211,9 +335,24 @@ def is_zombie(file_path):
     file.Close()
     return False
 
+def fileEntries(file_path, treename="Events"):
+    # number of entries of the tree, None for a zombie file
+    file = ROOT.TFile.Open(file_path)
+    if not file or file.IsZombie():
+        logger.warning(f"Found zombie file: {file_path}")
+        return None
+    tree = file.Get(treename)
+    entries = tree.GetEntries() if tree else 0
+    file.Close()
+    return entries
+
+# name and group of a sample, to select the samples before listing their files
+SampleInfo = collections.namedtuple("SampleInfo", ["name", "group"])
+
 def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_path=None, nanoVersion="v9",
                 data_tags=["TrackFitV722_NanoProdv3", "TrackFitV722_NanoProdv2"],
-                mc_tags=["TrackFitV722_NanoProdv3", "TrackFitV718_NanoProdv1"], oneMCfileEveryN=None, checkFileForZombie=False, era="2016PostVFP", extended=True):
+                mc_tags=["TrackFitV722_NanoProdv3", "TrackFitV718_NanoProdv1"], oneMCfileEveryN=None, checkFileForZombie=False, era="2016PostVFP", extended=True,
+                fileCatalogue=None, catalogueTTL=24, refreshCatalogue=False, countEntries=False, nWorkers=16):
 
     if maxFiles is None or (isinstance(maxFiles, int) and maxFiles < -1):
         maxFiles=default_nfiles
@@ -242,21 +381,42 @@ def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_p
     elif mode and "lowpu" in mode:
         dataDict = dataDictLowPU
 
-    narf_datasets = []
+    samples = []
     for sample,info in dataDict.items():
         if sample in genDataDict:
             base_path = base_path.replace("NanoAOD", "NanoGen")
 
         is_data = info.get("group","") == "Data"
+        if is_data and mode == "gen":
+            continue
 
+        samples.append((sample, info, base_path, is_data))
+
+    # the files are only listed for the selected samples
+    if not callable(filt) and not callable(excl):
+        selected = [SampleInfo(sample, info.get("group")) for sample, info, _, _ in samples]
+        selected = set(s.name for s in excludeProcs(excl, filterProcs(filt, selected)))
+        samples = [x for x in samples if x[0] in selected]
+
+    # the paths with the first production tag are listed concurrently beforehand, the others only if needed as fallback
+    catalogue = FileCatalogue(fileCatalogue, ttl=catalogueTTL, refresh=refreshCatalogue, max_workers=nWorkers)
+    if checkFileForZombie or countEntries:
+        enableConcurrentFileOpen()
+    catalogue.prefetch([path.format(BASE_PATH=sample_base_path, NANO_PROD_TAG=(data_tags if is_data else mc_tags)[0])
+        for sample, info, sample_base_path, is_data in samples for path in info["filepaths"]])
+
+    narf_datasets = []
+    for sample, info, sample_base_path, is_data in samples:
         prod_tags = data_tags if is_data else mc_tags
         nfiles = maxFiles
         if type(maxFiles) == dict:
             nfiles = maxFiles[sample] if sample in maxFiles else -1
-        paths = makeFilelist(info["filepaths"], nfiles, base_path=base_path, nano_prod_tags=prod_tags, is_data=is_data, oneMCfileEveryN=oneMCfileEveryN)
+        paths = makeFilelist(info["filepaths"], nfiles, base_path=sample_base_path, nano_prod_tags=prod_tags, is_data=is_data, oneMCfileEveryN=oneMCfileEveryN, catalogue=catalogue)
 
-        if checkFileForZombie:
-            paths = [p for p in paths if not is_zombie(p)]
+        if checkFileForZombie or countEntries:
+            entries = catalogue.count_entries(paths)
+            if checkFileForZombie:
+                paths = [p for p, n in zip(paths, entries) if n is not None]
 
         #paths = list(filter(lambda x: not ("WminusJetsToMuNu" in x and os.path.basename(x) in ["NanoV9MCPostVFP_4316.root","NanoV9MCPostVFP_4372.root","NanoV9MCPostVFP_4310.root","NanoV9MCPostVFP_4377.root","NanoV9MCPostVFP_4306.root"]), paths))
 
@@ -270,8 +430,6 @@ def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_p
         )
 
         if is_data:
-            if mode == "gen":
-                continue
             narf_info.update(dict(
                 is_data=True,
                 lumi_csv=info["lumicsv"],
@@ -284,7 +442,10 @@ def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_p
                 group=info["group"] if "group" in info else None,
                 )
             )
-        narf_datasets.append(narf.Dataset(**narf_info))
+        dataset = narf.Dataset(**narf_info)
+        # used to balance the work between the threads and shards
+        dataset.file_weights = catalogue.file_weights(paths)
+        narf_datasets.append(dataset)
 
     narf_datasets = filterProcs(filt, narf_datasets)
     narf_datasets = excludeProcs(excl, narf_datasets)
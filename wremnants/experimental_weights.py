@@ -0,0 +1,33 @@
+import ROOT
+import narf
+from wremnants import include_cache
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+include_cache.declare('#include "experimental_weights.h"')
+
+def make_experimental_weight_helper(pileup_helper, vertex_helper, muon_prefiring_helper, muon_efficiency_helper=None,
+                                    new_muon_prefiring=True, vertex_weight=True):
+    # single helper for the pileup, vertex, muon prefiring and efficiency scale factor weights, from the individual helpers
+    sf_helper = ROOT.wrem.no_scale_factors() if muon_efficiency_helper is None else muon_efficiency_helper
+    logger.debug(f"Make fused experimental weight helper with {type(sf_helper).__cpp_name__}")
+    return ROOT.wrem.experimental_weight_helper[type(sf_helper)](pileup_helper, vertex_helper, muon_prefiring_helper, sf_helper,
+        new_muon_prefiring, vertex_weight)
+
+def define_experimental_weights(df, helper, new_muon_prefiring=True, scale_factors=True, colNamePrefix="goodMuons"):
+    # defines exp_weight and the individual factors with the same names as when they are defined separately,
+    # the factors are only evaluated when used e.g. by systematic helpers
+    cols = ["Pileup_nTrueInt", "GenVtx_z",
+        "Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId",
+        "L1PreFiringWeight_Muon_Nom", "L1PreFiringWeight_ECAL_Nom",
+        *[f"{colNamePrefix}_{v}" for v in ["pt0", "eta0", "SApt0", "SAeta0", "uT0", "charge0"]], "passIso"]
+    df = df.Define("exp_weights", helper, cols)
+    df = df.Define("weight_pu", "exp_weights.pu")
+    df = df.Define("weight_vtx", "exp_weights.vtx")
+    if new_muon_prefiring:
+        df = df.Define("weight_newMuonPrefiringSF", "exp_weights.muon_prefiring")
+    if scale_factors:
+        df = df.Define("weight_fullMuonSF_withTrackingReco", "exp_weights.sf")
+    df = df.Define("exp_weight", "exp_weights.weight")
+    return df
@@ -2,6 +2,7 @@ import ROOT
 import pathlib
 import hist
 import narf.clingutils
+from wremnants import include_cache
 import uproot
 import pathlib
 import hist
@@ -19,7 +20,7 @@ import narf
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "syst_helicity_utils.h"')
+include_cache.declare('#include "syst_helicity_utils.h"')
 
 data_dir = f"{pathlib.Path(__file__).parent}/data/"
 
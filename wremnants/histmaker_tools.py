@@ -1,13 +1,390 @@
 from narf.ioutils import H5PickleProxy
+import narf
+import ROOT
+import h5py
+import hashlib
+import inspect
+import json
+import os
+import sys
 import time
-from utilities import logging
+import shlex
+import subprocess
+import concurrent.futures
+import functools
+import glob
+from utilities import logging, common
+from utilities.io_tools import input_tools, output_tools
+from wremnants import muon_calibration, muon_selections, profile_tools
+from wremnants.datasets.dataset_tools import stripXrdClient
 
 logger = logging.child_logger(__name__)
 
-def scale_to_data(result_dict):
-    # scale histograms by lumi*xsec/sum(gen weights)
+# tree with the event weights of all events of the original files of a skimmed dataset
+skim_weights_tree = "SkimWeights"
+# trees of the original files copied into the skim, e.g. for the luminosity of the data
+skim_copy_trees = ["LuminosityBlocks", "Runs"]
+# arguments changing the preselection or the corrected muons the preselection is based on
+skim_args = ["era", "muonCorrMC", "muonCorrData", "biasCalibration", "noSmearing", "trackerMuons", "isolationDefinition", "pt", "makeMCefficiency"]
+# files of weights of the skimmed datasets and the weight expression they were written with
+skim_weight_files = {}
+
+def skim_hash(dataset, preselection, weight, args):
+    # the skim is identified by the input files, the selection code and the configuration of the corrections
+    digest = hashlib.sha256()
+    digest.update(dataset.name.encode())
+    for path in sorted(dataset.filepaths, key=stripXrdClient):
+        digest.update(stripXrdClient(path).encode())
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{stat.st_size}_{stat.st_mtime_ns}".encode())
+    digest.update(inspect.getsource(preselection).encode())
+    digest.update(weight.encode())
+    for module in [muon_calibration, muon_selections]:
+        digest.update(inspect.getsource(module).encode())
+    for header in ["muonCorr.h", "muon_calibration.h"]:
+        with open(f"{common.wremnants_dir}/include/{header}", "rb") as f:
+            digest.update(f.read())
+    config = {k: getattr(args, k, None) for k in skim_args}
+    config["calib_filepaths"] = common.calib_filepaths
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+def file_has_tree(path, tree):
+    f = ROOT.TFile.Open(path)
+    found = bool(f) and not f.IsZombie() and bool(f.Get(tree))
+    if f:
+        f.Close()
+    return found
+
+def skim_datasets(datasets, preselection, args, weight, skip=[]):
+    # snapshot the events passing the preselection of each dataset into the cache folder (or reuse an existing snapshot)
+    # and let the datasets read from there, all columns of the original files and the trees in skim_copy_trees are kept,
+    # the preselection has to be a subset of the selection of the histmaker,
+    # weight is the event weight of the simulation used by the histmaker, checked in sum_and_count_weights
+    # histograms filled before the preselection can not be made from a skim, the corresponding datasets need to be skipped
+    if args.nShards > 1 and args.shard is None:
+        # the shards are skimmed by the processes running them
+        return datasets
+
+    if args.shard is not None:
+        datasets = shard_datasets(datasets, args)
+
+    os.makedirs(args.skimCache, exist_ok=True)
     time0 = time.time()
 
+    opts = ROOT.RDF.RSnapshotOptions()
+    opts.fLazy = True
+    opts.fCompressionAlgorithm = ROOT.ROOT.RCompressionSetting.EAlgorithm.kLZ4
+    opts.fCompressionLevel = 4
+
+    snapshots = []
+    to_move = []
+    to_copy = []
+    for dataset in datasets:
+        if dataset.name in skip or not dataset.filepaths:
+            continue
+
+        path = f"{args.skimCache}/{dataset.name}_{skim_hash(dataset, preselection, weight, args)}.root"
+        weightpath = path.replace(".root", "_weights.root")
+
+        if os.path.isfile(path) and os.path.isfile(weightpath):
+            logger.info(f"Read dataset {dataset.name} from skim {path}")
+        else:
+            logger.info(f"Skim dataset {dataset.name} into {path}")
+            df = ROOT.RDataFrame("Events", dataset.filepaths)
+            columns = df.GetColumnNames()
+            dfw = df.Define("weight", "1.0" if dataset.is_data else weight)
+            # files are written with temporary names such that an interrupted skim is not picked up
+            snapshots.append(dfw.Snapshot(skim_weights_tree, f"{weightpath}.tmp", ["weight"], opts))
+            snapshots.append(preselection(df, dataset).Snapshot("Events", f"{path}.tmp", columns, opts))
+            to_move.extend([path, weightpath])
+            to_copy.append((list(dataset.filepaths), path))
+
+        dataset.filepaths = [path]
+        dataset.file_weights = None
+        skim_weight_files[dataset.name] = (weightpath, "1.0" if dataset.is_data else weight)
+
+    if snapshots:
+        ROOT.RDF.RunGraphs(snapshots)
+        # added to the skim files after the events, the trees are small
+        opts_update = ROOT.RDF.RSnapshotOptions()
+        opts_update.fMode = "UPDATE"
+        opts_update.fCompressionAlgorithm = opts.fCompressionAlgorithm
+        opts_update.fCompressionLevel = opts.fCompressionLevel
+        for filepaths, path in to_copy:
+            for tree in skim_copy_trees:
+                if file_has_tree(filepaths[0], tree):
+                    ROOT.RDataFrame(tree, filepaths).Snapshot(tree, f"{path}.tmp", "", opts_update)
+        for path in to_move:
+            os.replace(f"{path}.tmp", path)
+        logger.info(f"Skim datasets: {time.time() - time0}")
+
+    return datasets
+
+def sum_and_count_weights(df, dataset, weight):
+    # for a skimmed dataset the sum of weights has to be taken from all events of the original files,
+    # weight is the expression the "weight" column of df is defined with
+    if dataset.name not in skim_weight_files:
+        return df.SumAndCount("weight")
+    weightpath, skim_weight = skim_weight_files[dataset.name]
+    if weight != skim_weight:
+        raise RuntimeError(f"The weight '{weight}' of dataset {dataset.name} differs from the weight '{skim_weight}' of its skim")
+    return ROOT.RDataFrame(skim_weights_tree, weightpath).SumAndCount("weight")
+
+# arguments that do not change the results of a dataset
+checkpoint_ignore_args = ["checkpoint", "resume", "nThreads", "verbose", "noColorLogger", "filterProcs", "excludeProcs", 
+    "appendOutputFile", "outfolder", "postfix", "forceDefaultName", "shardJobs", "shardCommand", "helperCache", "profileGraph",
+    "fileCatalogue", "fileCatalogueTTL", "refreshFileCatalogue", "countFileEntries"]
+# the results read from checkpoint files keep a reference to the file
+checkpoint_readers = []
+
+@functools.lru_cache()
+def code_digest():
+    # the histmaker, the source of the loaded wremnants and utilities modules and the headers of the compiled helpers,
+    # computed once before the first dataset is run such that it is the same for all datasets of a job
+    digest = hashlib.sha256()
+    paths = [sys.argv[0]]
+    for name, module in sorted(sys.modules.items()):
+        if name.split(".")[0] in ["wremnants", "utilities"] and getattr(module, "__file__", None):
+            paths.append(module.__file__)
+    paths.extend(sorted(glob.glob(f"{common.wremnants_dir}/include/**/*.h", recursive=True)))
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def checkpoint_hash(dataset, args):
+    # the results of a dataset are reused if the code, the options and the input files are the same
+    digest = hashlib.sha256()
+    digest.update(code_digest().encode())
+    config = {k: v for k, v in vars(args).items() if k not in checkpoint_ignore_args}
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    digest.update(dataset.name.encode())
+    # sorted since the order of the files can change with the balancing of the work
+    for path in sorted(stripXrdClient(p) for p in dataset.filepaths):
+        digest.update(path.encode())
+    return digest.hexdigest()
+
+def file_weights(dataset):
+    # work needed for each file (number of entries or size from the file catalogue), None if unknown
+    weights = getattr(dataset, "file_weights", None)
+    if weights is None or len(weights) != len(dataset.filepaths):
+        return None
+    return weights
+
+def shard_indices(weights, nfiles, ishard, nshards):
+    # without weights contiguous ranges, such that the files of the merged shards are in the original order,
+    # otherwise the files are assigned by decreasing weight to the shard with the least work so far
+    if weights is None:
+        return list(range(ishard*nfiles//nshards, (ishard+1)*nfiles//nshards))
+
+    work = [0]*nshards
+    indices = []
+    for i in sorted(range(nfiles), key=lambda i: -weights[i]):
+        jshard = min(range(nshards), key=lambda j: work[j])
+        work[jshard] += weights[i]
+        if jshard == ishard:
+            indices.append(i)
+    return sorted(indices)
+
+def balance_datasets(datasets, args):
+    # the largest files are processed first, such that the small files fill the threads at the end of the event loop
+    if args.noBalanceFiles:
+        return
+    for dataset in datasets:
+        weights = file_weights(dataset)
+        if weights is None:
+            continue
+        order = sorted(range(len(weights)), key=lambda i: -weights[i])
+        dataset.filepaths = [dataset.filepaths[i] for i in order]
+        dataset.file_weights = [weights[i] for i in order]
+
+def shard_datasets(datasets, args):
+    # only keep the files of the shard run by this process, datasets without files in the shard are dropped
+    # (datasets without any file are kept in the first shard as in a run without shards)
+    shard = []
+    for dataset in datasets:
+        if not getattr(dataset, "is_shard", False):
+            if not dataset.filepaths and args.shard == 0:
+                shard.append(dataset)
+                continue
+            weights = None if args.noBalanceFiles else file_weights(dataset)
+            indices = shard_indices(weights, len(dataset.filepaths), args.shard, args.nShards)
+            dataset.filepaths = [dataset.filepaths[i] for i in indices]
+            if weights is not None:
+                dataset.file_weights = [weights[i] for i in indices]
+            dataset.is_shard = True
+        if dataset.filepaths:
+            shard.append(dataset)
+    return shard
+
+def shard_output_path(outfile, ishard):
+    return outfile.replace(".hdf5", f"_shard{ishard}.hdf5")
+
+def run_shards(outfile, args):
+    # run the histmaker for each shard as a separate process with the same arguments
+    commands = []
+    for ishard in range(args.nShards):
+        # the file catalogue was already refreshed by this process
+        command = [sys.executable, *[a for a in sys.argv if a != "--refreshFileCatalogue"], "--shard", str(ishard)]
+        if args.shardCommand:
+            command = args.shardCommand.format(command=shlex.join(command), shard=ishard)
+        commands.append(command)
+
+    def run(ishard):
+        logger.info(f"Run shard {ishard}")
+        time0 = time.time()
+        proc = subprocess.run(commands[ishard], shell=isinstance(commands[ishard], str))
+        if proc.returncode != 0:
+            raise RuntimeError(f"Shard {ishard} failed with exit code {proc.returncode}")
+        logger.info(f"Shard {ishard} done: {time.time() - time0}")
+        return time.time() - time0
+
+    njobs = args.shardJobs if args.shardJobs else args.nShards
+    time0 = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor:
+        times = list(executor.map(run, range(args.nShards)))
+    # the shards are balanced if the last one is done after about the mean time of a shard (times the number of rounds)
+    mean = sum(times)/len(times)
+    logger.info(f"Shards done after {time.time() - time0:.1f} s, mean time of a shard {mean:.1f} s, "
+        f"longest {max(times):.1f} s ({max(times)/mean:.2f} times the mean)")
+
+    time0 = time.time()
+    shardfiles = [shard_output_path(outfile, ishard) for ishard in range(args.nShards)]
+    resultdict = merge_shards(shardfiles)
+    for shardfile in shardfiles:
+        os.remove(shardfile)
+    logger.info(f"Merge shards: {time.time() - time0}")
+    return resultdict
+
+def merge_shards(shardfiles):
+    # sum the histograms, weights and event counts of the same datasets in the different shards
+    readers = [input_tools.ResultsReader(shardfile) for shardfile in shardfiles]
+    keys = []
+    for reader in readers:
+        keys.extend(k for k in reader.keys() if k not in keys)
+
+    resultdict = {}
+    for key in keys:
+        results = [reader[key] for reader in readers if key in reader]
+        merged = {k: v for k, v in results[0].items() if k != "output"}
+        merged["dataset"] = dict(results[0]["dataset"])
+        merged["dataset"]["filepaths"] = [f for r in results for f in r["dataset"]["filepaths"]]
+        for k in ["weight_sum", "event_count", "lumi"]:
+            if k in merged:
+                merged[k] = sum(r[k] for r in results)
+
+        # all shards run the same graph, so they must have the same histograms
+        h_names = []
+        for r in results:
+            h_names.extend(h for h in r["output"].keys() if h not in h_names)
+        for r in results:
+            missing = [h for h in h_names if h not in r["output"]]
+            if missing:
+                raise RuntimeError(f"Histograms {missing} of {key} are missing in some of the shards")
+
+        merged["output"] = {}
+        for h_name in h_names:
+            histo = None
+            for r in results:
+                proxy = r["output"][h_name]
+                if histo is None:
+                    histo = proxy.get()
+                else:
+                    histo += proxy.get()
+                    proxy.release()
+            merged["output"][h_name] = H5PickleProxy(histo)
+        resultdict[key] = merged
+
+    for reader in readers:
+        reader.close()
+
+    return resultdict
+
+def build_and_run(datasets, build_graph, outfile, args, meta_info=None):
+    # with --profileGraph the columns and filters of the graph are timed and a report is written into a json file
+    # next to the output file, and added to the meta_info dict if given, to be written into the output file
+    if not args.profileGraph:
+        return run_datasets(datasets, build_graph, outfile, args)
+
+    resultdict = run_datasets(datasets, profile_tools.profile_build_graph(build_graph), outfile, args)
+    if resultdict is None:
+        return None
+    report = profile_tools.make_report(resultdict)
+    profile_tools.write_report(report, outfile.replace(".hdf5", "_graph_profile.json"))
+    if meta_info is not None:
+        meta_info["graph_profile"] = report
+    return resultdict
+
+def run_datasets(datasets, build_graph, outfile, args):
+    # with --nShards the files of each dataset are split into shards that are run as separate processes and merged afterwards,
+    # each shard process only writes the results of its files and None is returned, the histmaker then stops
+    # and the post processing is done on the merged results
+    if args.shard is not None:
+        datasets = shard_datasets(datasets, args)
+        balance_datasets(datasets, args)
+        results = narf.build_and_run(datasets, build_graph)
+        with h5py.File(shard_output_path(outfile, args.shard), "w") as f:
+            for k, v in results.items():
+                narf.ioutils.pickle_dump_h5py(k, v, f)
+                input_tools.write_hist_index(f[k], v["output"])
+                input_tools.write_result_info(f[k], v)
+        if args.profileGraph:
+            profile_tools.write_report(profile_tools.make_report(results), shard_output_path(outfile, args.shard).replace(".hdf5", "_graph_profile.json"))
+        return None
+    elif args.nShards > 1:
+        return run_shards(outfile, args)
+
+    balance_datasets(datasets, args)
+
+    # with --checkpoint the datasets are run one after the other and the results of each are written to a checkpoint file
+    # when it is done, with --resume datasets with results from the same configuration in the checkpoint file are not run again,
+    # the returned results are read lazily from the checkpoint file
+    if not (args.checkpoint or args.resume):
+        return narf.build_and_run(datasets, build_graph)
+
+    checkpoint = (args.appendOutputFile if args.appendOutputFile else outfile).replace(".hdf5", "_checkpoint.hdf5")
+    done = {}
+    if os.path.isfile(checkpoint):
+        if args.resume:
+            with h5py.File(checkpoint, "r") as f:
+                done = {k: json.loads(v) for k, v in f.attrs.items()}
+        else:
+            logger.warning(f"Checkpoint file {checkpoint} exists already, it will be overwritten")
+            os.remove(checkpoint)
+
+    keys = []
+    for dataset in datasets:
+        # the dataset name can be changed when building the graph
+        name = dataset.name
+        config_hash = checkpoint_hash(dataset, args)
+        if name in done and done[name]["hash"] == config_hash:
+            logger.info(f"Take results of dataset {name} from checkpoint file {checkpoint}")
+            keys.extend(done[name]["keys"])
+            continue
+
+        time0 = time.time()
+        results = narf.build_and_run([dataset], build_graph)
+        with h5py.File(checkpoint, "a") as f:
+            for k, v in results.items():
+                if k in f:
+                    del f[k]
+                narf.ioutils.pickle_dump_h5py(k, v, f)
+                input_tools.write_hist_index(f[k], v["output"])
+                input_tools.write_result_info(f[k], v)
+            f.attrs[name] = json.dumps({"hash": config_hash, "keys": list(results.keys())})
+        keys.extend(results.keys())
+        logger.info(f"Run and checkpoint dataset {name}: {time.time() - time0}")
+        del results
+
+    reader = input_tools.ResultsReader(checkpoint)
+    checkpoint_readers.append(reader)
+    return {k: reader[k] for k in keys}
+
+def data_scales(result_dict):
+    # scale of each MC dataset to lumi*xsec/sum(gen weights)
     lumi = [result["lumi"] for result in result_dict.values() if result["dataset"]["is_data"]]
     if len(lumi) == 0:
         lumi = 1
@@ -15,6 +392,7 @@ def scale_to_data(result_dict):
         lumi = sum(lumi)
 
     logger.warning(f"Scale histograms with luminosity = {lumi} /fb")
+    scales = {}
     for d_name, result in result_dict.items():
         if result["dataset"]["is_data"]:
             continue
@@ -23,46 +401,42 @@ def scale_to_data(result_dict):
 
         logger.debug(f"For dataset {d_name} with xsec={xsec}")
 
-        scale = lumi * 1000 * xsec / result["weight_sum"]
-
-        result["weight_sum"] = result["weight_sum"]*scale
-
-        for h_name, histogram in result["output"].items():
-
-            histo = histogram.get()
-
-            histo *= scale
-
-    logger.info(f"Scale to data: {time.time() - time0}")
+        scales[d_name] = lumi * 1000 * xsec / result["weight_sum"]
 
+    return scales
 
-def aggregate_groups(datasets, result_dict, groups_to_aggregate):
-    # add members of groups together
+def scale_and_aggregate(datasets, result_dict, groups_to_aggregate, scale=True):
+    # scale histograms by lumi*xsec/sum(gen weights) and add members of groups together,
+    # the histograms of a group are visited one name at a time, each member is scaled in place, added to the histogram
+    # of the first member and released right away, such that at most one histogram per name and group is held in addition
     time0 = time.time()
 
-    for group in groups_to_aggregate:
+    scales = data_scales(result_dict) if scale else {}
+    for d_name, factor in scales.items():
+        result_dict[d_name]["weight_sum"] = result_dict[d_name]["weight_sum"]*factor
 
+    groups = {}
+    for group in groups_to_aggregate:
         dataset_names = [d.name for d in datasets if d.group == group]
-        if len(dataset_names) == 0:
+        names = [name for name, result in result_dict.items() if result["dataset"]["name"] in dataset_names]
+        if names:
+            groups[group] = names
+    grouped = set(name for names in groups.values() for name in names)
+
+    for d_name, factor in scales.items():
+        if d_name in grouped:
             continue
+        for h_name, histogram in result_dict[d_name]["output"].items():
+            histo = histogram.get()
+            histo *= factor
 
+    for group, names in groups.items():
         logger.debug(f"Aggregate group {group}")
 
         resdict = None
-        members = {}
-        to_del = []
-        for name, result in result_dict.items():
-            if result["dataset"]["name"] not in dataset_names:
-                continue
-
+        for name in names:
+            result = result_dict[name]
             logger.debug(f"Add {name}")
-
-            for h_name, histogram in result["output"].items():
-                if h_name in members.keys():
-                    members[h_name].append(histogram.get())
-                else:
-                    members[h_name] = [histogram.get()]
-
             if resdict is None:
                 resdict = {
                     "n_members": 1,
@@ -81,22 +455,49 @@ def aggregate_groups(datasets, result_dict, groups_to_aggregate):
                 resdict["weight_sum"] += float(result["weight_sum"])
                 resdict["event_count"] += float(result["event_count"])
 
-            to_del.append(name)
+        h_names = []
+        for name in names:
+            h_names.extend(h for h in result_dict[name]["output"].keys() if h not in h_names)
 
         output = {}
-        for h_name, histograms in members.items():
+        for h_name in h_names:
+            histo = None
+            nhists = 0
+            for name in names:
+                # the proxy is taken out of the member results, such that the histogram is freed once it is added
+                histogram = result_dict[name]["output"].pop(h_name, None)
+                if histogram is None:
+                    continue
+                nhists += 1
+                member = histogram.get()
+                if name in scales:
+                    member *= scales[name]
+                if histo is None:
+                    histo = member
+                else:
+                    histo += member
+                histogram.release()
+                del member, histogram
 
-            if len(histograms) != resdict["n_members"]:
-                logger.warning(f"There is a different number of histograms ({len(histograms)}) than original members {resdict['n_members']} for {h_name} from group {group}")
+            if nhists != resdict["n_members"]:
+                logger.warning(f"There is a different number of histograms ({nhists}) than original members {resdict['n_members']} for {h_name} from group {group}")
                 logger.warning("Summing them up probably leads to wrong behaviour")
 
-            output[h_name] = H5PickleProxy(sum(histograms))
+            output[h_name] = H5PickleProxy(histo)
+
+        # delete individual datasets
+        for name in names:
+            del result_dict[name]
 
         result_dict[group] = resdict
         result_dict[group]["output"] = output
 
-        # delete individual datasets
-        for name in to_del:
-            del result_dict[name]
+    logger.info(f"Scale and aggregate: {time.time() - time0}")
 
-    logger.info(f"Aggregate groups: {time.time() - time0}")
+def scale_to_data(result_dict):
+    # scale histograms by lumi*xsec/sum(gen weights)
+    scale_and_aggregate([], result_dict, [])
+
+def aggregate_groups(datasets, result_dict, groups_to_aggregate):
+    # add members of groups together
+    scale_and_aggregate(datasets, result_dict, groups_to_aggregate, scale=False)
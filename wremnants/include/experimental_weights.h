@@ -0,0 +1,156 @@
+#ifndef WREMNANTS_EXPERIMENTAL_WEIGHTS_H
+#define WREMNANTS_EXPERIMENTAL_WEIGHTS_H
+
+#include "TAxis.h"
+#include "TH1D.h"
+#include "TH2D.h"
+#include <algorithm>
+#include <array>
+#include <cmath>
+#include <type_traits>
+#include <vector>
+#include "defines.h"
+#include "pileup.h"
+#include "vertex.h"
+#include "muon_prefiring.h"
+
+namespace wrem {
+
+// copy of a TAxis with the same bin finding as TAxis::FindFixBin, without the virtual calls
+class flat_axis {
+public:
+
+  flat_axis(const TAxis &axis) :
+    nbins_(axis.GetNbins()), xmin_(axis.GetXmin()), xmax_(axis.GetXmax()),
+    edges_(axis.GetXbins()->GetArray(), axis.GetXbins()->GetArray() + axis.GetXbins()->GetSize()) {}
+
+  int size() const { return nbins_; }
+
+  int find_bin(double x) const {
+    if (x < xmin_) {
+      return 0;
+    }
+    if (!(x < xmax_)) {
+      return nbins_ + 1;
+    }
+    if (edges_.empty()) {
+      return 1 + int(nbins_*(x - xmin_)/(xmax_ - xmin_));
+    }
+    return std::upper_bound(edges_.begin(), edges_.end(), x) - edges_.begin();
+  }
+
+private:
+  int nbins_;
+  double xmin_;
+  double xmax_;
+  std::vector<double> edges_;
+};
+
+// nominal experimental weights of an event, the product and the individual factors (the vertex weight is also computed when not applied)
+struct experimental_weights {
+  double weight = 1.0;
+  double pu = 1.0;
+  double vtx = 1.0;
+  double muon_prefiring = 1.0;
+  double sf = 1.0;
+};
+
+// placeholder for the efficiency helper when no scale factors are applied
+struct no_scale_factors {};
+
+// Fused evaluation of the pileup, vertex, muon prefiring and efficiency scale factor weights in a single call,
+// the histograms of the helpers are copied into flat arrays at construction.
+// The weight is the same product as the expression built from the individual columns in the histmakers
+template <typename SF_HELPER>
+class experimental_weight_helper {
+public:
+
+  experimental_weight_helper(const pileup_helper &pileup, const vertex_helper &vertex, const muon_prefiring_helper &prefiring,
+                             const SF_HELPER &sf, bool new_muon_prefiring, bool vertex_weight) :
+    pu_axis_(*pileup.puweights()->GetXaxis()),
+    vtx_axis_x_(*vertex.vertexweights()->GetXaxis()), vtx_axis_y_(*vertex.vertexweights()->GetYaxis()),
+    prefiring_axis_(*prefiring.parameters()->GetXaxis()),
+    sf_(sf), new_muon_prefiring_(new_muon_prefiring), vertex_weight_(vertex_weight) {
+
+    const TH1D &hpu = *pileup.puweights();
+    for (int i = 0; i < pu_axis_.size() + 2; ++i) {
+      pu_.push_back(hpu.GetBinContent(i));
+    }
+
+    const TH2D &hvtx = *vertex.vertexweights();
+    vtx_.resize((vtx_axis_x_.size() + 2)*(vtx_axis_y_.size() + 2));
+    for (int iy = 0; iy < vtx_axis_y_.size() + 2; ++iy) {
+      for (int ix = 0; ix < vtx_axis_x_.size() + 2; ++ix) {
+        vtx_[iy*(vtx_axis_x_.size() + 2) + ix] = hvtx.GetBinContent(ix, iy);
+      }
+    }
+
+    // (plateau, threshold, width) of the prefiring probability for each |eta| bin, the hotspot last
+    const TH2D &hprefire = *prefiring.parameters();
+    const TH2D &hhotspot = *prefiring.hotspot_parameters();
+    for (int i = 1; i <= prefiring_axis_.size(); ++i) {
+      prefiring_.push_back({std::clamp(hprefire.GetBinContent(i, 3), 0., 1.), hprefire.GetBinContent(i, 1), hprefire.GetBinContent(i, 2)});
+    }
+    prefiring_.push_back({std::clamp(hhotspot.GetBinContent(1, 3), 0., 1.), hhotspot.GetBinContent(1, 1), hhotspot.GetBinContent(1, 2)});
+  }
+
+  experimental_weights operator() (float nTrueInt, float genVtx_z,
+                                   const Vec_f &muon_eta, const Vec_f &muon_pt, const Vec_f &muon_phi, const Vec_i &muon_charge, const Vec_b &muon_looseId,
+                                   float l1prefire_muon, float l1prefire_ecal,
+                                   float pt, float eta, float sapt, float saeta, float ut, int charge, bool pass_iso) {
+    experimental_weights res;
+
+    res.pu = pu_[pu_axis_.find_bin(nTrueInt)];
+    res.muon_prefiring = new_muon_prefiring_ ? muon_prefiring(muon_eta, muon_pt, muon_phi, muon_charge, muon_looseId) : l1prefire_muon;
+    res.weight = res.pu*res.muon_prefiring*l1prefire_ecal;
+
+    const int xbin = std::clamp(vtx_axis_x_.find_bin(genVtx_z), 1, vtx_axis_x_.size());
+    const int ybin = std::clamp(vtx_axis_y_.find_bin(nTrueInt), 1, vtx_axis_y_.size());
+    res.vtx = vtx_[ybin*(vtx_axis_x_.size() + 2) + xbin];
+    if (vertex_weight_) {
+      res.weight *= res.vtx;
+    }
+
+    if constexpr (!std::is_same_v<SF_HELPER, no_scale_factors>) {
+      if constexpr (std::is_invocable_v<SF_HELPER&, float, float, float, float, float, int, bool>) {
+        res.sf = sf_(pt, eta, sapt, saeta, ut, charge, pass_iso);
+      } else {
+        res.sf = sf_(pt, eta, sapt, saeta, charge, pass_iso);
+      }
+      res.weight *= res.sf;
+    }
+
+    return res;
+  }
+
+private:
+
+  // same as muon_prefiring_helper
+  double muon_prefiring(const Vec_f &eta, const Vec_f &pt, const Vec_f &phi, const Vec_i &charge, const Vec_b &looseId) const {
+    double sf = 1.0;
+    for (unsigned int i = 0; i < eta.size(); ++i) {
+      if (charge[i] == -99 || !looseId[i]) continue;
+      const std::size_t idx = muon_prefiring_helper::is_hotspot(eta[i], phi[i]) ? prefiring_.size() - 1
+        : std::clamp(prefiring_axis_.find_bin(std::fabs(eta[i])), 1, prefiring_axis_.size()) - 1;
+      auto const &parms = prefiring_[idx];
+      const double prefiringProbability = parms[0]/(std::exp( (pt[i] - parms[1]) / parms[2] ) + 1);
+      sf *= (1.0 - prefiringProbability);
+    }
+    return sf;
+  }
+
+  flat_axis pu_axis_;
+  std::vector<double> pu_;
+  flat_axis vtx_axis_x_;
+  flat_axis vtx_axis_y_;
+  std::vector<double> vtx_;
+  flat_axis prefiring_axis_;
+  std::vector<std::array<double, 3>> prefiring_;
+  SF_HELPER sf_;
+  bool new_muon_prefiring_;
+  bool vertex_weight_;
+};
+
+}
+
+#endif
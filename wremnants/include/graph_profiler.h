@@ -0,0 +1,134 @@
+#ifndef WREMNANTS_GRAPH_PROFILER_H
+#define WREMNANTS_GRAPH_PROFILER_H
+
+#include <chrono>
+#include <deque>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <utility>
+#include <vector>
+
+namespace wrem {
+
+// Number of calls and time spent in the nodes of the RDataFrame graph, accumulated separately for each thread
+// and only summed when the report is made to avoid any synchronization in the event loop
+class GraphProfiler {
+public:
+    using acc_t = std::vector<std::pair<unsigned long long, unsigned long long>>;
+
+    static GraphProfiler &instance() {
+        static GraphProfiler profiler;
+        return profiler;
+    }
+
+    std::size_t add_node(const std::string &name) {
+        std::lock_guard<std::mutex> lock(mutex_);
+        names_.push_back(name);
+        return names_.size() - 1;
+    }
+
+    void record(std::size_t id, unsigned long long ns) {
+        acc_t &acc = local();
+        if (acc.size() <= id) {
+            acc.resize(id + 1);
+        }
+        acc[id].first += 1;
+        acc[id].second += ns;
+    }
+
+    const std::vector<std::string> &names() const { return names_; }
+
+    // (calls, nanoseconds) summed over the threads, only to be called outside of the event loop
+    acc_t totals() {
+        std::lock_guard<std::mutex> lock(mutex_);
+        acc_t res(names_.size());
+        for (auto const &acc : accs_) {
+            for (std::size_t id = 0; id < acc->size() && id < res.size(); ++id) {
+                res[id].first += (*acc)[id].first;
+                res[id].second += (*acc)[id].second;
+            }
+        }
+        return res;
+    }
+
+private:
+    acc_t &local() {
+        thread_local acc_t *acc = nullptr;
+        if (acc == nullptr) {
+            std::lock_guard<std::mutex> lock(mutex_);
+            accs_.emplace_back(std::make_unique<acc_t>(names_.size()));
+            acc = accs_.back().get();
+        }
+        return *acc;
+    }
+
+    std::mutex mutex_;
+    std::vector<std::string> names_;
+    std::vector<std::unique_ptr<acc_t>> accs_;
+};
+
+// Start, end and number of entries of the tasks of the event loop, to check how well the work is balanced between the threads.
+// A task is started by a DefinePerSample column and its end is updated for each entry by a Filter on that column,
+// the tasks are kept in a deque such that the pointers stay valid when more are added
+class TaskTimer {
+public:
+    struct Task {
+        std::size_t dataset;
+        unsigned int slot;
+        long long start;
+        long long end;
+        unsigned long long entries;
+    };
+
+    static TaskTimer &instance() {
+        static TaskTimer timer;
+        return timer;
+    }
+
+    static long long now() {
+        return std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now().time_since_epoch()).count();
+    }
+
+    std::size_t add_dataset(const std::string &name) {
+        std::lock_guard<std::mutex> lock(mutex_);
+        names_.push_back(name);
+        return names_.size() - 1;
+    }
+
+    Task *start(std::size_t dataset, unsigned int slot) {
+        const long long t = now();
+        std::lock_guard<std::mutex> lock(mutex_);
+        tasks_.push_back(Task{dataset, slot, t, t, 0});
+        return &tasks_.back();
+    }
+
+    static bool tick(Task *task) {
+        task->end = now();
+        ++task->entries;
+        return true;
+    }
+
+    const std::vector<std::string> &names() const { return names_; }
+
+    // only to be called outside of the event loop
+    std::vector<Task> tasks() const { return std::vector<Task>(tasks_.begin(), tasks_.end()); }
+
+private:
+    std::mutex mutex_;
+    std::vector<std::string> names_;
+    std::deque<Task> tasks_;
+};
+
+template <typename F>
+auto profile_call(std::size_t id, F &&f) {
+    auto const t0 = std::chrono::steady_clock::now();
+    auto res = f();
+    auto const dt = std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now() - t0);
+    GraphProfiler::instance().record(id, dt.count());
+    return res;
+}
+
+}
+
+#endif
@@ -1,3 +1,6 @@
+#ifndef WREMNANTS_MUON_CALIBRATION_H
+#define WREMNANTS_MUON_CALIBRATION_H
+
 #include <ROOT/RVec.hxx>
 #include "Math/GenVector/PtEtaPhiM4D.h"
 #include "TFile.h"
@@ -10,6 +13,8 @@
 #include <fstream>
 #include <typeinfo>
 #include <algorithm>
+#include <array>
+#include <stdexcept>
 #include "defines.h"
 #include "tfliteutils.h"
 
@@ -1430,40 +1435,148 @@ public:
             // compute qoprec/qopgen needed to compute the weights
             const double qopr = qoprec/qopgen;
 
-            // fill input tensors
-            Eigen::TensorFixedSize<double, Eigen::Sizes<>> genPt_tensor;
-            Eigen::TensorFixedSize<double, Eigen::Sizes<>> genEta_tensor;
-            Eigen::TensorFixedSize<double, Eigen::Sizes<>> genCharge_tensor;
-            Eigen::TensorFixedSize<double, Eigen::Sizes<>> qopr_tensor;
+            const auto [dweightdmu, dweightdsigmasq] = evaluate(genPt, genEta, genCharge, qopr);
 
-            genPt_tensor(0) = genPt;
-            genEta_tensor(0) = genEta;
-            genCharge_tensor(0) = genCharge;
-            qopr_tensor(0) = qopr;
+            // get the output values
+            const double dweightdscale = dweightdmu/qopgen;
+            const double dweightdsigmasq_qop = dweightdsigmasq/qopgen/qopgen;
 
-            // define output tensors
-            Eigen::TensorFixedSize<double, Eigen::Sizes<>> dweightdmu_tensor;
-            Eigen::TensorFixedSize<double, Eigen::Sizes<>> dweightdsigmasq_tensor;
+            res.emplace_back(dweightdscale, dweightdsigmasq_qop);
+        }
+        return res;
+    }
 
+    // derivatives of the weight with respect to the mean and the variance of qoprec/qopgen as given by the model
+    std::pair<double, double> evaluate(double genPt, double genEta, double genCharge, double qopr) const {
+        // fill input tensors
+        Eigen::TensorFixedSize<double, Eigen::Sizes<>> genPt_tensor;
+        Eigen::TensorFixedSize<double, Eigen::Sizes<>> genEta_tensor;
+        Eigen::TensorFixedSize<double, Eigen::Sizes<>> genCharge_tensor;
+        Eigen::TensorFixedSize<double, Eigen::Sizes<>> qopr_tensor;
 
-            // build tuples of inputs and outputs (use std::tie so the tuples contain references to the tensors above)
-            auto const inputs = std::tie(genPt_tensor, genEta_tensor, genCharge_tensor, qopr_tensor);
-            auto outputs = std::tie(dweightdmu_tensor, dweightdsigmasq_tensor);
+        genPt_tensor(0) = genPt;
+        genEta_tensor(0) = genEta;
+        genCharge_tensor(0) = genCharge;
+        qopr_tensor(0) = qopr;
 
-            // call the tensorflow lite model to fill the outputs
-            (*helper_)(inputs, outputs);
+        // define output tensors
+        Eigen::TensorFixedSize<double, Eigen::Sizes<>> dweightdmu_tensor;
+        Eigen::TensorFixedSize<double, Eigen::Sizes<>> dweightdsigmasq_tensor;
 
-            // get the output values
-            const double dweightdscale = dweightdmu_tensor(0)/qopgen;
-            const double dweightdsigmasq = dweightdsigmasq_tensor(0)/qopgen/qopgen;
+        // build tuples of inputs and outputs (use std::tie so the tuples contain references to the tensors above)
+        auto const inputs = std::tie(genPt_tensor, genEta_tensor, genCharge_tensor, qopr_tensor);
+        auto outputs = std::tie(dweightdmu_tensor, dweightdsigmasq_tensor);
+
+        // call the tensorflow lite model to fill the outputs
+        (*helper_)(inputs, outputs);
+
+        return std::make_pair(dweightdmu_tensor(0), dweightdsigmasq_tensor(0));
+    }
+
+private:
+    std::shared_ptr<narf::tflite_helper> helper_;
+};
+
+// The model of SplinesDifferentialWeightsHelper evaluated once on a regular grid of points in (genPt, genEta, qoprec/qopgen)
+// for each charge, the weights are obtained by trilinear interpolation instead of one call of the model per muon.
+// Muons outside of the grid are evaluated with the model.
+class SplinesDifferentialWeightsGridHelper {
+public:
+    using out_t = RVec<std::pair<double, double> >;
+
+    SplinesDifferentialWeightsGridHelper(const std::string &filename,
+        unsigned int nPt, double ptMin, double ptMax,
+        unsigned int nEta, double etaMin, double etaMax,
+        unsigned int nQopr, double qoprMin, double qoprMax) :
+        model_(filename),
+        n_{nPt, nEta, nQopr}, min_{ptMin, etaMin, qoprMin}, max_{ptMax, etaMax, qoprMax} {
+
+        for (std::size_t iaxis = 0; iaxis < 3; ++iaxis) {
+            if (n_[iaxis] < 2) {
+                throw std::invalid_argument("The grid needs at least two points per variable");
+            }
+            step_[iaxis] = (max_[iaxis] - min_[iaxis])/(n_[iaxis] - 1);
+        }
 
-            res.emplace_back(dweightdscale, dweightdsigmasq);
+        auto grid = std::make_shared<std::vector<double>>(2*nPt*nEta*nQopr*2);
+        for (unsigned int icharge = 0; icharge < 2; ++icharge) {
+            const double charge = icharge == 0 ? -1. : 1.;
+            for (unsigned int ipt = 0; ipt < nPt; ++ipt) {
+                for (unsigned int ieta = 0; ieta < nEta; ++ieta) {
+                    for (unsigned int iqopr = 0; iqopr < nQopr; ++iqopr) {
+                        const auto [dweightdmu, dweightdsigmasq] = model_.evaluate(
+                            ptMin + ipt*step_[0], etaMin + ieta*step_[1], charge, qoprMin + iqopr*step_[2]);
+                        const std::size_t idx = 2*index(icharge, ipt, ieta, iqopr);
+                        (*grid)[idx] = dweightdmu;
+                        (*grid)[idx+1] = dweightdsigmasq;
+                    }
+                }
+            }
+        }
+        grid_ = grid;
+    }
+
+    out_t operator() (
+        const RVec<float> &recPts, const RVec<float> &recEtas, const RVec<int> &recCharges,
+        const RVec<float> &genPts, const RVec<float> &genEtas, const RVec<int> &genCharges
+    ) const {
+
+        auto const nmuons = recPts.size();
+        out_t res;
+        res.reserve(nmuons);
+
+        for (std::size_t i = 0; i < nmuons; ++i) {
+            const double qoprec = recCharges[i]*1./(recPts[i]*std::cosh(recEtas[i]));
+            const double qopgen = genCharges[i]*1./(genPts[i]*std::cosh(genEtas[i]));
+            const double qopr = qoprec/qopgen;
+
+            const auto [dweightdmu, dweightdsigmasq] = evaluate(genPts[i], genEtas[i], genCharges[i], qopr);
+
+            res.emplace_back(dweightdmu/qopgen, dweightdsigmasq/qopgen/qopgen);
         }
         return res;
     }
 
+    std::pair<double, double> evaluate(double genPt, double genEta, int genCharge, double qopr) const {
+        const std::array<double, 3> x = {genPt, genEta, qopr};
+        std::array<unsigned int, 3> i0;
+        std::array<double, 3> f;
+        for (std::size_t iaxis = 0; iaxis < 3; ++iaxis) {
+            if (!(x[iaxis] >= min_[iaxis] && x[iaxis] <= max_[iaxis])) {
+                return model_.evaluate(genPt, genEta, genCharge, qopr);
+            }
+            const double pos = (x[iaxis] - min_[iaxis])/step_[iaxis];
+            i0[iaxis] = std::min(static_cast<unsigned int>(pos), n_[iaxis] - 2);
+            f[iaxis] = pos - i0[iaxis];
+        }
+
+        const unsigned int icharge = genCharge > 0 ? 1 : 0;
+        const std::vector<double> &grid = *grid_;
+        double dweightdmu = 0.;
+        double dweightdsigmasq = 0.;
+        for (unsigned int corner = 0; corner < 8; ++corner) {
+            const unsigned int dpt = corner & 1;
+            const unsigned int deta = (corner >> 1) & 1;
+            const unsigned int dqopr = (corner >> 2) & 1;
+            const double w = (dpt ? f[0] : 1. - f[0])*(deta ? f[1] : 1. - f[1])*(dqopr ? f[2] : 1. - f[2]);
+            const std::size_t idx = 2*index(icharge, i0[0] + dpt, i0[1] + deta, i0[2] + dqopr);
+            dweightdmu += w*grid[idx];
+            dweightdsigmasq += w*grid[idx+1];
+        }
+        return std::make_pair(dweightdmu, dweightdsigmasq);
+    }
+
 private:
-    std::shared_ptr<narf::tflite_helper> helper_;
+    std::size_t index(unsigned int icharge, unsigned int ipt, unsigned int ieta, unsigned int iqopr) const {
+        return ((static_cast<std::size_t>(icharge)*n_[0] + ipt)*n_[1] + ieta)*n_[2] + iqopr;
+    }
+
+    SplinesDifferentialWeightsHelper model_;
+    std::array<unsigned int, 3> n_;
+    std::array<double, 3> min_;
+    std::array<double, 3> max_;
+    std::array<double, 3> step_;
+    std::shared_ptr<const std::vector<double>> grid_;
 };
 
 class SmearingHelperSimpleWeight {
@@ -1669,3 +1782,5 @@ private:
 };
 
 }
+
+#endif
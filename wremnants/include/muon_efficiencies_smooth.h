@@ -2,11 +2,22 @@
 #define WREMNANTS_MUON_EFFICIENCIES_SMOOTH_H
 
 #include <boost/histogram/axis.hpp>
+#include <boost/histogram/fwd.hpp>
 #include <array>
+#include <stdexcept>
+#include <tuple>
+#include <vector>
 #include "defines.h"
 
 namespace wrem {
 
+    // number of axes of a histogram with static axes
+    template<typename T>
+    struct histogram_rank;
+
+    template<typename Axes, typename Storage>
+    struct histogram_rank<boost::histogram::histogram<Axes, Storage>> : std::tuple_size<Axes> {};
+
     // TODO use enums for integer/boolean/category axes so that the code is less error-prone?
 
     template<int NSysts, typename HIST_SF>
@@ -630,11 +641,19 @@ namespace wrem {
     public:
 
         muon_efficiency_smooth_helper_stat_base(HIST_SF &&sf_type) :
-            sf_type_(std::make_shared<const HIST_SF>(std::move(sf_type))) {}
+            sf_type_(std::make_shared<const HIST_SF>(std::move(sf_type))) {
+            make_stat_table();
+        }
 
         // number of eta bins, number of eigen variations for pt axis, then 2 charges
         using stat_tensor_t = Eigen::TensorFixedSize<double, Eigen::Sizes<NEtaBins, NPtEigenBins, NCharges>>;
 
+        // 5 axes (eta, pt, charge, eff type, eigen variation), a 6th one for the ut dependence
+        static constexpr std::size_t rank_ = histogram_rank<HIST_SF>::value;
+
+        // the lookup table can be switched off to evaluate the variations from the histogram, e.g. for comparisons
+        void set_use_table(bool use_table) { use_table_ = use_table; }
+
         int checkEffTypeInAxis(boost::histogram::axis::category<std::string> axis, const std::string& match = "match") {
             int ret = -1;
             for (Int_t i = 0; i < axis.size(); i++) {
@@ -661,6 +680,11 @@ namespace wrem {
             // overflow/underflow are attributed to adjacent bin
             auto const tensor_eta_idx = std::clamp(eta_idx, 0, NEtaBins - 1);
 
+            if (const double *ratios = rank_ == 5 ? stat_ratios(eta_idx, pt_idx, charge_idx, eff_type_idx) : nullptr) {
+                set_stat_ratios(res, tensor_eta_idx, charge_idx, ratios);
+                return res;
+            }
+
             auto const &cell_nomi = sf_type_->at(eta_idx,
                                                  pt_idx,
                                                  charge_idx,
@@ -705,6 +729,11 @@ namespace wrem {
             // overflow/underflow are attributed to adjacent bin
             auto const tensor_eta_idx = std::clamp(eta_idx, 0, NEtaBins - 1);
 
+            if (const double *ratios = stat_ratios(eta_idx, pt_idx, charge_idx, eff_type_idx, ut_idx)) {
+                set_stat_ratios(res, tensor_eta_idx, charge_idx, ratios);
+                return res;
+            }
+
             auto const &cell_nomi = sf_type_->at(eta_idx,
                                                  pt_idx,
                                                  charge_idx,
@@ -754,6 +783,11 @@ namespace wrem {
             // overflow/underflow are attributed to adjacent bin
             auto const tensor_eta_idx = std::clamp(eta_idx, 0, NEtaBins - 1);
 
+            if (const double *ratios = rank_ == 5 ? stat_ratios(eta_idx, pt_idx, charge_idx, eff_type_idx_iso) : nullptr) {
+                set_stat_ratios(res, tensor_eta_idx, charge_idx, ratios);
+                return res;
+            }
+
             auto const &cell_nomi = sf_type_->at(eta_idx,
                                                  pt_idx,
                                                  charge_idx,
@@ -802,6 +836,11 @@ namespace wrem {
             // overflow/underflow are attributed to adjacent bin
             auto const tensor_eta_idx = std::clamp(eta_idx, 0, NEtaBins - 1);
 
+            if (const double *ratios = stat_ratios(eta_idx, pt_idx, charge_idx, eff_type_idx_iso, ut_idx)) {
+                set_stat_ratios(res, tensor_eta_idx, charge_idx, ratios);
+                return res;
+            }
+
             auto const &cell_nomi = sf_type_->at(eta_idx,
                                                  pt_idx,
                                                  charge_idx,
@@ -834,6 +873,81 @@ namespace wrem {
 
     protected:
 
+        // ratios of the eigen variations to the nominal SF for the bin of each axis (including under/overflow) except the
+        // eigen variation one, nullptr if not available so that the SF are taken from the histogram
+        const double *stat_ratios(int eta_idx, int pt_idx, int charge_idx, int eff_type_idx, int ut_idx = -1) const {
+            if (!use_table_ || !stat_table_) {
+                return nullptr;
+            }
+            const std::array<int, 5> idxs = {eta_idx + 1, pt_idx + 1, charge_idx + 1, eff_type_idx + 1, ut_idx + 1};
+            std::size_t cell = 0;
+            for (std::size_t i = 0; i < idxs.size(); i++) {
+                if (idxs[i] < 0 || idxs[i] >= table_sizes_[i]) {
+                    return nullptr;
+                }
+                cell = cell*table_sizes_[i] + idxs[i];
+            }
+            if (!(*stat_valid_)[cell]) {
+                return nullptr;
+            }
+            return stat_table_->data() + cell*NPtEigenBins;
+        }
+
+        void set_stat_ratios(stat_tensor_t &res, int tensor_eta_idx, int charge_idx, const double *ratios) const {
+            // the tensor is column major, consecutive eigen variations are NEtaBins apart
+            double *out = res.data() + tensor_eta_idx + NEtaBins*NPtEigenBins*charge_idx;
+            for (int i = 0; i < NPtEigenBins; i++) {
+                out[i*NEtaBins] = ratios[i];
+            }
+        }
+
+        // precompute the ratios once such that each call is a single lookup instead of NPtEigenBins + 1 histogram accesses,
+        // bins where the histogram can't be accessed (e.g. missing under/overflow) are marked as invalid
+        void make_stat_table() {
+            auto const &h = *sf_type_;
+            table_sizes_ = {h.template axis<0>().size() + 2, h.template axis<1>().size() + 2, h.template axis<2>().size() + 2,
+                            h.template axis<3>().size() + 2, 1};
+            if constexpr (rank_ > 5) {
+                table_sizes_[4] = h.template axis<5>().size() + 2;
+            }
+            std::size_t ncells = 1;
+            for (auto const size : table_sizes_) {
+                ncells *= size;
+            }
+
+            auto table = std::make_shared<std::vector<double>>(ncells*NPtEigenBins, 1.0);
+            auto valid = std::make_shared<std::vector<char>>(ncells, 0);
+            auto const eigen_axis = h.template axis<4>();
+
+            std::size_t cell = 0;
+            for (int eta_idx = -1; eta_idx < table_sizes_[0] - 1; eta_idx++) {
+                for (int pt_idx = -1; pt_idx < table_sizes_[1] - 1; pt_idx++) {
+                    for (int charge_idx = -1; charge_idx < table_sizes_[2] - 1; charge_idx++) {
+                        for (int eff_type_idx = -1; eff_type_idx < table_sizes_[3] - 1; eff_type_idx++) {
+                            for (int ut_idx = -1; ut_idx < table_sizes_[4] - 1; ut_idx++, cell++) {
+                                auto sf = [&](int eigen_axis_idx) {
+                                    if constexpr (rank_ > 5) {
+                                        return h.at(eta_idx, pt_idx, charge_idx, eff_type_idx, eigen_axis_idx, ut_idx).value();
+                                    } else {
+                                        return h.at(eta_idx, pt_idx, charge_idx, eff_type_idx, eigen_axis_idx).value();
+                                    }
+                                };
+                                try {
+                                    const double sf_nomi = sf(idx_nom_);
+                                    for (int tensor_eigen_idx = 1; tensor_eigen_idx <= NPtEigenBins; tensor_eigen_idx++) {
+                                        (*table)[cell*NPtEigenBins + tensor_eigen_idx - 1] = sf(eigen_axis.index(tensor_eigen_idx)) / sf_nomi;
+                                    }
+                                    (*valid)[cell] = 1;
+                                } catch (const std::out_of_range &) {}
+                            }
+                        }
+                    }
+                }
+            }
+            stat_table_ = table;
+            stat_valid_ = valid;
+        }
+
         std::shared_ptr<const HIST_SF> sf_type_;
         // cache the bin indices since the string category lookup is slow
         int idx_nom_ = sf_type_->template axis<4>().index(0); // input effStat axis is organized as nomi - UpVar, with nomi centered at 0
@@ -846,6 +960,11 @@ namespace wrem {
         int idx_antiiso_triggering_    = checkEffTypeInAxis(sf_type_->template axis<3>(), "antiiso");
         int idx_iso_nontriggering_     = checkEffTypeInAxis(sf_type_->template axis<3>(), "isonotrig");
         int idx_iso_antitriggering_    = checkEffTypeInAxis(sf_type_->template axis<3>(), "isoantitrig");
+        // lookup table of the stat variations, shared between the copies of the helper
+        std::array<int, 5> table_sizes_ = {};
+        std::shared_ptr<const std::vector<double>> stat_table_;
+        std::shared_ptr<const std::vector<char>> stat_valid_;
+        bool use_table_ = true;
 
     };
 
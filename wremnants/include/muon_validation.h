@@ -1,3 +1,6 @@
+#ifndef WREMNANTS_MUON_VALIDATION_H
+#define WREMNANTS_MUON_VALIDATION_H
+
 #include <boost/histogram.hpp>
 #include <stdlib.h>
 #include <defines.h>
@@ -71,3 +74,5 @@ private:
 };
 
 }
+
+#endif
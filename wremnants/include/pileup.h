@@ -17,6 +17,8 @@ public:
     return puweights_->GetBinContent(puweights_->FindFixBin(nTrueInt));
   }
 
+  const std::shared_ptr<const TH1D> &puweights() const { return puweights_; }
+
 
 private:
   std::shared_ptr<const TH1D> puweights_;
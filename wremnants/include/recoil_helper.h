@@ -1,9 +1,14 @@
+#ifndef WREMNANTS_RECOIL_HELPER_H
+#define WREMNANTS_RECOIL_HELPER_H
+
 #include <ROOT/RVec.hxx>
 #include <iostream>
 #include <vector>
 #include <thread>
 #include <chrono>
 #include <cmath>
+#include <array>
+#include <stdexcept>
 #include "defines.h"
 #include "tfliteutils.h"
 
@@ -175,6 +180,100 @@ private:
 
 
 
+// Same as RecoilCalibrationHelper, with the model evaluated once on a regular grid of (pt, ut_para, ut_perp)
+// and trilinearly interpolated, the model is evaluated directly outside of the grid
+template <size_t N_UNC>
+class RecoilCalibrationGridHelper {
+
+public:
+
+    using model_t = RecoilCalibrationHelper<N_UNC>;
+    using out_t = typename model_t::out_t;
+
+    RecoilCalibrationGridHelper(const std::string &filename, const std::string &func_name, bool do_unc_,
+        unsigned int nPt, double ptMin, double ptMax,
+        unsigned int nPara, double paraMin, double paraMax,
+        unsigned int nPerp, double perpMin, double perpMax) :
+        model_(filename, func_name, do_unc_),
+        n_{nPt, nPara, nPerp}, min_{ptMin, paraMin, perpMin}, max_{ptMax, paraMax, perpMax} {
+
+        do_unc = do_unc_;
+        nvals_ = do_unc ? 2 + N_UNC : 2;
+        for (std::size_t iaxis = 0; iaxis < 3; ++iaxis) {
+            if (n_[iaxis] < 2) {
+                throw std::invalid_argument("The grid needs at least two points per variable");
+            }
+            step_[iaxis] = (max_[iaxis] - min_[iaxis])/(n_[iaxis] - 1);
+        }
+
+        auto grid = std::make_shared<std::vector<double>>(nvals_*nPt*nPara*nPerp);
+        for (unsigned int ipt = 0; ipt < nPt; ++ipt) {
+            for (unsigned int ipara = 0; ipara < nPara; ++ipara) {
+                for (unsigned int iperp = 0; iperp < nPerp; ++iperp) {
+                    auto const res = model_(ptMin + ipt*step_[0], paraMin + ipara*step_[1], perpMin + iperp*step_[2]);
+                    const std::size_t idx = nvals_*index(ipt, ipara, iperp);
+                    (*grid)[idx] = res.ut_para_corr(0);
+                    (*grid)[idx+1] = res.ut_perp_corr(0);
+                    for (std::size_t iunc = 0; iunc < nvals_ - 2; ++iunc) {
+                        (*grid)[idx+2+iunc] = res.unc_weights(iunc);
+                    }
+                }
+            }
+        }
+        grid_ = grid;
+    }
+
+    out_t operator() (const double &pt, const double &ut_para, const double &ut_perp) {
+        const std::array<double, 3> x = {pt, ut_para, ut_perp};
+        std::array<unsigned int, 3> i0;
+        std::array<double, 3> f;
+        for (std::size_t iaxis = 0; iaxis < 3; ++iaxis) {
+            if (!(x[iaxis] >= min_[iaxis] && x[iaxis] <= max_[iaxis])) {
+                return model_(pt, ut_para, ut_perp);
+            }
+            const double pos = (x[iaxis] - min_[iaxis])/step_[iaxis];
+            i0[iaxis] = std::min(static_cast<unsigned int>(pos), n_[iaxis] - 2);
+            f[iaxis] = pos - i0[iaxis];
+        }
+
+        out_t ret;
+        ret.ut_para_corr(0) = 0.;
+        ret.ut_perp_corr(0) = 0.;
+        ret.unc_weights.setConstant(do_unc ? 0. : 1.);
+        const std::vector<double> &grid = *grid_;
+        for (unsigned int corner = 0; corner < 8; ++corner) {
+            const unsigned int dpt = corner & 1;
+            const unsigned int dpara = (corner >> 1) & 1;
+            const unsigned int dperp = (corner >> 2) & 1;
+            const double w = (dpt ? f[0] : 1. - f[0])*(dpara ? f[1] : 1. - f[1])*(dperp ? f[2] : 1. - f[2]);
+            const std::size_t idx = nvals_*index(i0[0] + dpt, i0[1] + dpara, i0[2] + dperp);
+            ret.ut_para_corr(0) += w*grid[idx];
+            ret.ut_perp_corr(0) += w*grid[idx+1];
+            for (std::size_t iunc = 0; iunc < nvals_ - 2; ++iunc) {
+                ret.unc_weights(iunc) += w*grid[idx+2+iunc];
+            }
+        }
+        return ret;
+    }
+
+
+private:
+    std::size_t index(unsigned int ipt, unsigned int ipara, unsigned int iperp) const {
+        return (static_cast<std::size_t>(ipt)*n_[1] + ipara)*n_[2] + iperp;
+    }
+
+    model_t model_;
+    bool do_unc;
+    std::size_t nvals_;
+    std::array<unsigned int, 3> n_;
+    std::array<double, 3> min_;
+    std::array<double, 3> max_;
+    std::array<double, 3> step_;
+    std::shared_ptr<const std::vector<double>> grid_;
+};
+
+
+
 class RecoilCalibrationUncertaintyHelper {
 
 public:
@@ -208,4 +307,4 @@ private:
 
 }
 
-
+#endif
@@ -1,3 +1,6 @@
+#ifndef WREMNANTS_RECOIL_TOOLS_H
+#define WREMNANTS_RECOIL_TOOLS_H
+
 #include <ROOT/RVec.hxx>
 #include <iostream>
 #include <vector>
@@ -231,4 +234,6 @@ Eigen::TensorFixedSize<double, Eigen::Sizes<N_SYST>> concatWeights(First nominal
 
 
 
-}
\ No newline at end of file
+}
+
+#endif
@@ -19,6 +19,8 @@ public:
         return vertexweights_->GetBinContent(xbin, ybin);
     }
 
+    const std::shared_ptr<const TH2D> &vertexweights() const { return vertexweights_; }
+
 
 private:
     std::shared_ptr<const TH2D> vertexweights_;
@@ -0,0 +1,126 @@
+import ROOT
+import narf
+# loads the tflite libraries needed by the compiled muon_calibration.h
+import narf.tfliteutils
+import glob
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shlex
+import subprocess
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+# Optional precompiled dictionary of the wremnants/include headers.
+# It is built once with scripts/utilities/build_include_cache.py, the headers in it are then not parsed at import
+# but only on first use through the rootmap (autoparsing), and the non template code is taken from the compiled library.
+# The cache is invalidated by any change of the headers or of the ROOT version, set WREM_NO_INCLUDE_CACHE to ignore it.
+
+include_dir = f"{pathlib.Path(__file__).parent}/include"
+cache_dir = os.environ.get("WREM_INCLUDE_CACHE_DIR", f"{pathlib.Path(__file__).parent}/.include_cache")
+lib_name = "libwremInclude"
+
+# headers declared so far through declare(), used by the build to know which headers to compile
+declared_headers = []
+# headers provided by the loaded library
+loaded_headers = set()
+
+include_regex = re.compile(r'^\s*#include\s*[<"]([^<>"]+)[>"]\s*$')
+
+# a class declared at import, used to check that the rootmap autoparsing of the library works
+check_header = "csVariables.h"
+check_symbol = "wrem::CSVars"
+
+def header_hash():
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(ROOT.gROOT.GetVersion().encode())
+    for path in sorted(glob.glob(f"{include_dir}/*.h")):
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def stamp_path():
+    return f"{cache_dir}/{lib_name}.json"
+
+def read_stamp():
+    if not os.path.isfile(stamp_path()):
+        return None
+    with open(stamp_path(), "r") as f:
+        return json.load(f)
+
+def load():
+    if os.environ.get("WREM_NO_INCLUDE_CACHE"):
+        return False
+    stamp = read_stamp()
+    if stamp is None:
+        return False
+    if stamp["hash"] != header_hash():
+        logger.warning(f"The headers changed since the include cache in {cache_dir} was built, they are parsed instead. "
+            "Rebuild it with scripts/utilities/build_include_cache.py")
+        return False
+    if ROOT.gSystem.Load(f"{cache_dir}/{lib_name}.so") < 0:
+        logger.warning(f"Failed to load the include cache {cache_dir}/{lib_name}.so, the headers are parsed instead")
+        return False
+    ROOT.gInterpreter.LoadLibraryMap(f"{cache_dir}/{lib_name}.rootmap")
+    # the includes are only skipped if the symbols resolve, otherwise the headers are parsed as without the cache
+    if check_header in stamp["headers"] and not ROOT.TClass.GetClass(check_symbol):
+        logger.warning(f"{check_symbol} does not resolve from the include cache {cache_dir}/{lib_name}.so, the headers are parsed instead. "
+            "Rebuild it with scripts/utilities/build_include_cache.py")
+        return False
+    loaded_headers.update(stamp["headers"])
+    logger.debug(f"Loaded the include cache {cache_dir}/{lib_name}.so")
+    return True
+
+def declare(code):
+    # replacement of narf.clingutils.Declare, includes of headers provided by the include cache are skipped
+    match = include_regex.match(code)
+    if match:
+        header = match.group(1)
+        if header not in declared_headers:
+            declared_headers.append(header)
+        if header in loaded_headers:
+            return
+    narf.clingutils.Declare(code)
+
+def include_flags():
+    # include paths of the interpreter, e.g. for the narf headers
+    return shlex.split(ROOT.gInterpreter.GetIncludePath())
+
+def build(headers):
+    # generate the dictionary with rootcling and compile it into a library, the stamp is written last
+    os.makedirs(cache_dir, exist_ok=True)
+    hash_before = header_hash()
+    base = f"{cache_dir}/{lib_name}"
+    lib = f"{base}.so"
+
+    # only the namespaces are selected, this is enough for the rootmap to autoparse the headers on their first use
+    namespaces = ["wrem", "wrem_vqt", "wrem_vqt_int", "wrem_vqt_real"]
+    linkdef = f"{base}_LinkDef.h"
+    with open(linkdef, "w") as f:
+        f.write("#ifdef __CLING__\n")
+        f.write("#pragma link off all globals;\n#pragma link off all classes;\n#pragma link off all functions;\n")
+        for ns in namespaces:
+            f.write(f"#pragma link C++ namespace {ns};\n")
+        f.write("#endif\n")
+
+    flags = [f"-I{include_dir}", *include_flags()]
+    dictionary = f"{base}_dict.cxx"
+    commands = [
+        ["rootcling", "-f", dictionary, "-s", lib, "-rml", f"{lib_name}.so", "-rmf", f"{base}.rootmap",
+            *flags, *headers, linkdef],
+        [os.environ.get("CXX", "c++"), "-shared", "-fPIC", "-O3", "-o", lib, dictionary, *flags,
+            *shlex.split(subprocess.check_output(["root-config", "--cflags", "--libs"], text=True))],
+    ]
+    for command in commands:
+        logger.info(f"Running {' '.join(command)}")
+        subprocess.run(command, check=True, cwd=cache_dir)
+
+    if header_hash() != hash_before:
+        raise RuntimeError("The headers changed during the build of the include cache")
+    with open(stamp_path(), "w") as f:
+        json.dump({"hash": hash_before, "root": ROOT.gROOT.GetVersion(), "headers": headers}, f, indent=1)
+    logger.info(f"Include cache written to {cache_dir}")
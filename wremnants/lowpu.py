@@ -1,13 +1,14 @@
 
 import narf
+from wremnants import include_cache
 
 # load lowPU specific libs
 #ROOT.gInterpreter.AddIncludePath(f"{pathlib.Path(__file__).parent}/include/")
-narf.clingutils.Declare('#include "lowpu_utils.h"')
-narf.clingutils.Declare('#include "lowpu_efficiencies.h"')
-narf.clingutils.Declare('#include "lowpu_prefire.h"')
-narf.clingutils.Declare('#include "lowpu_rochester.h"')
-narf.clingutils.Declare('#include "electron_selections.h"')
+include_cache.declare('#include "lowpu_utils.h"')
+include_cache.declare('#include "lowpu_efficiencies.h"')
+include_cache.declare('#include "lowpu_prefire.h"')
+include_cache.declare('#include "lowpu_rochester.h"')
+include_cache.declare('#include "electron_selections.h"')
 
 
 def lepSF_systs(df, results, sName, sVars, defineExpr, baseName, baseAxes, baseCols):
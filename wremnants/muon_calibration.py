@@ -2,6 +2,7 @@ import ROOT
 import pathlib
 import hist
 import narf
+from wremnants import include_cache
 from utilities import rdf_tools
 from utilities import common, logging
 from utilities import boostHistHelpers as hh
@@ -16,8 +17,8 @@ import pickle
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "muon_calibration.h"')
-narf.clingutils.Declare('#include "lowpu_utils.h"')
+include_cache.declare('#include "muon_calibration.h"')
+include_cache.declare('#include "lowpu_utils.h"')
 
 data_dir = common.data_dir
 
@@ -169,6 +170,20 @@ def make_muon_bias_helpers(args):
 
     return helper
 
+# accepted deviation of the weights interpolated on the default grid from the model, relative to the standard deviation of the weights
+# of muons in the template range (maximum and 99% quantile), checked by scripts/tests/benchmark_splines_weights.py
+splines_weights_grid_tolerance = {"max" : 1e-2, "q99" : 1e-3}
+
+def make_splines_differential_weights_helper(filename, grid=False, pt_grid=[43, 16., 100.], eta_grid=[25, -2.4, 2.4], qopr_grid=[401, 0.8, 1.2]):
+    # with grid=True the model is evaluated on a grid of (nPoints, min, max) for genPt, genEta and qoprec/qopgen and interpolated,
+    # the deviation from the model with the default grid is within splines_weights_grid_tolerance
+    if not grid:
+        return ROOT.wrem.SplinesDifferentialWeightsHelper(filename)
+    time0 = time.time()
+    helper = ROOT.wrem.SplinesDifferentialWeightsGridHelper(filename, *pt_grid, *eta_grid, *qopr_grid)
+    logger.info(f"Evaluate the muon response weights on a grid: {time.time() - time0}")
+    return helper
+
 def make_muon_smearing_helpers(filename = f"{data_dir}/calibration/smearingrel_smooth.pkl.lz4",
                                filenamevar = f"{data_dir}/calibration/smearing_variations_smooth.pkl.lz4"):
     # this helper smears muon pT to match the resolution in data
@@ -2,6 +2,7 @@ import ROOT
 import pathlib
 import hist
 import narf
+from wremnants import include_cache
 import numpy as np
 import boost_histogram as bh
 import logging
@@ -10,8 +11,8 @@ import lz4.frame
 
 from utilities import common
 
-narf.clingutils.Declare('#include "muon_efficiencies_binned.h"')
-narf.clingutils.Declare('#include "muon_efficiencies_binned_vqt.h"')
+include_cache.declare('#include "muon_efficiencies_binned.h"')
+include_cache.declare('#include "muon_efficiencies_binned_vqt.h"')
 
 data_dir = common.data_dir
 
@@ -2,6 +2,7 @@ import ROOT
 import pathlib
 import hist
 import narf
+from wremnants import include_cache
 import numpy as np
 import boost_histogram as bh
 import pickle
@@ -15,7 +16,7 @@ from utilities import common, logging
 from utilities.io_tools import input_tools
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "muon_efficiencies_smooth.h"')
+include_cache.declare('#include "muon_efficiencies_smooth.h"')
 
 data_dir = common.data_dir
 
@@ -2,9 +2,10 @@ import ROOT
 import pathlib
 import hist
 import narf.clingutils
+from wremnants import include_cache
 from utilities import common
 
-narf.clingutils.Declare('#include "muon_prefiring.h"')
+include_cache.declare('#include "muon_prefiring.h"')
 
 data_dir = common.data_dir
 
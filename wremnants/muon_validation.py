@@ -1,6 +1,7 @@
 import ROOT
 import hist
 import narf
+from wremnants import include_cache
 import numpy as np
 import uproot
 from functools import reduce
@@ -8,7 +9,7 @@ from utilities import common, logging
 from utilities import boostHistHelpers as hh
 from wremnants.muon_calibration import get_jpsi_scale_param_cov_mat
 
-narf.clingutils.Declare('#include "muon_validation.h"')
+include_cache.declare('#include "muon_validation.h"')
 
 logger = logging.child_logger(__name__)
 
@@ -2,13 +2,14 @@ import ROOT
 import pathlib
 import hist
 import narf
+from wremnants import include_cache
 import numpy as np
 import boost_histogram as bh
 from utilities import common, logging
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "pileup.h"')
+include_cache.declare('#include "pileup.h"')
 
 data_dir = common.data_dir
 
@@ -0,0 +1,163 @@
+import ROOT
+import narf
+from wremnants import include_cache
+import hist
+import json
+import re
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+include_cache.declare('#include "graph_profiler.h"')
+
+# python references to the helpers used in profiled columns, the jitted code only holds their address
+profiled_helpers = []
+
+def add_node(name):
+    return ROOT.wrem.GraphProfiler.instance().add_node(name)
+
+def profiled_expression(node_id, expr, rettype=""):
+    # the expression is evaluated inside a lambda timed by wrem::profile_call,
+    # as for RDataFrame expressions with a return statement are taken as function bodies
+    body = expr if re.search(r"\breturn\b", expr) else f"return {expr};"
+    return f"return wrem::profile_call({node_id}, [&](){rettype} {{ {body} }});"
+
+def profiled_helper(node_id, helper, cols):
+    # expose the helper to the interpreter through its address and call it from a timed expression
+    profiled_helpers.append(helper)
+    name = f"wrem_profiled_helper_{node_id}"
+    ROOT.gInterpreter.Declare(f"auto &{name} = *reinterpret_cast<{type(helper).__cpp_name__}*>({ROOT.addressof(helper)});")
+    return profiled_expression(node_id, f"{name}({', '.join(cols)})")
+
+class ProfiledNode(object):
+    # wraps a node of the RDataFrame graph, Define and Filter are replaced by timed expressions,
+    # all other methods are forwarded and returned nodes are wrapped again
+    def __init__(self, node, prefix):
+        self.node = node
+        self.prefix = prefix
+
+    def wrap(self, res):
+        if isinstance(res, ProfiledNode) or not hasattr(res, "Define"):
+            return res
+        return ProfiledNode(res, self.prefix)
+
+    def Define(self, name, expr, cols=None):
+        node_id = add_node(f"{self.prefix}Define:{name}")
+        if isinstance(expr, str):
+            return self.wrap(self.node.Define(name, profiled_expression(node_id, expr)))
+        return self.wrap(self.node.Define(name, profiled_helper(node_id, expr, cols)))
+
+    def Filter(self, expr, *args):
+        if not isinstance(expr, str):
+            return self.wrap(self.node.Filter(expr, *args))
+        node_id = add_node(f"{self.prefix}Filter:{expr}")
+        return self.wrap(self.node.Filter(profiled_expression(node_id, expr, " -> bool"), *args))
+
+    def __getattr__(self, attr):
+        res = getattr(self.node, attr)
+        if not callable(res):
+            return res
+        def call(*args, **kwargs):
+            return self.wrap(res(*args, **kwargs))
+        return call
+
+def time_tasks(df, name):
+    # the tasks of the event loop are timed by a filter at the top of the graph which is always true
+    dataset_id = ROOT.wrem.TaskTimer.instance().add_dataset(name)
+    df = df.DefinePerSample("wrem_task", f"return wrem::TaskTimer::instance().start({dataset_id}, rdfslot_);")
+    return df.Filter("return wrem::TaskTimer::tick(wrem_task);", "wrem_task")
+
+def profile_build_graph(build_graph):
+    # the nodes are named by the dataset they belong to
+    def profiled_build_graph(df, dataset):
+        return build_graph(ProfiledNode(time_tasks(df, dataset.name), f"{dataset.name}:"), dataset)
+    return profiled_build_graph
+
+def task_report():
+    # the work is balanced if the event loop ends shortly after the last task started, compared to the mean time of a task,
+    # as after that the threads become idle one after the other
+    timer = ROOT.wrem.TaskTimer.instance()
+    names = list(timer.names())
+    tasks = [(names[t.dataset], t.start, t.end, int(t.entries)) for t in timer.tasks()]
+    if not tasks:
+        return {}
+
+    times = [(end - start)*1e-9 for _, start, end, _ in tasks]
+    mean = sum(times)/len(times)
+    loop_start = min(t[1] for t in tasks)
+    loop_end = max(t[2] for t in tasks)
+    tail = (loop_end - max(t[1] for t in tasks))*1e-9
+
+    datasets = {}
+    for (name, _, _, entries), dt in zip(tasks, times):
+        if name not in datasets:
+            datasets[name] = {"dataset": name, "tasks": 0, "entries": 0, "time": 0., "max_task_time": 0.}
+        datasets[name]["tasks"] += 1
+        datasets[name]["entries"] += entries
+        datasets[name]["time"] += dt
+        datasets[name]["max_task_time"] = max(datasets[name]["max_task_time"], dt)
+
+    report = {
+        "tasks": len(tasks),
+        "event_loop_time": (loop_end - loop_start)*1e-9,
+        "mean_task_time": mean,
+        "max_task_time": max(times),
+        "time_after_last_task_start": tail,
+        "tail_over_mean_task_time": tail/mean if mean > 0 else 0.,
+        "datasets": sorted(datasets.values(), key=lambda x: -x["max_task_time"]),
+    }
+    logger.info(f"Event loop of {report['event_loop_time']:.1f} s with {len(tasks)} tasks, mean task time {mean:.2f} s, longest task {max(times):.2f} s, "
+        f"the loop ended {tail:.2f} s after the last task started ({report['tail_over_mean_task_time']:.2f} times the mean task time)")
+    return report
+
+def hist_nbytes(h):
+    values = h.values(flow=True)
+    return values.nbytes*(2 if h.storage_type == hist.storage.Weight else 1)
+
+def make_report(resultdict):
+    # time and number of calls of the columns and filters (summed over the datasets and for each dataset),
+    # and the size of the booked histograms, sorted by the cumulative time and size
+    profiler = ROOT.wrem.GraphProfiler.instance()
+    names = list(profiler.names())
+    totals = profiler.totals()
+
+    nodes = {}
+    nodes_dataset = []
+    for name, (calls, ns) in zip(names, totals):
+        dataset, node = name.split(":", 1)
+        nodes_dataset.append({"dataset": dataset, "node": node, "calls": int(calls), "time": ns*1e-9})
+        if node not in nodes:
+            nodes[node] = {"node": node, "calls": 0, "time": 0.}
+        nodes[node]["calls"] += int(calls)
+        nodes[node]["time"] += ns*1e-9
+
+    hists = {}
+    hists_dataset = []
+    for dataset, result in resultdict.items():
+        if not isinstance(result, dict) or "output" not in result:
+            continue
+        for h_name, h in result["output"].items():
+            h = h.get() if isinstance(h, narf.ioutils.H5PickleProxy) else h
+            nbytes = hist_nbytes(h) if hasattr(h, "values") else 0
+            hists_dataset.append({"dataset": dataset, "hist": h_name, "bytes": nbytes})
+            hists[h_name] = hists.get(h_name, 0) + nbytes
+
+    report = {
+        "nodes": sorted(nodes.values(), key=lambda x: -x["time"]),
+        "nodes_per_dataset": sorted(nodes_dataset, key=lambda x: -x["time"]),
+        "hists": sorted([{"hist": k, "bytes": v} for k, v in hists.items()], key=lambda x: -x["bytes"]),
+        "hists_per_dataset": sorted(hists_dataset, key=lambda x: -x["bytes"]),
+        "tasks": task_report(),
+    }
+
+    for entry in report["nodes"][:20]:
+        logger.info(f"{entry['node'][:80].ljust(80)} {entry['time']:10.2f} s {entry['calls']:12d} calls")
+    for entry in report["hists"][:10]:
+        logger.info(f"{entry['hist'][:80].ljust(80)} {entry['bytes']/1024**2:10.1f} MB")
+
+    return report
+
+def write_report(report, outfile):
+    logger.info(f"Write graph profile to {outfile}")
+    with open(outfile, "w") as f:
+        json.dump(report, f, indent=1)
@@ -8,18 +8,24 @@ import decimal
 import json
 import os
 import array
+import time
 from utilities import common as common
 from utilities.io_tools import input_tools
+from wremnants import include_cache
 
 import tensorflow as tf
 
 
-ROOT.gInterpreter.Declare('#include "recoil_tools.h"')
-ROOT.gInterpreter.Declare('#include "recoil_helper.h"')
+include_cache.declare('#include "recoil_tools.h"')
+include_cache.declare('#include "recoil_helper.h"')
 logger = logging.getLogger("wremnants").getChild(__name__.split(".")[-1])
 
+# accepted deviation of the recoil calibration interpolated on the default grid from the model for events inside the grid,
+# relative to the standard deviation of the values (maximum and 99% quantile), checked by scripts/tests/benchmark_recoil_helper.py
+recoil_grid_tolerance = {"max" : 1e-2, "q99" : 1e-3}
 
-def RecoilCalibrationHelper(fIn, args):
+
+def RecoilCalibrationHelper(fIn, args, pt_grid=[51, 0., 100.], para_grid=[101, -100., 100.], perp_grid=[101, -100., 100.]):
 
     with open(fIn, 'rb') as f:
         model = f.read()
@@ -27,7 +33,15 @@ def RecoilCalibrationHelper(fIn, args):
         meta = interpreter.get_signature_runner('meta')()['output_00000_00000']
         nstat = int(meta[0])
 
-    helper = ROOT.wrem.RecoilCalibrationHelper[nstat](fIn, "base_transform", args.recoilUnc)
+    if not getattr(args, "recoilGrid", False):
+        helper = ROOT.wrem.RecoilCalibrationHelper[nstat](fIn, "base_transform", args.recoilUnc)
+        return helper, nstat
+
+    # the model is evaluated on a grid of (nPoints, min, max) for pt, ut_para and ut_perp and interpolated,
+    # the deviation from the model with the default grid is within recoil_grid_tolerance
+    time0 = time.time()
+    helper = ROOT.wrem.RecoilCalibrationGridHelper[nstat](fIn, "base_transform", args.recoilUnc, *pt_grid, *para_grid, *perp_grid)
+    logger.info(f"Evaluate the recoil calibration on a grid: {time.time() - time0}")
     return helper, nstat
 
 def VPTReweightHelper(fIn):
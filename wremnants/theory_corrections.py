@@ -9,8 +9,10 @@ import pickle
 import re
 import glob
 import h5py
+import sys
+import time
 from .correctionsTensor_helper import makeCorrectionsTensor
-from utilities import boostHistHelpers as hh, common, logging
+from utilities import boostHistHelpers as hh, common, logging, cache_tools
 from utilities.io_tools import input_tools
 from wremnants import theory_tools
 
@@ -22,6 +24,10 @@ def valid_theory_corrections():
     return [m[1] for m in matches if m]+["none"]
 
 def load_corr_helpers(procs, generators, make_tensor=True, base_dir=f"{common.data_dir}/TheoryCorrections/"):
+    # only the post-processed correction histograms are cached with --helperCache, the conversion to tensors is always done,
+    # the time of both steps is logged separately to see what the cache saves
+    time0 = time.time()
+    time_tensor = 0.
     corr_helpers = {}
     for proc in procs:
         corr_helpers[proc] = {}
@@ -31,17 +37,22 @@ def load_corr_helpers(procs, generators, make_tensor=True, base_dir=f"{common.da
                 logger.warning(f"Did not find correction file for process {proc}, generator {generator}. No correction will be applied for this process!")
                 continue
             logger.debug(f"Make theory correction helper for file: {fname}")
-            corrh = load_corr_hist(fname, proc[0], get_corr_name(generator))
-            corrh = postprocess_corr_hist(corrh)
+            histname = get_corr_name(generator)
+            corrh = cache_tools.cached("theory_corr", lambda: postprocess_corr_hist(load_corr_hist(fname, proc[0], histname)),
+                files=[fname], code=[sys.modules[__name__], hh], proc=proc[0], histname=histname)
             if not make_tensor:
                 corr_helpers[proc][generator] = corrh
-            elif "Helicity" in generator:
+                continue
+            time_tensor0 = time.time()
+            if "Helicity" in generator:
                 corr_helpers[proc][generator] = makeCorrectionsTensor(corrh, ROOT.wrem.CentralCorrByHelicityHelper, tensor_rank=3)
             else:
                 corr_helpers[proc][generator] = makeCorrectionsTensor(corrh, weighted_corr=generator in theory_tools.theory_corr_weight_map)
+            time_tensor += time.time() - time_tensor0
     for generator in generators:
         if not any([generator in corr_helpers[proc] for proc in procs]):
             logger.warning(f"Did not find correction for generator {generator} for any processes!")
+    logger.info(f"Load theory correction helpers: {time.time() - time0} (histograms {time.time() - time0 - time_tensor}{' from the cache' if cache_tools.cache_dir else ''}, tensors {time_tensor})")
     return corr_helpers
 
 def make_corr_helper_fromnp(filename=f"{common.data_dir}/N3LLCorrections/inclusive_{{process}}_pT.npz", isW=True):
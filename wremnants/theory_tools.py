@@ -7,10 +7,11 @@ from utilities import boostHistHelpers as hh,common,logging
 from wremnants import theory_corrections
 from scipy import ndimage
 import narf.clingutils
+from wremnants import include_cache
 from math import sqrt
 
 logger = logging.child_logger(__name__)
-narf.clingutils.Declare('#include "theoryTools.h"')
+include_cache.declare('#include "theoryTools.h"')
 
 # this puts the bin centers at 0.5, 1.0, 2.0
 axis_muRfact = hist.axis.Variable(
@@ -2,12 +2,13 @@ import ROOT
 import pathlib
 import hist
 import narf
+from wremnants import include_cache
 import numpy as np
 import boost_histogram as bh
 from utilities import common
 from utilities import common, logging
 
-narf.clingutils.Declare('#include "vertex.h"')
+include_cache.declare('#include "vertex.h"')
 
 logger = logging.child_logger(__name__)
 